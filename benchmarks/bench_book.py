@@ -0,0 +1,85 @@
+"""SortedDict book against the dense price ladder on synthetic order flow.
+
+The flow is a random walk of the mid price with limit orders placed within a band around it, a share of them
+crossing the spread, and random cancels of resting orders. Each book is run twice, the second time
+every operation is followed by a top of book read as a broadcast would do. Order entities are built up front, only the book operations are timed.
+
+Run from the repository root: python -m benchmarks.bench_book
+"""
+import random
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
+from src.market import domain
+
+BANDS = (10, 100, 1000)
+OPERATIONS = 50_000
+CANCEL_SHARE = 0.3
+TOP_LEVELS = 10
+
+
+def create_order(direction, price, quantity) -> domain.Order:
+    return domain.Order(
+        uuid=uuid4(),
+        account=uuid4(),
+        ticker='ABC',
+        dtype='LIMIT',
+        direction=direction,
+        price=price,
+        quantity=quantity,
+        created=datetime.now(),
+    )
+
+
+def generate_flow(band: int, seed: int = 0) -> list[tuple[str, object]]:
+    rng = random.Random(seed)
+    mid = 10_000
+    flow = []
+    for _ in range(OPERATIONS):
+        if rng.random() < CANCEL_SHARE:
+            flow.append(('CANCEL', rng.random()))
+            continue
+        mid += rng.choice((-1, 0, 1))
+        direction = rng.choice(('BUY', 'SELL'))
+        # Mostly passive orders, one in ten crosses the spread by a few ticks
+        offset = rng.randint(1, band) if rng.random() > 0.1 else -rng.randint(0, 3)
+        tick = mid - offset if direction == 'BUY' else mid + offset
+        flow.append(('SEND', create_order(direction, tick / 100, rng.randint(1, 10))))
+    return flow
+
+
+def run(book: domain.BookType, flow: list[tuple[str, object]], read_top: bool) -> tuple[float, int]:
+    market = domain.Market(ticker='ABC', orders=[], tick_size=0.01, book=book)
+    resting = []
+    start = perf_counter()
+    for action, payload in flow:
+        if action == 'SEND':
+            market.send_order(payload)
+            resting.append(payload.uuid)
+        elif resting:
+            uuid = resting.pop(int(payload * len(resting)))
+            try:
+                market.cancel_order(uuid)
+            except LookupError:
+                pass
+        if read_top:
+            market.top_buy_levels(TOP_LEVELS)
+            market.top_sell_levels(TOP_LEVELS)
+    elapsed = perf_counter() - start
+    return elapsed / len(flow), len(market.buy_level) + len(market.sell_level)
+
+
+def main():
+    print(f"{'band':>8} {'top':>6} {'levels':>8} {'sorted, us':>12} {'ladder, us':>12} {'speedup':>8}")
+    for band in BANDS:
+        flow = generate_flow(band)
+        for read_top in (False, True):
+            sorted_op, levels = run('SORTED', flow, read_top)
+            ladder_op, _ = run('LADDER', flow, read_top)
+            print(f"{band:>8} {str(read_top):>6} {levels:>8} {sorted_op * 1e6:>12.2f} {ladder_op * 1e6:>12.2f} "
+                  f"{sorted_op / ladder_op:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Fan-out of transaction messages to 1k subscribers of one channel.
+
+The baseline encodes the message for every socket, as send_json did. The other runs go through
+ConnectionManager, which encodes once and queues the same text for every writer task, with the json
+fallback and with orjson. Sockets accept text without doing any I/O, so the numbers are encoding and
+queueing cost only.
+
+Run from the repository root: python -m benchmarks.bench_broadcast
+"""
+import asyncio
+import json
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
+from loguru import logger
+from pydantic_core import to_jsonable_python
+
+from src.market import domain
+from src.market.infrastructure import broadcast
+from src.market.infrastructure.schema import TransactionSchema
+
+SUBSCRIBERS = 1_000
+MESSAGES = 200
+
+
+class NullWebSocket:
+    async def send_text(self, text: str):
+        pass
+
+
+def create_message() -> dict:
+    trs = domain.Transaction(ticker='ABC', date=datetime.now(), price=10, quantity=1, buyer=uuid4(), seller=uuid4())
+    return TransactionSchema.from_entity(trs).model_dump()
+
+
+async def bench_per_socket(messages: list[dict]) -> float:
+    sockets = [NullWebSocket() for _ in range(SUBSCRIBERS)]
+    start = perf_counter()
+    for message in messages:
+        for websocket in sockets:
+            await websocket.send_text(json.dumps(message, separators=(',', ':'), default=to_jsonable_python))
+    return perf_counter() - start
+
+
+async def bench_manager(messages: list[dict]) -> float:
+    manager = broadcast.ConnectionManager('bench', maxsize=len(messages))
+    sockets = [NullWebSocket() for _ in range(SUBSCRIBERS)]
+    connections = [manager.add('ABC', x) for x in sockets]
+    start = perf_counter()
+    for message in messages:
+        manager.broadcast('ABC', message)
+    while any(len(x) for x in connections):
+        await asyncio.sleep(0)
+    elapsed = perf_counter() - start
+    for websocket in sockets:
+        await manager.disconnect('ABC', websocket)
+    assert manager.stats().dropped == 0
+    return elapsed
+
+
+def main():
+    logger.disable('src')
+    messages = [create_message() for _ in range(MESSAGES)]
+    orjson = broadcast.orjson
+    runs = [('encode per socket', None, bench_per_socket), ('encode once, json', None, bench_manager)]
+    if orjson is not None:
+        runs.append(('encode once, orjson', orjson, bench_manager))
+    print(f"{'subscribers':>12} {'run':>22} {'per message, ms':>16} {'per delivery, us':>17}")
+    for name, encoder, bench in runs:
+        broadcast.orjson = encoder
+        elapsed = asyncio.run(bench(messages))
+        print(f"{SUBSCRIBERS:>12} {name:>22} {elapsed / MESSAGES * 1e3:>16.3f} "
+              f"{elapsed / MESSAGES / SUBSCRIBERS * 1e6:>17.2f}")
+    broadcast.orjson = orjson
+
+
+if __name__ == '__main__':
+    main()
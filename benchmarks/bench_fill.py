@@ -0,0 +1,86 @@
+"""Per-fill cost of the pydantic entities versus the compact book representation.
+
+Run from the repository root: python -m benchmarks.bench_fill
+"""
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
+from src.base import eventbus
+from src.market import domain
+
+FILLS = 10_000
+
+
+def create_order(direction, price, quantity) -> domain.Order:
+    return domain.Order(
+        uuid=uuid4(),
+        account=uuid4(),
+        ticker='ABC',
+        dtype='LIMIT',
+        direction=direction,
+        price=price,
+        quantity=quantity,
+        created=datetime.now(),
+    )
+
+
+def pydantic_fills(maker: domain.Order, taker: domain.Order) -> list:
+    # What the matching loop used to allocate for every fill
+    result = []
+    for _ in range(FILLS):
+        trs = domain.Transaction(date=datetime.now(), buyer=taker.account, seller=maker.account, price=maker.price,
+                                 quantity=1, ticker=maker.ticker)
+        result.append(eventbus.Deleted(key='OrderCompleted', entity=maker))
+        result.append(eventbus.Created(key='TransactionCreated', entity=trs))
+    return result
+
+
+def compact_fills(maker: domain.Order, taker: domain.Order) -> list:
+    now = datetime.now()
+    # Tick size 0.01, as a commodity gets by default
+    book_maker = domain.BookOrder.from_entity(maker, maker.price, round(maker.price / 0.01))
+    result = []
+    for _ in range(FILLS):
+        result.append(('OrderCompleted', book_maker))
+        result.append(('TransactionCreated', domain.Fill(ticker=maker.ticker, date=now, price=maker.price, quantity=1,
+                                                         buyer=taker.account, seller=maker.account)))
+    return result
+
+
+def measure(func, *args) -> tuple[float, float]:
+    start = perf_counter()
+    func(*args)
+    elapsed = perf_counter() - start
+    tracemalloc.start()
+    result = func(*args)
+    allocated, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed / FILLS, allocated / FILLS
+
+
+def bench_market() -> tuple[float, float]:
+    market = domain.Market(ticker='ABC', orders=[create_order('SELL', 100, 1) for _ in range(FILLS)])
+    taker = create_order('BUY', 100, FILLS)
+    start = perf_counter()
+    market.send_buy_limit_order(taker)
+    matched = perf_counter() - start
+    market.events.parse_events()
+    converted = perf_counter() - start
+    return matched / FILLS, converted / FILLS
+
+
+def main():
+    maker, taker = create_order('SELL', 100, 1), create_order('BUY', 100, 1)
+    print(f"{'representation':>16} {'us/fill':>10} {'bytes/fill':>12}")
+    for name, func in (('pydantic', pydantic_fills), ('compact', compact_fills)):
+        elapsed, allocated = measure(func, maker, taker)
+        print(f"{name:>16} {elapsed * 1e6:>10.2f} {allocated:>12.0f}")
+    matched, converted = bench_market()
+    print(f"market sweep: {matched * 1e6:.2f} us/fill matching, {converted * 1e6:.2f} us/fill with entity conversion")
+
+
+if __name__ == '__main__':
+    main()
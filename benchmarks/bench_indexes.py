@@ -0,0 +1,137 @@
+"""Query plans and timings of the hot query paths with and without the secondary indexes.
+
+Seeds realistic volumes into the migrated tables, runs EXPLAIN ANALYZE for every path, drops the indexes and
+runs them again. Everything happens in one transaction that is rolled back, DDL included.
+
+Run from the repository root: DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.bench_indexes
+"""
+import asyncio
+import json
+import os
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from src import db
+
+ACCOUNTS = 2_000
+TICKERS = 50
+ORDERS = 200_000
+TRANSACTIONS = 1_000_000
+DEALS = 50_000
+
+INDEXES = (
+    'ix_order_open_ticker',
+    'ix_order_account_created',
+    'ix_transaction_buyer',
+    'ix_transaction_seller',
+    'ix_transaction_ticker_date',
+    'ix_transaction_date',
+)
+
+CONSTRAINTS = (
+    ('deal_table', 'uq_deal_table_account_ticker'),
+)
+
+SEED = (
+    f"""
+    CREATE TEMP TABLE bench_account ON COMMIT DROP AS
+    SELECT gen_random_uuid() AS id, row_number() OVER () AS n FROM generate_series(1, {ACCOUNTS})
+    """,
+    f"""
+    INSERT INTO "order" (id, updated_at, account, ticker, status, dtype, direction, price, quantity, created)
+    SELECT gen_random_uuid(), now(), a.id::text, 'T' || (i % {TICKERS}),
+           CASE WHEN i % 5 = 0 THEN 'PARTIAL' ELSE 'PENDING' END, 'LIMIT',
+           CASE WHEN i % 2 = 0 THEN 'BUY' ELSE 'SELL' END, 100 + (i % 200) * 0.01, 1 + i % 10,
+           now() - i * interval '1 second'
+    FROM generate_series(1, {ORDERS}) AS i JOIN bench_account a ON a.n = 1 + i % {ACCOUNTS}
+    """,
+    f"""
+    INSERT INTO transaction (id, updated_at, ticker, date, price, quantity, buyer, seller)
+    SELECT gen_random_uuid(), now(), 'T' || (i % {TICKERS}), now() - i * interval '1 second',
+           100 + (i % 200) * 0.01, 1 + i % 10, b.id, s.id
+    FROM generate_series(1, {TRANSACTIONS}) AS i
+    JOIN bench_account b ON b.n = 1 + i % {ACCOUNTS}
+    JOIN bench_account s ON s.n = 1 + (i * 7) % {ACCOUNTS}
+    """,
+    f"""
+    INSERT INTO deal_table (id, updated_at, account, ticker, status, weighted_price, total_quantity)
+    SELECT gen_random_uuid(), now(), a.id, 'T' || (i / {ACCOUNTS} % {TICKERS}), 'PROCESSING', 0, 0
+    FROM generate_series(1, {DEALS}) AS i JOIN bench_account a ON a.n = 1 + i % {ACCOUNTS}
+    """,
+    'ANALYZE "order"',
+    'ANALYZE transaction',
+    'ANALYZE deal_table',
+)
+
+ACCOUNT = '(SELECT id FROM bench_account WHERE n = 42)'
+
+QUERIES = {
+    'open orders of a ticker': """
+        SELECT * FROM "order" WHERE ticker = 'T7' AND status IN ('PENDING', 'PARTIAL') ORDER BY created
+    """,
+    'account orders page': f"""
+        SELECT * FROM "order" WHERE account = {ACCOUNT}::text ORDER BY created, id LIMIT 100
+    """,
+    'transactions as buyer': f"SELECT * FROM transaction WHERE buyer = {ACCOUNT}",
+    'transactions as seller': f"SELECT * FROM transaction WHERE seller = {ACCOUNT}",
+    'ticker transactions page': """
+        SELECT * FROM transaction WHERE ticker = 'T7' AND (date, id) > (now() - interval '5 days', gen_random_uuid())
+        ORDER BY date, id LIMIT 100
+    """,
+    'transactions page': """
+        SELECT * FROM transaction WHERE (date, id) > (now() - interval '5 days', gen_random_uuid())
+        ORDER BY date, id LIMIT 100
+    """,
+    'deal of an account': f"SELECT * FROM deal_table WHERE account = {ACCOUNT} AND ticker = 'T7'",
+}
+
+
+def summarize(plan: dict) -> str:
+    nodes = []
+
+    def walk(node):
+        name = node['Node Type']
+        if 'Index Name' in node:
+            name += f" ({node['Index Name']})"
+        nodes.append(name)
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan['Plan'])
+    return ' > '.join(nodes)
+
+
+async def explain(conn) -> dict[str, tuple[float, str]]:
+    result = {}
+    for name, query in QUERIES.items():
+        rows = await conn.execute(text(f'EXPLAIN (ANALYZE, FORMAT JSON) {query}'))
+        plan = rows.scalar()
+        plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]
+        result[name] = (plan['Execution Time'], summarize(plan))
+    return result
+
+
+async def main():
+    engine = create_async_engine(os.environ.get('DATABASE_URL', db.DATABASE_URL))
+    async with engine.connect() as conn:
+        transaction = await conn.begin()
+        for stmt in SEED:
+            await conn.execute(text(stmt))
+        indexed = await explain(conn)
+        for index in INDEXES:
+            await conn.execute(text(f'DROP INDEX IF EXISTS {index}'))
+        for table, constraint in CONSTRAINTS:
+            await conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}'))
+        plain = await explain(conn)
+        await transaction.rollback()
+    await engine.dispose()
+
+    for name in QUERIES:
+        print(f'{name}: {plain[name][0]:.2f} ms -> {indexed[name][0]:.2f} ms')
+        print(f'    without: {plain[name][1]}')
+        print(f'    with:    {indexed[name][1]}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+"""Matching throughput of an aggressive order sweeping one deep price level.
+
+Run from the repository root: python -m benchmarks.bench_matching
+"""
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
+from src.market import domain
+
+DEPTHS = (10, 100, 1000)
+ROUNDS = 20
+
+
+def create_order(direction, price, quantity) -> domain.Order:
+    return domain.Order(
+        uuid=uuid4(),
+        account=uuid4(),
+        ticker='ABC',
+        dtype='LIMIT',
+        direction=direction,
+        price=price,
+        quantity=quantity,
+        created=datetime.now(),
+    )
+
+
+def bench_sweep(depth: int) -> float:
+    elapsed = 0
+    for _ in range(ROUNDS):
+        market = domain.Market(ticker='ABC', orders=[create_order('SELL', 100, 1) for _ in range(depth)])
+        taker = create_order('BUY', 100, depth)
+        start = perf_counter()
+        market.send_buy_limit_order(taker)
+        elapsed += perf_counter() - start
+        assert len(market.sell_level) == 0
+    return elapsed / ROUNDS
+
+
+def bench_nibble(depth: int) -> float:
+    market = domain.Market(ticker='ABC', orders=[create_order('SELL', 100, 2) for _ in range(depth)])
+    takers = [create_order('BUY', 100, 1) for _ in range(depth)]
+    start = perf_counter()
+    for taker in takers:
+        market.send_buy_limit_order(taker)
+    return (perf_counter() - start) / depth
+
+
+def main():
+    print(f"{'depth':>8} {'sweep, ms':>12} {'fills/s':>12} {'nibble, us':>12}")
+    for depth in DEPTHS:
+        sweep = bench_sweep(depth)
+        nibble = bench_nibble(depth)
+        print(f"{depth:>8} {sweep * 1e3:>12.3f} {depth / sweep:>12.0f} {nibble * 1e6:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Bulk order updates through PostgresRepo against a local Postgres.
+
+Compares the former path (an ORM instance per row, its state fed to an ORM bulk UPDATE) with update_many
+(one executemany of a Core UPDATE bound by primary key). Rows are inserted and updated inside a transaction
+that is rolled back, the database needs the migrated schema.
+
+Run from the repository root: DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.bench_repo_update
+"""
+import asyncio
+import os
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from src import db
+from src.base.repo import PostgresRepo
+from src.market import domain
+from src.market.infrastructure.postgres import OrderModel
+
+SIZES = (1_000, 10_000)
+
+
+def create_order(quantity: int) -> domain.Order:
+    return domain.Order(account=uuid4(), ticker='BENCH', dtype='LIMIT', direction='BUY', price=100,
+                        quantity=quantity, created=datetime.now())
+
+
+async def orm_update_many(session: AsyncSession, orders: list[domain.Order]):
+    data = [{k: v for k, v in OrderModel.from_entity(x).__dict__.items() if not k.startswith('_')} for x in orders]
+    await session.execute(update(OrderModel), data)
+
+
+async def bench(engine, size: int) -> tuple[float, float]:
+    orders = [create_order(10) for _ in range(size)]
+    async with AsyncSession(engine) as session:
+        repo = PostgresRepo(session, OrderModel)
+        await repo.add_many(orders)
+        await session.flush()
+
+        changed = [x.model_copy(update={'quantity': 5, 'status': 'PARTIAL'}) for x in orders]
+        start = perf_counter()
+        await orm_update_many(session, changed)
+        orm = perf_counter() - start
+
+        changed = [x.model_copy(update={'quantity': 3}) for x in orders]
+        start = perf_counter()
+        await repo.update_many(changed)
+        core = perf_counter() - start
+        await session.rollback()
+    return orm, core
+
+
+async def main():
+    engine = create_async_engine(os.environ.get('DATABASE_URL', db.DATABASE_URL))
+    print(f"{'rows':>8} {'orm, ms':>10} {'core, ms':>10} {'speedup':>8}")
+    for size in SIZES:
+        orm, core = await bench(engine, size)
+        print(f"{size:>8} {orm * 1e3:>10.1f} {core * 1e3:>10.1f} {orm / core:>8.2f}")
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""CPU cost of building a book from loaded orders, ORM hydration against plain rows.
+
+The database round-trip is left out: ORM instances are built in memory and converted with to_entity as
+get_many does, rows are named tuples of BOOK_ORDER_FIELDS as get_rows returns them.
+
+Run from the repository root: python -m benchmarks.bench_warm_up
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from time import perf_counter
+from uuid import uuid4
+
+from src.market import domain
+from src.market.infrastructure.postgres import OrderModel
+
+SIZES = (10_000, 100_000)
+
+OrderRow = namedtuple('OrderRow', domain.BOOK_ORDER_FIELDS)
+
+
+def generate_rows(size: int) -> list[OrderRow]:
+    accounts = [uuid4() for _ in range(100)]
+    start = datetime.now()
+    rows = []
+    for i in range(size):
+        direction = 'BUY' if i % 2 else 'SELL'
+        price = (9_000 - i % 1_000 if direction == 'BUY' else 11_000 + i % 1_000) / 100
+        rows.append(OrderRow(uuid4(), accounts[i % 100], 'ABC', 'LIMIT', direction, price, 1 + i % 10,
+                             start + timedelta(microseconds=i), 'PENDING'))
+    return rows
+
+
+def bench_entities(rows: list[OrderRow]) -> float:
+    models = [OrderModel(id=x.uuid, account=str(x.account), ticker=x.ticker, dtype=x.dtype, direction=x.direction,
+                         price=x.price, quantity=x.quantity, created=x.created, status=x.status) for x in rows]
+    start = perf_counter()
+    domain.Market(ticker='ABC', orders=[x.to_entity() for x in models])
+    return perf_counter() - start
+
+
+def bench_rows(rows: list[OrderRow]) -> float:
+    start = perf_counter()
+    domain.Market(ticker='ABC', orders=rows)
+    return perf_counter() - start
+
+
+def main():
+    print(f"{'orders':>8} {'entities, ms':>14} {'rows, ms':>10} {'speedup':>8}")
+    for size in SIZES:
+        rows = generate_rows(size)
+        entities, plain = bench_entities(rows), bench_rows(rows)
+        print(f"{size:>8} {entities * 1e3:>14.1f} {plain * 1e3:>10.1f} {entities / plain:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""add indexes for the hot query paths
+
+Revision ID: 3c9e7a5b1f20
+Revises: 8b41c6f0d2e9
+Create Date: 2026-10-18 12:05:37.114902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c9e7a5b1f20'
+down_revision: Union[str, None] = '8b41c6f0d2e9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_order_open_ticker', 'order', ['ticker', 'created'],
+                    postgresql_where=sa.text("status IN ('PENDING', 'PARTIAL')"))
+    op.create_index('ix_order_account_created', 'order', ['account', 'created', 'id'])
+    op.create_index('ix_transaction_buyer', 'transaction', ['buyer'])
+    op.create_index('ix_transaction_seller', 'transaction', ['seller'])
+    op.create_index('ix_transaction_ticker_date', 'transaction', ['ticker', 'date', 'id'])
+    op.create_index('ix_transaction_date', 'transaction', ['date', 'id'])
+    op.create_index('ix_deal_table_account_ticker', 'deal_table', ['account', 'ticker'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_deal_table_account_ticker', table_name='deal_table')
+    op.drop_index('ix_transaction_date', table_name='transaction')
+    op.drop_index('ix_transaction_ticker_date', table_name='transaction')
+    op.drop_index('ix_transaction_seller', table_name='transaction')
+    op.drop_index('ix_transaction_buyer', table_name='transaction')
+    op.drop_index('ix_order_account_created', table_name='order')
+    op.drop_index('ix_order_open_ticker', table_name='order')
@@ -0,0 +1,30 @@
+"""add account balance checks
+
+Revision ID: 4f6a2c8e0d17
+Revises: e2b8f4a6c913
+Create Date: 2026-10-18 13:58:12.470391
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4f6a2c8e0d17'
+down_revision: Union[str, None] = 'e2b8f4a6c913'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_check_constraint('ck_account_cash', 'account', 'cash >= 0')
+    op.create_check_constraint('ck_account_buy_deals_amount', 'account', 'buy_deals_amount >= 0')
+    op.create_check_constraint('ck_account_sell_deals_amount', 'account', 'sell_deals_amount >= 0')
+
+
+def downgrade() -> None:
+    op.drop_constraint('ck_account_sell_deals_amount', 'account', type_='check')
+    op.drop_constraint('ck_account_buy_deals_amount', 'account', type_='check')
+    op.drop_constraint('ck_account_cash', 'account', type_='check')
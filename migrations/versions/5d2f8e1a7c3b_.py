@@ -0,0 +1,26 @@
+"""add commodity tick size
+
+Revision ID: 5d2f8e1a7c3b
+Revises: dc6166b85ae0
+Create Date: 2026-10-18 10:52:14.216537
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2f8e1a7c3b'
+down_revision: Union[str, None] = 'dc6166b85ae0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('commodity', sa.Column('tick_size', sa.Float(), server_default='0.01', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('commodity', 'tick_size')
@@ -0,0 +1,26 @@
+"""add commodity book type
+
+Revision ID: 8b41c6f0d2e9
+Revises: 5d2f8e1a7c3b
+Create Date: 2026-10-18 11:20:41.508231
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b41c6f0d2e9'
+down_revision: Union[str, None] = '5d2f8e1a7c3b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('commodity', sa.Column('book', sa.String(length=16), server_default='SORTED', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('commodity', 'book')
@@ -0,0 +1,46 @@
+"""add position projection
+
+Revision ID: a7d3e9c41b58
+Revises: 3c9e7a5b1f20
+Create Date: 2026-10-18 12:48:02.931470
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d3e9c41b58'
+down_revision: Union[str, None] = '3c9e7a5b1f20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('position',
+                    sa.Column('account', sa.UUID(), nullable=False),
+                    sa.Column('ticker', sa.String(length=32), nullable=False),
+                    sa.Column('weighted_price', sa.Float(), nullable=False),
+                    sa.Column('total_quantity', sa.Integer(), nullable=False),
+                    sa.Column('id', sa.Uuid(), nullable=False),
+                    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('account', 'ticker', name='uq_position_account_ticker')
+                    )
+    # Existing history is projected once, later fills keep the table up to date
+    op.execute("""
+        INSERT INTO position (id, updated_at, account, ticker, weighted_price, total_quantity)
+        SELECT gen_random_uuid(), now(), account, ticker, sum(quantity * price), sum(quantity)
+        FROM (
+            SELECT buyer AS account, ticker, price, quantity FROM transaction WHERE buyer != seller
+            UNION ALL
+            SELECT seller AS account, ticker, price, -quantity FROM transaction WHERE buyer != seller
+        ) AS fills
+        GROUP BY account, ticker
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('position')
@@ -0,0 +1,45 @@
+"""make deals unique per account and ticker
+
+Revision ID: e2b8f4a6c913
+Revises: a7d3e9c41b58
+Create Date: 2026-10-18 13:21:45.602178
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b8f4a6c913'
+down_revision: Union[str, None] = 'a7d3e9c41b58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Concurrent read-then-insert could leave several deals of one account and ticker, merge them into the first
+    op.execute("""
+        UPDATE deal_table d
+        SET weighted_price = m.weighted_price, total_quantity = m.total_quantity
+        FROM (
+            SELECT min(id::text) AS keep, sum(weighted_price) AS weighted_price, sum(total_quantity) AS total_quantity
+            FROM deal_table
+            GROUP BY account, ticker
+            HAVING count(*) > 1
+        ) AS m
+        WHERE d.id::text = m.keep
+    """)
+    op.execute("""
+        DELETE FROM deal_table d
+        USING deal_table k
+        WHERE d.account = k.account AND d.ticker = k.ticker AND d.id::text > k.id::text
+    """)
+    op.drop_index('ix_deal_table_account_ticker', table_name='deal_table')
+    op.create_unique_constraint('uq_deal_table_account_ticker', 'deal_table', ['account', 'ticker'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_deal_table_account_ticker', 'deal_table', type_='unique')
+    op.create_index('ix_deal_table_account_ticker', 'deal_table', ['account', 'ticker'])
@@ -1,3 +1,4 @@
+from typing import NamedTuple
 from uuid import UUID, uuid4
 
 from pydantic import PrivateAttr
@@ -9,6 +10,13 @@ class NotEnoughMoney(Exception):
     pass
 
 
+class AccountChange(NamedTuple):
+    uuid: UUID
+    cash: float = 0
+    bda: float = 0
+    sda: float = 0
+
+
 class Account:
     def __init__(self, cash: float, bda: float, sda: float, uuid: UUID = lambda x: uuid4):
         self.validate(cash, bda, sda)
@@ -1,9 +1,17 @@
+from abc import ABC, abstractmethod
 from uuid import UUID
 
 from src.account import domain
 from src.base.repo import Repository
 
 
+class AccountRepository(Repository[domain.Account], ABC):
+    @abstractmethod
+    async def apply_changes(self, changes: list[domain.AccountChange]):
+        """Adds the changes to the stored balances at once, raises NotEnoughMoney if a balance would go negative"""
+        raise NotImplemented
+
+
 class CreateAccount:
     def __init__(self, account: domain.Account, repo: Repository[domain.Account]):
         self._repo = repo
@@ -22,6 +30,15 @@ class GetAccountByUuid:
         return await self._repo.get_one_by_id(self._uuid)
 
 
+class GetAccountsByUuids:
+    def __init__(self, uuids: list[UUID], repo: Repository[domain.Account]):
+        self._repo = repo
+        self._uuids = uuids
+
+    async def execute(self) -> list[domain.Account]:
+        return await self._repo.get_many_by_id(self._uuids)
+
+
 class UpdateAccount:
     def __init__(self, account: domain.Account, repo: Repository[domain.Account]):
         self._repo = repo
@@ -31,8 +48,17 @@ class UpdateAccount:
         await self._repo.update_one(self._account)
 
 
+class ApplyAccountChanges:
+    def __init__(self, changes: list[domain.AccountChange], repo: AccountRepository):
+        self._repo = repo
+        self._changes = changes
+
+    async def execute(self):
+        await self._repo.apply_changes(self._changes)
+
+
 class CommandFactory:
-    def __init__(self, acc_repo: Repository[domain.Account], ):
+    def __init__(self, acc_repo: AccountRepository, ):
         self._acc_repo = acc_repo
 
     def create_account(self, account: domain.Account) -> CreateAccount:
@@ -41,5 +67,11 @@ class CommandFactory:
     def get_account_by_uuid(self, uuid: UUID) -> GetAccountByUuid:
         return GetAccountByUuid(uuid, self._acc_repo)
 
+    def get_accounts_by_uuids(self, uuids: list[UUID]) -> GetAccountsByUuids:
+        return GetAccountsByUuids(uuids, self._acc_repo)
+
     def update_account(self, account: domain.Account) -> UpdateAccount:
         return UpdateAccount(account, self._acc_repo)
+
+    def apply_account_changes(self, changes: list[domain.AccountChange]) -> ApplyAccountChanges:
+        return ApplyAccountChanges(changes, self._acc_repo)
@@ -1,4 +1,3 @@
-from src.base.repo import Repository, PostgresRepo
 from .. import domain, handlers
 from . import postgres
 
@@ -7,8 +6,8 @@ class Bootstrap:
     def __init__(self, session):
         self._session = session
 
-    def get_account_repo(self) -> Repository[domain.Account]:
-        repo = PostgresRepo(self._session, postgres.AccountModel)
+    def get_account_repo(self) -> handlers.AccountRepository:
+        repo = postgres.AccountRepo(self._session)
         return repo
 
     def get_command_factory(self) -> handlers.CommandFactory:
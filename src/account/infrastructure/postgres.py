@@ -1,10 +1,13 @@
 from uuid import UUID
 
-from sqlalchemy import String, TIMESTAMP, Integer, Float, JSON, ForeignKey
+from sqlalchemy import String, TIMESTAMP, Integer, Float, JSON, ForeignKey, CheckConstraint, Uuid, column, func, \
+    update, values
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column
 
-from src.base.repo.postgres import Base
-from src.account import domain
+from src.base.repo.postgres import Base, PostgresRepo
+from src.account import domain, handlers
 
 
 class AccountModel(Base):
@@ -12,6 +15,11 @@ class AccountModel(Base):
     buy_deals_amount: Mapped[Float] = mapped_column(Float, nullable=False)
     sell_deals_amount: Mapped[Float] = mapped_column(Float, nullable=False)
     cash: Mapped[Float] = mapped_column(Float, nullable=False)
+    __table_args__ = (
+        CheckConstraint('cash >= 0', name='ck_account_cash'),
+        CheckConstraint('buy_deals_amount >= 0', name='ck_account_buy_deals_amount'),
+        CheckConstraint('sell_deals_amount >= 0', name='ck_account_sell_deals_amount'),
+    )
 
     @staticmethod
     def key_converter(key: str):
@@ -28,10 +36,45 @@ class AccountModel(Base):
         )
 
     @classmethod
-    def from_entity(cls, entity: domain.Account):
-        return cls(
+    def to_values(cls, entity: domain.Account) -> dict:
+        return dict(
             id=entity.uuid,
             buy_deals_amount=entity.buy_deals_amount,
             sell_deals_amount=entity.sell_deals_amount,
             cash=entity.cash,
         )
+
+
+class AccountRepo(PostgresRepo, handlers.AccountRepository):
+    def __init__(self, session: AsyncSession):
+        super().__init__(session, AccountModel)
+
+    async def apply_changes(self, changes: list[domain.AccountChange]):
+        if not changes:
+            return
+        # UPDATE ... FROM (VALUES ...): every balance changes in one statement, the CHECK constraints guard the result
+        table = AccountModel.__table__
+        data = values(
+            column('id', Uuid), column('cash', Float), column('bda', Float), column('sda', Float),
+            name='change',
+        ).data([(x.uuid, x.cash, x.bda, x.sda) for x in changes])
+        stmt = (
+            update(table)
+            .where(table.c.id == data.c.id)
+            .values(
+                cash=table.c.cash + data.c.cash,
+                buy_deals_amount=table.c.buy_deals_amount + data.c.bda,
+                sell_deals_amount=table.c.sell_deals_amount + data.c.sda,
+                updated_at=func.now(),
+            )
+            .returning(table.c.id)
+        )
+        try:
+            result = await self._session.execute(stmt)
+        except IntegrityError as err:
+            if 'ck_account_' in str(err.orig):
+                raise domain.NotEnoughMoney(str(err.orig)) from err
+            raise
+        updated = len(result.all())
+        if updated != len(changes):
+            raise LookupError(f'{len(changes) - updated} of {len(changes)} accounts not found')
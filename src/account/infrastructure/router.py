@@ -2,6 +2,7 @@ from uuid import UUID
 
 from fastapi import APIRouter, Depends
 from src import db
+from src.market.infrastructure.bootstrap import account_ledger
 
 from . import bootstrap, schema
 
@@ -44,4 +45,5 @@ async def update_account(data: schema.AccountSchema, get_as=Depends(db.get_as))
         boot = bootstrap.Bootstrap(session)
         await boot.get_command_factory().update_account(data.to_entity()).execute()
         await session.commit()
+        account_ledger.invalidate({data.uuid})
         return data
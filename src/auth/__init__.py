@@ -1,2 +1,2 @@
 from .db import User
-from .user import current_active_user
+from .user import current_active_user, current_superuser
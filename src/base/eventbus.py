@@ -1,5 +1,6 @@
+import asyncio
 from collections import deque
-from typing import Generic, TypeVar, Callable, Sequence, Optional
+from typing import Awaitable, Generic, TypeVar, Callable, Sequence, Optional
 from uuid import UUID, uuid4
 
 from loguru import logger
@@ -7,6 +8,10 @@ from pydantic import BaseModel, Field
 
 T = TypeVar("T")
 
+# Seconds before a failed dispatcher batch is handled again, doubled after every attempt up to the maximum
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30
+
 
 class Event(BaseModel):
     key: str
@@ -61,6 +66,12 @@ class Queue:
         for x in events:
             self.append(x)
 
+    def pop_all(self) -> list[Event]:
+        events = list(self._queue)
+        self._queue.clear()
+        logger.debug(f"EXTRACT: {len(events)} events")
+        return events
+
     @property
     def empty(self):
         return len(self._queue) == 0
@@ -70,15 +81,103 @@ class EventBus:
     def __init__(self, queue: Queue):
         self._queue = queue
         self._handlers: dict[str, Callable] = {}
+        self._batch_keys: set[str] = set()
 
     def register(self, key: str, handler: Callable):
         self._handlers[key] = handler
+        self._batch_keys.discard(key)
+
+    def register_batch(self, key: str, handler: Callable):
+        """Handler receives every queued event of the key at once"""
+        self._handlers[key] = handler
+        self._batch_keys.add(key)
 
     def extend_events(self, events: list[Event]):
         self._queue.extend(events)
 
-    async def run(self):
+    async def run(self) -> list[Event]:
+        # Queued events are grouped by key and the groups are handled in registration order,
+        # events raised by the handlers are picked up by the next round
+        handled = []
         while not self._queue.empty:
-            event = self._queue.popleft()
-            handler = self._handlers[event.key]
-            await handler(event)
+            grouped: dict[str, list[Event]] = {}
+            popped = self._queue.pop_all()
+            handled.extend(popped)
+            for event in popped:
+                if event.key not in self._handlers:
+                    raise KeyError(event.key)
+                grouped.setdefault(event.key, []).append(event)
+            for key, handler in self._handlers.items():
+                events = grouped.get(key)
+                if not events:
+                    continue
+                if key in self._batch_keys:
+                    await handler(events)
+                else:
+                    for event in events:
+                        await handler(event)
+        return handled
+
+
+class Dispatcher:
+    """
+    Hands committed events to `handle` in a background task, so the request that produced them does not wait.
+    Batches are handled in the order they were put, the ones that queue up meanwhile are handled as one.
+    A failed batch is handled again after a growing delay, later batches wait behind it until `attempts` run out.
+    """
+
+    def __init__(self, handle: Callable[[list[Event]], Awaitable], attempts: int = 1,
+                 retry_delay: float = RETRY_DELAY):
+        self._handle = handle
+        self._attempts = attempts
+        self._retry_delay = retry_delay
+        self._batches: deque[list[Event]] = deque()
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task: Optional[asyncio.Task] = None
+        self.lost = 0
+
+    def put(self, events: list[Event]):
+        if not events:
+            return
+        self._batches.append(events)
+        self._idle.clear()
+        self._ready.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name='event-dispatcher')
+
+    async def join(self):
+        await self._idle.wait()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        batches = self._batches
+        while True:
+            if not batches:
+                self._idle.set()
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            events = [x for batch in batches for x in batch]
+            batches.clear()
+            delay = self._retry_delay
+            for attempt in range(1, self._attempts + 1):
+                try:
+                    await self._handle(events)
+                    break
+                except Exception as err:
+                    if attempt == self._attempts:
+                        self.lost += len(events)
+                        logger.error(f'dispatcher lost {len(events)} events after {attempt} attempts: {err}')
+                        break
+                    logger.warning(f'dispatcher failed {len(events)} events, attempt {attempt}: {err}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
@@ -1,8 +1,9 @@
-from typing import Type
+from typing import Type, Sequence, AsyncIterator
 from uuid import UUID
 
 import loguru
-from sqlalchemy import TIMESTAMP, func, select, update, delete, Result, Table, ForeignKey
+from sqlalchemy import TIMESTAMP, func, select, update, delete, bindparam, tuple_, and_, or_, Result, Row, Table, \
+    ForeignKey
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.testing.schema import Column
@@ -24,6 +25,10 @@ def parse_order_by(model, order_by: OrderBy):
 def parse_filter_by(model, filter_by: dict) -> list:
     filters = []
     for key, value in filter_by.items():
+        if key == '$or':
+            # {'$or': [{...}, {...}]} matches rows satisfying any of the nested filters
+            filters.append(or_(*[and_(*parse_filter_by(model, x)) for x in value]))
+            continue
         key = model.key_converter(key)
         if '$__in' in key:
             filters.append(model.__table__.c[key.split('.')[0]].in_(value))
@@ -48,9 +53,17 @@ class Base(DeclarativeBase):
         return f"{self.__class__.__name__}"
 
     @classmethod
-    def from_entity(cls, entity: T):
+    def select_column(cls, key: str):
+        return cls.__table__.c[cls.key_converter(key)].label(key)
+
+    @classmethod
+    def to_values(cls, entity: T) -> dict:
         raise NotImplemented
 
+    @classmethod
+    def from_entity(cls, entity: T):
+        return cls(**cls.to_values(entity))
+
     def to_entity(self, **kwargs) -> T:
         raise NotImplemented
 
@@ -88,6 +101,35 @@ class PostgresRepo(Repository):
         entities = [x.to_entity() for x in models.scalars()]
         return entities
 
+    async def get_page(self, keyset: Sequence[str], after: Sequence = None, limit: int = 100, filter_by: dict = None,
+                       asc: bool = True) -> list[T]:
+        # Keyset pagination: the page starts right after the given key values, so its cost does not grow with depth
+        columns = [self._model.__table__.c[self._model.key_converter(key)] for key in keyset]
+        stmt = select(self._model)
+        if filter_by is not None:
+            stmt = stmt.where(*parse_filter_by(self._model, filter_by))
+        if after is not None:
+            stmt = stmt.where(tuple_(*columns) > tuple_(*after) if asc else tuple_(*columns) < tuple_(*after))
+        stmt = stmt.order_by(*[x.asc() if asc else x.desc() for x in columns]).limit(limit)
+        models = await self._session.execute(stmt)
+        return [x.to_entity() for x in models.scalars()]
+
+    async def get_rows(self, columns: Sequence[str], filter_by: dict = None, order_by: OrderBy = None,
+                       slice_from=None, slice_to=None) -> list[Row]:
+        # Plain rows labeled by entity field names, no ORM instance and no entity is built per row
+        stmt = select(*[self._model.select_column(x) for x in columns])
+        stmt = self._expand_statement(stmt, filter_by, order_by, slice_from, slice_to)
+        result = await self._session.execute(stmt)
+        return result.all()
+
+    async def stream_rows(self, columns: Sequence[str], filter_by: dict = None, order_by: OrderBy = None,
+                          chunk_size: int = 10_000) -> AsyncIterator[list[Row]]:
+        stmt = select(*[self._model.select_column(x) for x in columns])
+        stmt = self._expand_statement(stmt, filter_by, order_by)
+        result = await self._session.stream(stmt.execution_options(yield_per=chunk_size))
+        async for partition in result.partitions(chunk_size):
+            yield partition
+
     async def get_uniques(self, columns_by: list[str], filter_by: dict = None, order_by: OrderBy = None) -> Result:
         stmt = select(self._model).distinct(*[self._model.__table__.c[col] for col in columns_by])
         if filter_by is not None:
@@ -103,17 +145,27 @@ class PostgresRepo(Repository):
         entities = [x.to_entity() for x in result.scalars()]
         return entities
 
+    def _update_by_id_statement(self):
+        # Bind names must differ from column names in an UPDATE, hence the prefix
+        table = self._model.__table__
+        values = {col.name: bindparam(f'b_{col.name}') for col in table.c if col.name not in ('id', 'updated_at')}
+        return update(table).where(table.c.id == bindparam('b_id')).values(updated_at=func.now(), **values)
+
+    def _update_params(self, entity: T) -> dict:
+        return {f'b_{key}': value for key, value in self._model.to_values(entity).items()}
+
     async def update_one(self, data: T):
-        model = self._model.from_entity(data)
-        stmt = update(self._model).where(self._model.id == data.uuid).returning(self._model.id)
-        result = await self._session.execute(stmt, model.__dict__)
-        if len(list(result)) != 1:
-            raise LookupError(f"{len(list(result))}")
+        # A Core statement does not autoflush, pending inserts of this session must reach the database first
+        await self._session.flush()
+        result = await self._session.execute(self._update_by_id_statement(), self._update_params(data))
+        if result.rowcount != 1:
+            raise LookupError(f"{result.rowcount}")
 
     async def update_many(self, data: list[T]):
-        stmt = update(self._model)
-        data = [self._model.from_entity(x).__dict__ for x in data]
-        await self._session.execute(stmt, data)
+        if not data:
+            return
+        await self._session.flush()
+        await self._session.execute(self._update_by_id_statement(), [self._update_params(x) for x in data])
 
     async def remove_many(self, filter_by: dict):
         stmt = delete(self._model)
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Generic, TypeVar, Iterable, Sequence, NamedTuple, Union
+from typing import Generic, TypeVar, Iterable, Sequence, NamedTuple, Union, AsyncIterator
 from uuid import UUID
 
 from pydantic import BaseModel
@@ -26,6 +26,21 @@ class Repository(ABC, Generic[T]):
                        slice_to=None) -> list[T]:
         raise NotImplemented
 
+    @abstractmethod
+    async def get_page(self, keyset: Sequence[str], after: Sequence = None, limit: int = 100, filter_by: dict = None,
+                       asc: bool = True) -> list[T]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_rows(self, columns: Sequence[str], filter_by: dict = None, order_by: OrderBy = None,
+                       slice_from=None, slice_to=None) -> list[NamedTuple]:
+        raise NotImplemented
+
+    @abstractmethod
+    def stream_rows(self, columns: Sequence[str], filter_by: dict = None, order_by: OrderBy = None,
+                    chunk_size: int = 10_000) -> AsyncIterator[list[NamedTuple]]:
+        raise NotImplemented
+
     @abstractmethod
     async def get_uniques(self, columns_by: list[str], filter_by: dict = None, order_by: OrderBy = None) -> list[T]:
         raise NotImplemented
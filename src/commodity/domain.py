@@ -2,7 +2,7 @@ from uuid import UUID, uuid4
 
 from pydantic import BaseModel, Field
 
-from src.core import Ticker
+from src.core import BookType, Ticker
 
 
 Specification = str
@@ -12,4 +12,6 @@ class Commodity(BaseModel):
     ticker: Ticker
     description: str
     specification: Specification
+    tick_size: float = Field(default=0.01, gt=0)
+    book: BookType = 'SORTED'
     uuid: UUID = Field(default_factory=uuid4)
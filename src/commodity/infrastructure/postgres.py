@@ -1,4 +1,4 @@
-from sqlalchemy import String
+from sqlalchemy import String, Float
 from sqlalchemy.orm import Mapped, mapped_column
 
 from src.base.repo.postgres import Base
@@ -10,6 +10,12 @@ class CommodityModel(Base):
     ticker: Mapped[str] = mapped_column(String(16), unique=True)
     description: Mapped[str] = mapped_column(String(2048), default="")
     specification: Mapped[str] = mapped_column(String(2048), default="")
+    tick_size: Mapped[float] = mapped_column(Float, nullable=False, server_default='0.01')
+    book: Mapped[str] = mapped_column(String(16), nullable=False, server_default='SORTED')
+
+    @staticmethod
+    def key_converter(key: str):
+        return 'id' if key == 'uuid' else key
 
     def to_entity(self) -> domain.Commodity:
         return domain.Commodity(
@@ -17,13 +23,17 @@ class CommodityModel(Base):
             ticker=self.ticker,
             description=self.description,
             specification=self.specification,
+            tick_size=self.tick_size,
+            book=self.book,
         )
 
     @classmethod
-    def from_entity(cls, entity: domain.Commodity):
-        return cls(
+    def to_values(cls, entity: domain.Commodity) -> dict:
+        return dict(
             id=entity.uuid,
             ticker=entity.ticker,
             description=entity.description,
             specification=entity.specification,
+            tick_size=entity.tick_size,
+            book=entity.book,
         )
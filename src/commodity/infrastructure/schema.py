@@ -2,7 +2,7 @@ from uuid import UUID, uuid4
 
 from pydantic import BaseModel, Field
 
-from src.core import Ticker
+from src.core import BookType, Ticker
 from src.commodity  import domain
 
 
@@ -10,6 +10,8 @@ class CommoditySchema(BaseModel):
     ticker: Ticker
     description: str
     specification: domain.Specification
+    tick_size: float = Field(default=0.01, gt=0)
+    book: BookType = 'SORTED'
     uuid: UUID = Field(default_factory=uuid4)
 
     @classmethod
@@ -18,6 +20,8 @@ class CommoditySchema(BaseModel):
             ticker=entity.ticker,
             description=entity.description,
             specification=entity.specification,
+            tick_size=entity.tick_size,
+            book=entity.book,
             uuid=entity.uuid,
         )
 
@@ -26,5 +30,7 @@ class CommoditySchema(BaseModel):
             ticker=self.ticker,
             description=self.description,
             specification=self.specification,
+            tick_size=self.tick_size,
+            book=self.book,
             uuid=self.uuid,
         )
@@ -1,6 +1,8 @@
+from typing import Literal
 from uuid import uuid4
 
 Ticker = str
+BookType = Literal['SORTED', 'LADDER']
 
 
 def uuid4_factory():
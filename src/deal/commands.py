@@ -1,8 +1,22 @@
+from abc import ABC, abstractmethod
+
 from src.base.repo import Repository
 from . import domain
 from ..base.repo.repository import OrderBy
 
 
+class DealRepository(Repository[domain.Deal], ABC):
+    @abstractmethod
+    async def apply_changes(self, changes: list[domain.Deal]):
+        """Adds every change to the deal of its account and ticker, the deal is created when missing"""
+        raise NotImplemented
+
+    @abstractmethod
+    async def rebuild(self):
+        """Replaces every deal with the sums of the stored transactions"""
+        raise NotImplemented
+
+
 class CreateDeal:
     def __init__(self, deal: domain.Deal, repo: Repository[domain.Deal]):
         self._deal = deal
@@ -37,8 +51,25 @@ class UpdateDeal:
         raise NotImplemented
 
 
+class ApplyDealChanges:
+    def __init__(self, changes: list[domain.Deal], repo: DealRepository):
+        self._changes = changes
+        self._repo = repo
+
+    async def execute(self):
+        await self._repo.apply_changes(self._changes)
+
+
+class RebuildDeals:
+    def __init__(self, repo: DealRepository):
+        self._repo = repo
+
+    async def execute(self):
+        await self._repo.rebuild()
+
+
 class DealCommandFactory:
-    def __init__(self, deal_repo: Repository[domain.Deal]):
+    def __init__(self, deal_repo: DealRepository):
         self._deal_repo = deal_repo
 
     def create_deal(self, deal: domain.Deal) -> CreateDeal:
@@ -49,3 +80,9 @@ class DealCommandFactory:
 
     def update_deal(self, deal: domain.Deal) -> UpdateDeal:
         return UpdateDeal(deal, self._deal_repo)
+
+    def apply_deal_changes(self, changes: list[domain.Deal]) -> ApplyDealChanges:
+        return ApplyDealChanges(changes, self._deal_repo)
+
+    def rebuild_deals(self) -> RebuildDeals:
+        return RebuildDeals(self._deal_repo)
@@ -13,5 +13,5 @@ class Bootstrap:
         return self._queue
 
     def get_deal_command_factory(self) -> commands.DealCommandFactory:
-        deal_repo = PostgresRepo(self._session, postgres.DealModel)
+        deal_repo = postgres.DealRepo(self._session)
         return commands.DealCommandFactory(deal_repo)
@@ -1,13 +1,15 @@
 from uuid import UUID, uuid4
 
-from sqlalchemy import String, TIMESTAMP, Integer, Float, JSON, ForeignKey, select, Table, Column
+from sqlalchemy import String, TIMESTAMP, Integer, Float, JSON, ForeignKey, UniqueConstraint, func, select, Table, \
+    Column, delete, literal, union_all
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, insert
 
 from src.base.repo.postgres import Base, PostgresRepo
 from src.base.repo.repository import OrderBy
-from src.deal import domain
+from src.deal import domain, commands
+from src.market.infrastructure.postgres import TransactionModel
 
 
 class DealModel(Base):
@@ -17,6 +19,9 @@ class DealModel(Base):
     status: Mapped[str] = mapped_column(String(16), nullable=False)
     weighted_price: Mapped[float] = mapped_column(Float, nullable=False)
     total_quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    __table_args__ = (
+        UniqueConstraint('account', 'ticker', name='uq_deal_table_account_ticker'),
+    )
 
     @staticmethod
     def key_converter(key: str):
@@ -35,8 +40,8 @@ class DealModel(Base):
         )
 
     @classmethod
-    def from_entity(cls, entity: domain.Deal):
-        return cls(
+    def to_values(cls, entity: domain.Deal) -> dict:
+        return dict(
             id=entity.uuid,
             account=entity.account,
             ticker=entity.ticker,
@@ -44,3 +49,39 @@ class DealModel(Base):
             weighted_price=entity.weighted_price,
             total_quantity=entity.total_quantity,
         )
+
+
+class DealRepo(PostgresRepo, commands.DealRepository):
+    def __init__(self, session: AsyncSession):
+        super().__init__(session, DealModel)
+
+    async def apply_changes(self, changes: list[domain.Deal]):
+        if not changes:
+            return
+        stmt = insert(DealModel).values([DealModel.to_values(x) for x in changes])
+        stmt = stmt.on_conflict_do_update(
+            constraint='uq_deal_table_account_ticker',
+            set_=dict(
+                weighted_price=DealModel.weighted_price + stmt.excluded.weighted_price,
+                total_quantity=DealModel.total_quantity + stmt.excluded.total_quantity,
+                updated_at=func.now(),
+            ),
+        )
+        await self._session.execute(stmt)
+
+    async def rebuild(self):
+        # Both sides of every fill, a self-trade included, as the deals are added up when transactions are created
+        trs = TransactionModel.__table__
+        fills = union_all(
+            select(trs.c.buyer.label('account'), trs.c.ticker, trs.c.price, trs.c.quantity),
+            select(trs.c.seller.label('account'), trs.c.ticker, trs.c.price, (-trs.c.quantity).label('quantity')),
+        ).subquery()
+        source = (
+            select(func.gen_random_uuid(), func.now(), fills.c.account, fills.c.ticker, literal('PROCESSING'),
+                   func.sum(fills.c.quantity * fills.c.price), func.sum(fills.c.quantity))
+            .group_by(fills.c.account, fills.c.ticker)
+        )
+        table = DealModel.__table__
+        await self._session.execute(delete(table))
+        await self._session.execute(table.insert().from_select(
+            ['id', 'updated_at', 'account', 'ticker', 'status', 'weighted_price', 'total_quantity'], source))
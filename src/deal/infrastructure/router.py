@@ -3,6 +3,7 @@ from uuid import UUID
 from fastapi import APIRouter, Depends
 
 from src import db
+from src.auth import User, current_active_user, current_superuser
 from src.base.repo.repository import OrderBy
 from src.deal.infrastructure import bootstrap, schema
 
@@ -17,9 +18,11 @@ async def get_account_deals(
         account_uuid: UUID,
         order_by: str = None,
         asc: bool = True,
+        user: User = Depends(current_active_user),
         get_as=Depends(db.get_as),
 ):
-    filter_by = {'account': account_uuid}
+    # The deals of the caller, whatever account the path names
+    filter_by = {'account': user.id}
     order_by = OrderBy(order_by, asc) if order_by else None
 
     async with get_as as session:
@@ -27,3 +30,13 @@ async def get_account_deals(
         cmd = boot.get_deal_command_factory().get_many_deals(filter_by, order_by)
         deals = await cmd.execute()
         return [schema.DealSchema.from_entity(x) for x in deals]
+
+
+@router_deal.post("/rebuild")
+async def rebuild_deals(
+        _user: User = Depends(current_superuser),
+        get_as=Depends(db.get_as),
+):
+    async with get_as as session:
+        await bootstrap.Bootstrap(session).get_deal_command_factory().rebuild_deals().execute()
+        await session.commit()
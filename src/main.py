@@ -1,13 +1,37 @@
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
-from src.market.infrastructure.router import router_market, router_order, router_transaction, router_position
+from src import db
+from src.market.infrastructure.bootstrap import Bootstrap as MarketBootstrap, matching_engine
+from src.market.infrastructure.router import router_market, router_order, router_transaction, router_position, \
+    market_feed, broker, fanout, projector, matching_lock
 from src.account.infrastructure.router import router_account
 from src.commodity.infrastructure.router import router_commodity
+from src.deal.infrastructure.router import router_deal
 from src.auth.router import router_auth
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    if await matching_lock.acquire():
+        # Books are built where orders are matched, other processes read them from the database or the broker
+        async with db.get_as() as session:
+            await MarketBootstrap(session).get_command_factory().warm_up_markets().execute()
+    await broker.start()
+    yield
+    # Jobs still running put their events, the dispatchers are stopped once nothing is left to put
+    await matching_engine.stop()
+    await fanout.stop()
+    await projector.stop()
+    await market_feed.stop()
+    await broker.stop()
+    await matching_lock.release()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5173/",
@@ -26,6 +50,7 @@ app.include_router(router_market)
 app.include_router(router_position)
 app.include_router(router_account)
 app.include_router(router_commodity)
+app.include_router(router_deal)
 app.include_router(router_order)
 app.include_router(router_transaction)
 app.include_router(router_auth)
@@ -1,17 +1,49 @@
+import math
 from collections import deque
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Literal
+from decimal import Decimal
+from typing import Iterator, Literal, NamedTuple
 from uuid import UUID
 from sortedcontainers import SortedDict
-from pydantic import ConfigDict, PrivateAttr, BaseModel, Field
+from pydantic import ConfigDict, Field
 
 from src.base import eventbus
 from src.base.model import Entity
-from src.core import Ticker
+from src.core import BookType, Ticker
 
 OrderType = Literal['MARKET', 'LIMIT']
 OrderDirection = Literal['BUY', 'SELL']
 OrderStatus = Literal['PENDING', 'PARTIAL', 'COMPLETED', 'CANCELED']
+OPEN_STATUSES = ['PENDING', 'PARTIAL']
+Tick = int
+
+DEFAULT_TICK_SIZE = 0.01
+BOOK_ORDER_FIELDS = ('uuid', 'account', 'ticker', 'dtype', 'direction', 'price', 'quantity', 'created', 'status')
+TRANSACTION_FIELDS = ('uuid', 'ticker', 'date', 'price', 'quantity', 'buyer', 'seller')
+ORDER_KEYSET = ('created', 'uuid')
+TRANSACTION_KEYSET = ('date', 'uuid')
+
+
+class OrderRejected(ValueError):
+    """The request is refused before the book is changed"""
+
+
+class OrderNotFound(OrderRejected, LookupError):
+    pass
+
+
+class NotOrderOwner(OrderRejected):
+    pass
+
+
+class InsufficientCash(OrderRejected):
+    pass
+
+
+class UnknownTicker(OrderRejected, LookupError):
+    pass
 
 
 class Order(Entity):
@@ -43,6 +75,67 @@ class Transaction(Entity):
         return self.price * self.quantity
 
 
+@dataclass(slots=True)
+class BookOrder:
+    uuid: UUID
+    account: UUID
+    ticker: Ticker
+    dtype: OrderType
+    direction: OrderDirection
+    price: float
+    tick: Tick
+    quantity: int
+    created: datetime
+    status: OrderStatus
+
+    @classmethod
+    def from_entity(cls, order: Order, price: float, tick: Tick) -> 'BookOrder':
+        return cls(order.uuid, order.account, order.ticker, order.dtype, order.direction, price, tick, order.quantity,
+                   order.created, order.status)
+
+    def to_entity(self) -> Order:
+        return Order(
+            uuid=self.uuid,
+            account=self.account,
+            ticker=self.ticker,
+            dtype=self.dtype,
+            direction=self.direction,
+            price=self.price,
+            quantity=self.quantity,
+            created=self.created,
+            status=self.status,
+        )
+
+
+@dataclass(slots=True)
+class Fill:
+    ticker: Ticker
+    date: datetime
+    price: float
+    quantity: int
+    buyer: UUID
+    seller: UUID
+
+    def to_entity(self) -> Transaction:
+        return Transaction(
+            ticker=self.ticker,
+            date=self.date,
+            price=self.price,
+            quantity=self.quantity,
+            buyer=self.buyer,
+            seller=self.seller,
+        )
+
+
+EVENT_TYPES = {
+    'OrderCreated': eventbus.Created,
+    'OrderUpdated': eventbus.Updated,
+    'OrderCompleted': eventbus.Deleted,
+    'OrderCanceled': eventbus.Deleted,
+    'TransactionCreated': eventbus.Created,
+}
+
+
 class Position:
     def __init__(
             self,
@@ -57,7 +150,7 @@ class Position:
         self._total_quantity = total_quantity
 
     def append_transaction(self, trs: Transaction):
-        if trs.buyer != self.account_uuid or trs.seller != self.account_uuid:
+        if trs.buyer != self.account_uuid and trs.seller != self.account_uuid:
             raise ValueError
         if trs.ticker != self.ticker:
             raise ValueError
@@ -68,10 +161,28 @@ class Position:
         self._weighted_price = self._weighted_price + quantity * trs.price
         self._total_quantity += quantity
 
+    @property
+    def weighted_price(self) -> float:
+        return self._weighted_price
+
     @property
     def total_quantity(self) -> int:
         return self._total_quantity
 
+    @classmethod
+    def collect_changes(cls, transactions: list[Transaction]) -> list['Position']:
+        """Position change of every account and ticker touched by the transactions"""
+        positions: dict[tuple[UUID, Ticker], Position] = {}
+        for trs in transactions:
+            if trs.buyer == trs.seller:
+                continue
+            for account in (trs.buyer, trs.seller):
+                position = positions.get((account, trs.ticker))
+                if position is None:
+                    position = positions[(account, trs.ticker)] = cls(account, trs.ticker)
+                position.append_transaction(trs)
+        return list(positions.values())
+
     @property
     def avg_price(self) -> float:
         if self._total_quantity == 0:
@@ -79,54 +190,377 @@ class Position:
         return self._weighted_price / self._total_quantity
 
 
-class Market(BaseModel):
-    ticker: Ticker
-    _buyers: SortedDict[float, deque[Order]] = PrivateAttr(default_factory=SortedDict)
-    _sellers: SortedDict[float, deque[Order]] = PrivateAttr(default_factory=SortedDict)
-    _transactions: list[Transaction] = PrivateAttr(default_factory=list)
-    _orders: list[Order] = PrivateAttr(default_factory=list)
-    _events: eventbus.EventStore = PrivateAttr(default_factory=eventbus.EventStore)
-
-    def __init__(self, orders: list[Order], transactions: list[Transaction] = None, **data):
-        super().__init__(**data)
-        for order in orders:
-            self.__push_order_in_deque(order, constructor=True)
-        if len(self._buyers) and len(self._sellers):
-            if self._buyers.peekitem(-1)[0] >= self._sellers.peekitem(0)[0]:
-                raise Exception(f'buyers max price({self._buyers.peekitem(-1)[0]}) '
-                                f'>= sellers min  price ({self._sellers.peekitem(0)[0]})')
-        if transactions is not None:
-            self._transactions = transactions
+@dataclass(slots=True)
+class LedgerEntry:
+    """Cash of one account, the part of it held by its open orders and the number of updates not yet committed"""
+    cash: float
+    holds: dict[UUID, float] = field(default_factory=dict)
+    held: float = 0
+    pending: int = 0
+
+    @property
+    def available(self) -> float:
+        return self.cash - self.held
+
+    def hold(self, order: UUID, amount: float):
+        self.held += amount - self.holds.get(order, 0)
+        if amount:
+            self.holds[order] = amount
+        else:
+            self.holds.pop(order, None)
+        if not self.holds:
+            # Drop the rounding drift of the running sum whenever nothing is held
+            self.held = 0
+
+
+@dataclass(slots=True)
+class Level:
+    tick: Tick
+    quantity: int = 0
+    orders: deque[BookOrder] = field(default_factory=deque)
+
+
+class BookSide(ABC):
+    def __init__(self, direction: OrderDirection):
+        self.direction = direction
+
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplemented
+
+    @abstractmethod
+    def best(self) -> Level | None:
+        raise NotImplemented
+
+    @abstractmethod
+    def get(self, tick: Tick) -> Level | None:
+        raise NotImplemented
+
+    @abstractmethod
+    def get_or_create(self, tick: Tick) -> Level:
+        raise NotImplemented
+
+    @abstractmethod
+    def remove(self, tick: Tick):
+        raise NotImplemented
+
+    @abstractmethod
+    def items(self) -> Iterator[tuple[Tick, int]]:
+        """Aggregated quantity of every level in ascending tick order"""
+        raise NotImplemented
+
+    @abstractmethod
+    def top(self, n: int) -> list[tuple[Tick, int]]:
+        """Aggregated quantity of the n best levels, best first"""
+        raise NotImplemented
+
+    def fits(self, tick: Tick) -> bool:
+        """Whether a level at the tick can be added"""
+        return True
+
+    def can_hold(self, low: Tick, high: Tick) -> bool:
+        """Whether levels from low to high can be held at once"""
+        return True
+
+
+class SortedBookSide(BookSide):
+    def __init__(self, direction: OrderDirection):
+        super().__init__(direction)
+        self._levels: SortedDict[Tick, Level] = SortedDict()
+        self._best = -1 if direction == 'BUY' else 0
+
+    def __len__(self) -> int:
+        return len(self._levels)
+
+    def best(self) -> Level | None:
+        return self._levels.peekitem(self._best)[1] if self._levels else None
+
+    def get(self, tick: Tick) -> Level | None:
+        return self._levels.get(tick)
+
+    def get_or_create(self, tick: Tick) -> Level:
+        level = self._levels.get(tick)
+        if level is None:
+            level = self._levels[tick] = Level(tick)
+        return level
+
+    def remove(self, tick: Tick):
+        del self._levels[tick]
+
+    def items(self) -> Iterator[tuple[Tick, int]]:
+        return ((tick, level.quantity) for tick, level in self._levels.items())
+
+    def top(self, n: int) -> list[tuple[Tick, int]]:
+        levels = self._levels
+        if self.direction == 'BUY':
+            ticks = levels.islice(start=max(0, len(levels) - n), reverse=True)
+        else:
+            ticks = levels.islice(stop=n)
+        return [(tick, levels[tick].quantity) for tick in ticks]
+
+
+class LadderBookSide(BookSide):
+    """
+    Dense price ladder: levels live in a list indexed by tick offset, so finding a level is an index operation
+    and the best level is tracked by a pointer. Suited to liquid tickers quoted in a narrow band of ticks,
+    the list covers the whole span between the lowest and the highest level ever seen since the side was empty.
+    """
+
+    def __init__(self, direction: OrderDirection, max_span: int = 100_000):
+        super().__init__(direction)
+        self.max_span = max_span
+        self._base: Tick = 0
+        self._slots: list[Level | None] = []
+        self._best: Tick | None = None
+        self._count = 0
+        # Moving away from the best price goes down the ladder for buyers and up for sellers
+        self._step = -1 if direction == 'BUY' else 1
+
+    def __len__(self) -> int:
+        return self._count
+
+    def best(self) -> Level | None:
+        return None if self._best is None else self._slots[self._best - self._base]
+
+    def get(self, tick: Tick) -> Level | None:
+        index = tick - self._base
+        if 0 <= index < len(self._slots):
+            return self._slots[index]
+        return None
+
+    def get_or_create(self, tick: Tick) -> Level:
+        level = self.get(tick)
+        if level is None:
+            self.__reserve(tick)
+            level = self._slots[tick - self._base] = Level(tick)
+            self._count += 1
+            if self._best is None or (tick - self._best) * self._step < 0:
+                self._best = tick
+        return level
+
+    def remove(self, tick: Tick):
+        self._slots[tick - self._base] = None
+        self._count -= 1
+        if self._count == 0:
+            # An empty side is re-centred around the next order
+            self._slots = []
+            self._best = None
+        elif tick == self._best:
+            index = tick - self._base
+            while self._slots[index] is None:
+                index += self._step
+            self._best = index + self._base
+
+    def items(self) -> Iterator[tuple[Tick, int]]:
+        return ((level.tick, level.quantity) for level in self._slots if level is not None)
+
+    def top(self, n: int) -> list[tuple[Tick, int]]:
+        result = []
+        if self._best is None or n <= 0:
+            return result
+        slots = self._slots
+        stop = len(slots) if self._step > 0 else -1
+        for index in range(self._best - self._base, stop, self._step):
+            level = slots[index]
+            if level is not None:
+                result.append((level.tick, level.quantity))
+                if len(result) == n:
+                    break
+        return result
+
+    def fits(self, tick: Tick) -> bool:
+        if not self._count:
+            return True
+        if self.can_hold(min(tick, self._base), max(tick, self._base + len(self._slots) - 1)):
+            return True
+        # The ladder has drifted: trim it to the live levels before deciding the price is out of reach
+        slots = self._slots
+        first = next(i for i, level in enumerate(slots) if level is not None)
+        last = next(i for i in range(len(slots) - 1, first - 1, -1) if slots[i] is not None)
+        if not self.can_hold(min(tick, self._base + first), max(tick, self._base + last)):
+            return False
+        self._slots = slots[first:last + 1]
+        self._base += first
+        return True
+
+    def can_hold(self, low: Tick, high: Tick) -> bool:
+        return high - low < self.max_span
+
+    def __reserve(self, tick: Tick):
+        if not self._slots:
+            self._base = tick
+            self._slots = [None]
+            return
+        # The list grows at least by its own length, so a drifting price is amortized O(1) per tick
+        index = tick - self._base
+        if index < 0:
+            extra = max(-index, len(self._slots))
+            self._slots[:0] = [None] * extra
+            self._base -= extra
+        elif index >= len(self._slots):
+            self._slots.extend([None] * max(index - len(self._slots) + 1, len(self._slots)))
+
+
+BOOK_SIDES: dict[BookType, type[BookSide]] = {
+    'SORTED': SortedBookSide,
+    'LADDER': LadderBookSide,
+}
+
+
+class BookSpec(NamedTuple):
+    tick_size: float = DEFAULT_TICK_SIZE
+    book: BookType = 'SORTED'
+
+
+class Market:
+    # A plain class: attribute access on pydantic private attributes is too slow for the matching loop
+    def __init__(self, ticker: Ticker, orders: list[Order], transactions: list[Transaction] = None,
+                 tick_size: float = DEFAULT_TICK_SIZE, book: BookType = 'SORTED'):
+        if tick_size <= 0:
+            raise ValueError(f'tick size must be positive ({tick_size})')
+        self.ticker = ticker
+        self.tick_size = tick_size
+        self._precision = max(0, -Decimal(str(tick_size)).as_tuple().exponent)
+        self.book = book
+        self._buyers: BookSide = BOOK_SIDES[book]('BUY')
+        self._sellers: BookSide = BOOK_SIDES[book]('SELL')
+        self._index: dict[UUID, BookOrder] = {}
+        self._changes: list[tuple[str, BookOrder | Fill]] = []
+        self._transactions: list[Transaction] = transactions if transactions is not None else []
+        self._orders: list[Order] = []
+        self._events = eventbus.EventStore()
+        # Ticks whose aggregated quantity changed since the last parse_level_changes
+        self._dirty: dict[OrderDirection, set[Tick]] = {'BUY': set(), 'SELL': set()}
+
+        # Resting orders are entities or plain rows of BOOK_ORDER_FIELDS, an off-grid price is only rejected
+        # for new orders: a resting one is moved to the next tick in its favor, a buyer never pays more than
+        # its limit and a seller never gets less
+        ticks = [self.__resting_tick(order) for order in orders]
+        if not self.__can_hold(orders, ticks):
+            # Resting orders too far apart for the ladder, the book falls back to sorted sides
+            self.book = 'SORTED'
+            self._buyers, self._sellers = SortedBookSide('BUY'), SortedBookSide('SELL')
+        for order, tick in zip(orders, ticks):
+            self.__push_order_in_deque(BookOrder.from_entity(order, self.to_price(tick), tick), constructor=True)
+        # Stored orders that cross each other are kept as they are, the next incoming orders match against them
+        self.crossed = bool(len(self._buyers) and len(self._sellers)
+                            and self._buyers.best().tick >= self._sellers.best().tick)
 
     @property
     def events(self):
+        self.__flush_changes()
         return self._events
 
     @property
     def orders(self) -> list[Order]:
+        self.__flush_changes()
         return self._orders
 
     @property
     def transactions(self):
+        self.__flush_changes()
         return self._transactions
 
+    def parse_orders(self) -> list[Order]:
+        self.__flush_changes()
+        orders = self._orders
+        self._orders = []
+        return orders
+
+    def parse_transactions(self) -> list[Transaction]:
+        self.__flush_changes()
+        transactions = self._transactions
+        self._transactions = []
+        return transactions
+
+    def parse_level_changes(self) -> tuple[list[tuple[float, int]], list[tuple[float, int]]]:
+        """Absolute quantity of every buy and sell level touched since the last call, 0 for a removed level"""
+        changes = []
+        for side in (self._buyers, self._sellers):
+            dirty = self._dirty[side.direction]
+            levels = []
+            for tick in sorted(dirty):
+                level = side.get(tick)
+                levels.append((self.to_price(tick), level.quantity if level is not None else 0))
+            dirty.clear()
+            changes.append(levels)
+        return changes[0], changes[1]
+
     @property
     def buy_level(self) -> SortedDict[float, int]:
-        result = SortedDict()
-        for key, value in self._buyers.items():
-            result[key] = 0
-            for order in value:
-                result[key] += order.quantity
-        return result
+        return SortedDict((self.to_price(tick), quantity) for tick, quantity in self._buyers.items())
 
     @property
     def sell_level(self) -> SortedDict[float, int]:
-        result = SortedDict()
-        for key, value in self._sellers.items():
-            result[key] = 0
-            for order in value:
-                result[key] += order.quantity
-        return result
+        return SortedDict((self.to_price(tick), quantity) for tick, quantity in self._sellers.items())
+
+    def top_buy_levels(self, n: int) -> list[tuple[float, int]]:
+        return [(self.to_price(tick), quantity) for tick, quantity in self._buyers.top(n)]
+
+    def top_sell_levels(self, n: int) -> list[tuple[float, int]]:
+        return [(self.to_price(tick), quantity) for tick, quantity in self._sellers.top(n)]
+
+    def to_tick(self, price: float) -> Tick:
+        tick = round(price / self.tick_size)
+        if abs(tick * self.tick_size - price) > self.tick_size * 1e-6:
+            raise OrderRejected(f'price {price} is not a multiple of the tick size {self.tick_size}')
+        return tick
+
+    def __resting_tick(self, order) -> Tick:
+        ticks = order.price / self.tick_size
+        tick = round(ticks)
+        if abs(tick - ticks) <= 1e-6:
+            return tick
+        return math.floor(ticks) if order.direction == 'BUY' else math.ceil(ticks)
+
+    def to_price(self, tick: Tick) -> float:
+        return round(tick * self.tick_size, self._precision)
+
+    def get_order(self, uuid: UUID) -> BookOrder:
+        order = self._index.get(uuid)
+        if order is None:
+            raise OrderNotFound(f'order {uuid} is not in the {self.ticker} book')
+        return order
+
+    def cancel_order(self, uuid: UUID):
+        order = self.get_order(uuid)
+        del self._index[uuid]
+        order.status = 'CANCELED'
+        side = self._buyers if order.direction == 'BUY' else self._sellers
+        level = side.get(order.tick)
+        level.quantity -= order.quantity
+        self._dirty[order.direction].add(order.tick)
+        if level.quantity == 0:
+            side.remove(order.tick)
+        else:
+            # Canceled orders stay in the level deque and are skipped by matching, drop the ones at the front now
+            orders = level.orders
+            while orders[0].status == 'CANCELED':
+                orders.popleft()
+
+        self._changes.append(('OrderCanceled', order))
+
+    def amend_order(self, uuid: UUID, quantity: int):
+        order = self.get_order(uuid)
+        if quantity <= 0 or quantity >= order.quantity:
+            raise OrderRejected(f'quantity can only be decreased ({order.quantity} -> {quantity})')
+        side = self._buyers if order.direction == 'BUY' else self._sellers
+        side.get(order.tick).quantity -= order.quantity - quantity
+        self._dirty[order.direction].add(order.tick)
+        order.quantity = quantity
+        self._changes.append(('OrderUpdated', order))
+
+    def check_order(self, order: Order) -> Tick:
+        """Tick of the order price, raises OrderRejected if the book as it stands can not accept the order"""
+        if order.dtype != 'LIMIT':
+            raise OrderRejected(f'{order.dtype} orders are not supported')
+        if order.ticker != self.ticker:
+            raise OrderRejected(f'order of {order.ticker} sent to the {self.ticker} book')
+        if order.quantity <= 0:
+            raise OrderRejected(f'quantity must be positive ({order.quantity})')
+        tick = self.to_tick(order.price)
+        self.__check_rest(order, tick)
+        return tick
 
     def send_order(self, order: Order):
         if order.direction == 'BUY':
@@ -137,105 +571,118 @@ class Market(BaseModel):
             if order.dtype == 'LIMIT':
                 self.send_sell_limit_order(order)
                 return
-        raise ValueError(f'{order}')
+        raise OrderRejected(f'{order.dtype} {order.direction} orders are not supported')
 
     def send_buy_limit_order(self, order: Order):
-        order = order.model_copy()
-        if order.dtype != 'LIMIT':
-            raise ValueError
         if order.direction != 'BUY':
-            raise ValueError
-        if order.ticker != self.ticker:
-            raise ValueError
-        if order.quantity <= 0:
-            raise ValueError
-
+            raise OrderRejected(f'{order.direction} order sent as a buy order')
+        tick = self.check_order(order)
+        order = BookOrder.from_entity(order, self.to_price(tick), tick)
+        now = datetime.now()
+        sellers = self._sellers
         while order.quantity:
             # If the lower seller price is higher than buyer limit then push order in deque
-            if len(self._sellers) == 0 or self._sellers.peekitem(0)[0] > order.price:
+            best = sellers.best()
+            if best is None or best.tick > tick:
                 self.__push_order_in_deque(order)
                 break
             else:
-                best_sellers: deque[Order] = self._sellers.peekitem(0)[1]
-                for seller in best_sellers:
-                    self.__match_orders_and_create_transaction(order, seller)
-                    if not order.quantity:
-                        break
-                self.__update_best_sellers()
+                self.__sweep_level(order, sellers, best, now)
 
     def send_sell_limit_order(self, order: Order):
-        order = order.model_copy()
-        if order.dtype != 'LIMIT':
-            raise ValueError
         if order.direction != 'SELL':
-            raise ValueError
-        if order.ticker != self.ticker:
-            raise ValueError
-        if order.quantity <= 0:
-            raise ValueError
-
+            raise OrderRejected(f'{order.direction} order sent as a sell order')
+        tick = self.check_order(order)
+        order = BookOrder.from_entity(order, self.to_price(tick), tick)
+        now = datetime.now()
+        buyers = self._buyers
         while order.quantity:
             # If the better buyer price is lower than seller limit then push order in deque
-            if len(self._buyers) == 0 or self._buyers.peekitem(-1)[0] < order.price:
+            best = buyers.best()
+            if best is None or best.tick < tick:
                 self.__push_order_in_deque(order)
                 break
             else:
-                best_buyers: deque[Order] = self._buyers.peekitem(-1)[1]
-                for buyer in best_buyers:
-                    self.__match_orders_and_create_transaction(order, buyer)
-                    if not order.quantity:
-                        break
-                self.__update_best_buyers()
-
-    def __push_order_in_deque(self, order: Order, constructor=False):
-        queue = self._buyers if order.direction == 'BUY' else self._sellers
-        if queue.get(order.price) is None:
-            queue[order.price] = deque()
-        queue[order.price].append(order)
-        if not constructor:
-            self._orders.append(order)
-            self.events.push_event(event=eventbus.Created(key='OrderCreated', entity=order))
-
-    def __update_best_sellers(self):
-        best_sellers = deque(x for x in self._sellers.peekitem(0)[1] if x.quantity > 0)
-        if len(best_sellers) > 0:
-            self._sellers[self._sellers.keys()[0]] = best_sellers
-        else:
-            self._sellers.popitem(0)
-
-    def __update_best_buyers(self):
-        best_buyers = deque(x for x in self._buyers.peekitem(-1)[1] if x.quantity > 0)
-        if len(best_buyers) > 0:
-            self._buyers[self._buyers.keys()[-1]] = best_buyers
-        else:
-            self._buyers.popitem()
+                self.__sweep_level(order, buyers, best, now)
+
+    def __can_hold(self, orders: list, ticks: list[Tick]) -> bool:
+        for side in (self._buyers, self._sellers):
+            side_ticks = [tick for order, tick in zip(orders, ticks) if order.direction == side.direction]
+            if side_ticks and not side.can_hold(min(side_ticks), max(side_ticks)):
+                return False
+        return True
+
+    def __check_rest(self, order: Order, tick: Tick):
+        # Only a remainder that rests needs room on its side, an order filled on arrival never gets there
+        side, opposite = (self._buyers, self._sellers) if order.direction == 'BUY' else (self._sellers, self._buyers)
+        if side.fits(tick):
+            return
+        step = 1 if order.direction == 'BUY' else -1
+        fillable = sum(quantity for level, quantity in opposite.items() if (tick - level) * step >= 0)
+        if fillable < order.quantity:
+            raise OrderRejected(f'price {order.price} is too far from the {order.direction} side of the book')
 
-    def __match_orders_and_create_transaction(self, order: Order, cparty: Order):
+    def __flush_changes(self):
+        if not self._changes:
+            return
+        # Every compact object is converted once, so an order touched several times shares one entity
+        entities = {}
+        for key, item in self._changes:
+            entity = entities.get(id(item))
+            if entity is None:
+                entity = entities[id(item)] = item.to_entity()
+                if isinstance(item, Fill):
+                    self._transactions.append(entity)
+                else:
+                    self._orders.append(entity)
+            self._events.push_event(EVENT_TYPES[key](key=key, entity=entity))
+        self._changes = []
+
+    def __push_order_in_deque(self, order: BookOrder, constructor=False):
+        side = self._buyers if order.direction == 'BUY' else self._sellers
+        level = side.get_or_create(order.tick)
+        level.orders.append(order)
+        level.quantity += order.quantity
+        self._index[order.uuid] = order
+        if not constructor:
+            self._dirty[order.direction].add(order.tick)
+            self._changes.append(('OrderCreated', order))
+
+    def __sweep_level(self, order: BookOrder, side: BookSide, level: Level, now: datetime):
+        makers = level.orders
+        self._dirty[side.direction].add(level.tick)
+        while order.quantity and makers:
+            maker = makers[0]
+            if maker.status != 'CANCELED':
+                level.quantity -= self.__match_orders_and_create_transaction(order, maker, now)
+                if maker.quantity:
+                    break
+            makers.popleft()
+        # The level disappears with its last live order, trailing tombstones go with the deque
+        if level.quantity == 0:
+            side.remove(level.tick)
+        if not order.quantity:
+            # Filled on arrival, the order never rests but its final state is reported like a maker's
+            self._changes.append(('OrderCompleted', order))
+
+    def __match_orders_and_create_transaction(self, order: BookOrder, cparty: BookOrder, now: datetime) -> int:
         if order.quantity < cparty.quantity:
             quantity = order.quantity
             order.quantity = 0
             cparty.quantity -= quantity
             cparty.status = 'PARTIAL'
             order.status = 'COMPLETED'
-            self.events.push_event(eventbus.Updated(key='OrderUpdated', entity=cparty))
+            self._changes.append(('OrderUpdated', cparty))
         else:
             quantity = cparty.quantity
             cparty.quantity = 0
             order.quantity -= quantity
-            order.status = 'PARTIAL'
+            order.status = 'PARTIAL' if order.quantity else 'COMPLETED'
             cparty.status = 'COMPLETED'
-            self.events.push_event(eventbus.Deleted(key='OrderCompleted', entity=cparty))
+            del self._index[cparty.uuid]
+            self._changes.append(('OrderCompleted', cparty))
 
-        self._orders.append(cparty)
         buy, sell = (order.account, cparty.account) if order.direction == 'BUY' else (cparty.account, order.account)
-
-        transaction = Transaction(
-            date=datetime.now(),
-            buyer=buy,
-            seller=sell,
-            price=cparty.price,
-            quantity=quantity,
-            ticker=order.ticker,
-        )
-        self._transactions.append(transaction)
-        self._events.push_event(eventbus.Created(key='TransactionCreated', entity=transaction))
+        fill = Fill(ticker=order.ticker, date=now, price=cparty.price, quantity=quantity, buyer=buy, seller=sell)
+        self._changes.append(('TransactionCreated', fill))
+        return quantity
@@ -0,0 +1,115 @@
+import asyncio
+from collections import deque
+from time import perf_counter
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+from loguru import logger
+
+from src.core import Ticker
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class EngineStats(NamedTuple):
+    ticker: Ticker
+    queue_depth: int
+    processed: int
+    last_latency: float
+    avg_latency: float
+    max_latency: float
+
+
+class TickerWorker:
+    def __init__(self, ticker: Ticker, window: int = 1_000):
+        self.ticker = ticker
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._processed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def stats(self) -> EngineStats:
+        latencies = self._latencies
+        return EngineStats(
+            ticker=self.ticker,
+            queue_depth=self.queue_depth,
+            processed=self._processed,
+            last_latency=latencies[-1] if latencies else 0,
+            avg_latency=sum(latencies) / len(latencies) if latencies else 0,
+            max_latency=max(latencies) if latencies else 0,
+        )
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name=f'engine-{self.ticker}')
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # The running job is let finish, it may have committed already and still have events to hand on
+        while not self._queue.empty():
+            _job, future, _enqueued = self._queue.get_nowait()
+            future.cancel()
+        self._queue.put_nowait(None)
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def submit(self, job: Job) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((job, future, perf_counter()))
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            job, future, enqueued = item
+            if future.cancelled():
+                continue
+            try:
+                result = await job()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as err:
+                logger.error(f'{self.ticker}: {err}')
+                if not future.done():
+                    future.set_exception(err)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._processed += 1
+                self._latencies.append(perf_counter() - enqueued)
+
+
+class MatchingEngine:
+    def __init__(self):
+        self._workers: dict[Ticker, TickerWorker] = {}
+
+    def _get_or_create_worker(self, ticker: Ticker) -> TickerWorker:
+        worker = self._workers.get(ticker)
+        if worker is None:
+            worker = TickerWorker(ticker)
+            worker.start()
+            self._workers[ticker] = worker
+        return worker
+
+    async def execute(self, ticker: Ticker, job: Job) -> Any:
+        return await self._get_or_create_worker(ticker).submit(job)
+
+    def queue_depth(self, ticker: Ticker) -> int:
+        worker = self._workers.get(ticker)
+        return worker.queue_depth if worker is not None else 0
+
+    def stats(self) -> list[EngineStats]:
+        return [worker.stats for worker in self._workers.values()]
+
+    async def stop(self):
+        workers = list(self._workers.values())
+        self._workers = {}
+        await asyncio.gather(*[worker.stop() for worker in workers])
@@ -1,4 +1,7 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import AsyncIterator, NamedTuple
 from uuid import UUID
 
 from loguru import logger
@@ -10,39 +13,254 @@ from ..base.repo.repository import OrderBy
 from ..core import Ticker
 
 
+class MarketUpdate(NamedTuple):
+    market: domain.Market
+    orders: list[domain.Order]
+    transactions: list[domain.Transaction]
+
+    def accounts(self) -> set[UUID]:
+        accounts = {x.account for x in self.orders}
+        for trs in self.transactions:
+            accounts.add(trs.buyer)
+            accounts.add(trs.seller)
+        return accounts
+
+
+class PositionRepository(ABC):
+    @abstractmethod
+    async def apply_changes(self, changes: list[domain.Position]):
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_positions(self, account_uuid: UUID) -> list[domain.Position]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def rebuild(self):
+        raise NotImplemented
+
+
 class DealGateway(ABC):
     @abstractmethod
-    async def create_deals_from_transaction(self, trs: domain.Transaction):
+    async def create_deals_from_transactions(self, transactions: list[domain.Transaction]):
         raise NotImplemented
 
 
 class AccountGateway(ABC):
     @abstractmethod
-    async def change_accounts_data(self, trs: domain.Transaction):
+    async def change_accounts_data(self, transactions: list[domain.Transaction]):
         raise NotImplemented
 
     @abstractmethod
-    async def check_account_has_permission_to_send_order(self, order: domain.Order):
+    async def get_accounts_cash(self, accounts: list[UUID]) -> dict[UUID, float]:
         raise NotImplemented
 
 
+class CommodityGateway(ABC):
+    @abstractmethod
+    async def get_book_specs(self, tickers: list[Ticker] = None) -> dict[Ticker, domain.BookSpec]:
+        raise NotImplemented
+
+
+class MarketRegistry:
+    def __init__(self):
+        self._markets: dict[Ticker, domain.Market] = {}
+
+    def __contains__(self, ticker: Ticker) -> bool:
+        return ticker in self._markets
+
+    async def warm_up(self, order_repo: Repository[domain.Order], commodity_gw: CommodityGateway):
+        specs = await commodity_gw.get_book_specs()
+        grouped: dict[Ticker, list] = {ticker: [] for ticker in specs}
+        # The status predicate lets Postgres use the partial index on open orders
+        filter_by = {'status.$__in': domain.OPEN_STATUSES}
+        async for rows in order_repo.stream_rows(domain.BOOK_ORDER_FIELDS, filter_by, OrderBy('created', asc=True)):
+            for row in rows:
+                grouped.setdefault(row.ticker, []).append(row)
+        self._markets = {
+            ticker: self.__create_market(ticker, orders, specs.get(ticker, domain.BookSpec()))
+            for ticker, orders in grouped.items()
+        }
+
+    async def get_market(self, ticker: Ticker, order_repo: Repository[domain.Order],
+                         commodity_gw: CommodityGateway) -> domain.Market:
+        market = self._markets.get(ticker)
+        if market is None:
+            specs = await commodity_gw.get_book_specs([ticker])
+            if ticker not in specs:
+                raise domain.UnknownTicker(f'unknown ticker {ticker}')
+            filter_by = {'ticker': ticker, 'status.$__in': domain.OPEN_STATUSES}
+            orders = await order_repo.get_rows(domain.BOOK_ORDER_FIELDS, filter_by, OrderBy('created', asc=True))
+            market = self.__create_market(ticker, orders, specs.get(ticker, domain.BookSpec()))
+            market = self._markets.setdefault(ticker, market)
+        return market
+
+    async def check_ticker(self, ticker: Ticker, commodity_gw: CommodityGateway):
+        """Raises UnknownTicker before a book or a worker is created for a ticker that is not traded"""
+        if ticker not in self._markets and ticker not in await commodity_gw.get_book_specs([ticker]):
+            raise domain.UnknownTicker(f'unknown ticker {ticker}')
+
+    def evict(self, ticker: Ticker):
+        self._markets.pop(ticker, None)
+
+    @contextmanager
+    def changing(self, ticker: Ticker):
+        """Evicts the book if the block fails, a half-applied change is then rebuilt from the database"""
+        try:
+            yield
+        except BaseException:
+            self.evict(ticker)
+            raise
+
+    @staticmethod
+    def __create_market(ticker: Ticker, orders: list, spec: domain.BookSpec) -> domain.Market:
+        market = domain.Market(ticker=ticker, orders=orders, tick_size=spec.tick_size, book=spec.book)
+        if market.book != spec.book:
+            logger.warning(f'{ticker}: resting orders do not fit a {spec.book} book, using {market.book}')
+        if market.crossed:
+            logger.warning(f'{ticker}: resting orders cross, best buy {market.top_buy_levels(1)} '
+                           f'>= best sell {market.top_sell_levels(1)}')
+        return market
+
+
+class AccountLedger:
+    """
+    Cash and holds of the accounts that trade, so an order is checked without a database read.
+    An entry with no open order and no uncommitted update is idle: only the `max_idle` most recently
+    used idle entries are kept, the others are read again once needed.
+    """
+
+    def __init__(self, max_idle: int = 10_000):
+        self._entries: dict[UUID, domain.LedgerEntry] = {}
+        self._idle: OrderedDict[UUID, None] = OrderedDict()
+        self._max_idle = max_idle
+
+    def __contains__(self, account: UUID) -> bool:
+        return account in self._entries
+
+    def get(self, account: UUID) -> domain.LedgerEntry:
+        return self._entries[account]
+
+    async def load(self, accounts: set[UUID], acc_gw: AccountGateway, order_repo: Repository[domain.Order]):
+        missing = [x for x in accounts if x not in self._entries]
+        if not missing:
+            return
+        cash = await acc_gw.get_accounts_cash(missing)
+        entries = {}
+        for account in missing:
+            if account not in cash:
+                raise LookupError(f'account {account} not found')
+            entries[account] = domain.LedgerEntry(cash[account])
+        filter_by = {'account.$__in': [str(x) for x in missing], 'status.$__in': domain.OPEN_STATUSES}
+        for row in await order_repo.get_rows(('uuid', 'account', 'price', 'quantity'), filter_by):
+            entries[row.account].hold(row.uuid, row.price * row.quantity)
+        for account, entry in entries.items():
+            # Another ticker may have loaded the account meanwhile, its entry can already carry changes
+            self._entries.setdefault(account, entry)
+            self.__touch(account)
+
+    @contextmanager
+    def reserving(self, orders: list[domain.Order]):
+        """
+        Checks the orders and holds their amount right away, with no await in between, so orders of other tickers
+        can not spend the same cash while this one is matched. The holds are dropped if the block fails,
+        otherwise apply replaces them with what the orders hold once matched.
+        """
+        # Orders of one request are checked together, so a batch can not spend the same cash twice
+        amounts: dict[UUID, float] = {}
+        for order in orders:
+            amounts[order.account] = amounts.get(order.account, 0) + order.amount
+        for account, amount in amounts.items():
+            available = self._entries[account].available
+            if amount > available:
+                raise domain.InsufficientCash(f'order.amount > available cash ({amount} > {available})')
+        for order in orders:
+            self._entries[order.account].hold(order.uuid, order.amount)
+            self._idle.pop(order.account, None)
+        try:
+            yield
+        except BaseException:
+            for order in orders:
+                entry = self._entries.get(order.account)
+                if entry is not None:
+                    entry.hold(order.uuid, 0)
+                    self.__touch(order.account)
+            raise
+
+    def apply(self, update: MarketUpdate):
+        # Accounts that are not loaded are skipped, they are read from the database once needed.
+        # The touched entries stay until release, dropping one would lose the update until the commit
+        for account in update.accounts():
+            entry = self._entries.get(account)
+            if entry is not None:
+                entry.pending += 1
+                self._idle.pop(account, None)
+        for trs in update.transactions:
+            for account in (trs.buyer, trs.seller):
+                entry = self._entries.get(account)
+                if entry is not None:
+                    entry.cash -= trs.amount
+        for order in update.orders:
+            entry = self._entries.get(order.account)
+            if entry is not None:
+                entry.hold(order.uuid, order.amount if order.status in domain.OPEN_STATUSES else 0)
+
+    def release(self, accounts: set[UUID]):
+        """The update applied to the accounts is committed"""
+        for account in accounts:
+            entry = self._entries.get(account)
+            if entry is not None:
+                entry.pending = max(0, entry.pending - 1)
+                self.__touch(account)
+
+    def invalidate(self, accounts: set[UUID]):
+        for account in accounts:
+            self._entries.pop(account, None)
+            self._idle.pop(account, None)
+
+    def __touch(self, account: UUID):
+        entry = self._entries[account]
+        if entry.holds or entry.pending:
+            self._idle.pop(account, None)
+            return
+        self._idle[account] = None
+        self._idle.move_to_end(account)
+        while len(self._idle) > self._max_idle:
+            stale, _ = self._idle.popitem(last=False)
+            del self._entries[stale]
+
+
+class WarmUpMarketsCommand:
+    def __init__(self, registry: MarketRegistry, order_repo: Repository[domain.Order],
+                 commodity_gw: CommodityGateway):
+        self._registry = registry
+        self._order_repo = order_repo
+        self._commodity_gw = commodity_gw
+
+    async def execute(self):
+        await self._registry.warm_up(self._order_repo, self._commodity_gw)
+
+
 class GetMarketByTickerCommand:
-    def __init__(
-            self,
-            ticker: Ticker,
-            order_repo: Repository[domain.Order],
-            trs_repo: Repository[domain.Transaction],
-    ):
+    def __init__(self, ticker: Ticker, registry: MarketRegistry, order_repo: Repository[domain.Order],
+                 commodity_gw: CommodityGateway):
         self._ticker = ticker
+        self._registry = registry
         self._order_repo = order_repo
-        self._trs_repo = trs_repo
+        self._commodity_gw = commodity_gw
 
     async def execute(self) -> domain.Market:
-        ticker = self._ticker
-        orders = await self._order_repo.get_many(filter_by={'ticker': ticker})
-        transactions = await self._trs_repo.get_many({'ticker': ticker}, OrderBy('date', asc=True), 0, 100)
-        market = domain.Market(ticker=ticker, orders=orders, transactions=transactions)
-        return market
+        return await self._registry.get_market(self._ticker, self._order_repo, self._commodity_gw)
+
+
+class CheckTickerCommand:
+    def __init__(self, ticker: Ticker, registry: MarketRegistry, commodity_gw: CommodityGateway):
+        self._ticker = ticker
+        self._registry = registry
+        self._commodity_gw = commodity_gw
+
+    async def execute(self):
+        await self._registry.check_ticker(self._ticker, self._commodity_gw)
 
 
 class GetManyOrdersCommand:
@@ -59,46 +277,149 @@ class SendOrderCommand:
     def __init__(
             self,
             order: domain.Order,
+            registry: MarketRegistry,
+            ledger: AccountLedger,
             order_repo: Repository[domain.Order],
-            trs_repo: Repository[domain.Transaction],
-            deal_gw: DealGateway,
+            commodity_gw: CommodityGateway,
             acc_gw: AccountGateway,
             queue: eventbus.Queue,
     ):
         self._order = order
+        self._registry = registry
+        self._ledger = ledger
         self._order_repo = order_repo
-        self._trs_repo = trs_repo
-        self._deal_gw = deal_gw
+        self._commodity_gw = commodity_gw
         self._acc_gw = acc_gw
         self._queue = queue
 
-    async def execute(self) -> domain.Market:
+    async def execute(self) -> MarketUpdate:
         order = self._order
-        orders = await self._order_repo.get_many(filter_by={'ticker': order.ticker})
-        market = domain.Market(ticker=order.ticker, orders=orders)
-        await self._acc_gw.check_account_has_permission_to_send_order(order)
-        market.send_order(order)
-        self._queue.extend(market.events.parse_events())
-        return market
+        market = await self._registry.get_market(order.ticker, self._order_repo, self._commodity_gw)
+        market.check_order(order)
+        await self._ledger.load({order.account}, self._acc_gw, self._order_repo)
+        with self._ledger.reserving([order]):
+            market.send_order(order)
+            with self._registry.changing(order.ticker):
+                self._queue.extend(market.events.parse_events())
+                update = MarketUpdate(market, market.parse_orders(), market.parse_transactions())
+                await settle(update, self._ledger, self._acc_gw, self._order_repo)
+        return update
+
+
+class SendOrdersCommand:
+    def __init__(
+            self,
+            orders: list[domain.Order],
+            registry: MarketRegistry,
+            ledger: AccountLedger,
+            order_repo: Repository[domain.Order],
+            commodity_gw: CommodityGateway,
+            acc_gw: AccountGateway,
+            queue: eventbus.Queue,
+    ):
+        self._orders = orders
+        self._registry = registry
+        self._ledger = ledger
+        self._order_repo = order_repo
+        self._commodity_gw = commodity_gw
+        self._acc_gw = acc_gw
+        self._queue = queue
+
+    async def execute(self) -> MarketUpdate:
+        orders = self._orders
+        if not orders:
+            raise domain.OrderRejected('order batch is empty')
+        tickers = {x.ticker for x in orders}
+        if len(tickers) != 1:
+            raise domain.OrderRejected(f'order batch must contain one ticker, got {sorted(tickers)}')
+        market = await self._registry.get_market(orders[0].ticker, self._order_repo, self._commodity_gw)
+        for order in orders:
+            # Checked against the book before the batch, so a malformed order refuses the batch without changes
+            market.check_order(order)
+        await self._ledger.load({x.account for x in orders}, self._acc_gw, self._order_repo)
+        # An order the earlier ones left no room for evicts the book, the orders before it are already matched
+        with self._ledger.reserving(orders), self._registry.changing(market.ticker):
+            for order in orders:
+                market.send_order(order)
+            self._queue.extend(market.events.parse_events())
+            update = MarketUpdate(market, market.parse_orders(), market.parse_transactions())
+            await settle(update, self._ledger, self._acc_gw, self._order_repo)
+        return update
 
 
 class CancelOrderCommand:
     def __init__(
             self,
             order: domain.Order,
+            registry: MarketRegistry,
+            ledger: AccountLedger,
             order_repo: Repository[domain.Order],
+            commodity_gw: CommodityGateway,
+            acc_gw: AccountGateway,
             queue: eventbus.Queue,
     ):
         self._order = order
+        self._registry = registry
+        self._ledger = ledger
         self._order_repo = order_repo
+        self._commodity_gw = commodity_gw
+        self._acc_gw = acc_gw
         self._queue = queue
 
-    async def execute(self) -> domain.Market:
+    async def execute(self) -> MarketUpdate:
         order = self._order
-        await self._order_repo.remove_many({'uuid': order.uuid})
-        orders = await self._order_repo.get_many(filter_by={'ticker': order.ticker})
-        market = domain.Market(ticker=order.ticker, orders=orders)
-        return market
+        market = await self._registry.get_market(order.ticker, self._order_repo, self._commodity_gw)
+        check_owner(market, order)
+        market.cancel_order(order.uuid)
+        with self._registry.changing(order.ticker):
+            self._queue.extend(market.events.parse_events())
+            update = MarketUpdate(market, market.parse_orders(), market.parse_transactions())
+            await settle(update, self._ledger, self._acc_gw, self._order_repo)
+        return update
+
+
+class AmendOrderCommand:
+    def __init__(
+            self,
+            order: domain.Order,
+            registry: MarketRegistry,
+            ledger: AccountLedger,
+            order_repo: Repository[domain.Order],
+            commodity_gw: CommodityGateway,
+            acc_gw: AccountGateway,
+            queue: eventbus.Queue,
+    ):
+        self._order = order
+        self._registry = registry
+        self._ledger = ledger
+        self._order_repo = order_repo
+        self._commodity_gw = commodity_gw
+        self._acc_gw = acc_gw
+        self._queue = queue
+
+    async def execute(self) -> MarketUpdate:
+        order = self._order
+        market = await self._registry.get_market(order.ticker, self._order_repo, self._commodity_gw)
+        check_owner(market, order)
+        market.amend_order(order.uuid, order.quantity)
+        with self._registry.changing(order.ticker):
+            self._queue.extend(market.events.parse_events())
+            update = MarketUpdate(market, market.parse_orders(), market.parse_transactions())
+            await settle(update, self._ledger, self._acc_gw, self._order_repo)
+        return update
+
+
+def check_owner(market: domain.Market, order: domain.Order):
+    if market.get_order(order.uuid).account != order.account:
+        raise domain.NotOrderOwner(f'order {order.uuid} belongs to another account')
+
+
+async def settle(update: MarketUpdate, ledger: AccountLedger, acc_gw: AccountGateway,
+                 order_repo: Repository[domain.Order]):
+    # Makers are loaded before the update is applied: the database does not have this update yet,
+    # so every account the update touches is in the ledger by the time other tickers can see the change
+    await ledger.load(update.accounts(), acc_gw, order_repo)
+    ledger.apply(update)
 
 
 class GetManyTransactionsCommand:
@@ -114,44 +435,68 @@ class GetManyTransactionsCommand:
         return await self._trs_repo.get_many(self._filter_by, self._order_by, self._slice_from, self._slice_to)
 
 
-class GetAccountPositionsCommand:
-    def __init__(self, trs_repo: Repository[domain.Transaction], account_uuid: UUID):
+class GetPageCommand:
+    def __init__(self, repo: Repository, keyset: tuple[str, ...], filter_by=None, after=None, limit: int = 100,
+                 asc: bool = True):
+        self._repo = repo
+        self._keyset = keyset
+        self._filter_by = filter_by
+        self._after = after
+        self._limit = limit
+        self._asc = asc
+
+    async def execute(self) -> list:
+        return await self._repo.get_page(self._keyset, self._after, self._limit, self._filter_by, self._asc)
+
+
+class StreamTransactionsCommand:
+    def __init__(self, trs_repo: Repository[domain.Transaction], filter_by=None, order_by=None,
+                 chunk_size: int = 10_000):
         self._trs_repo = trs_repo
-        self._acc_uuid = account_uuid
-        self._positions: dict[Ticker, domain.Position] = {}
+        self._filter_by = filter_by
+        self._order_by = order_by
+        self._chunk_size = chunk_size
+
+    def execute(self) -> AsyncIterator[list[NamedTuple]]:
+        return self._trs_repo.stream_rows(domain.TRANSACTION_FIELDS, self._filter_by, self._order_by,
+                                          self._chunk_size)
+
 
-    def __get_or_create_pos(self, ticker: Ticker):
-        if self._positions.get(ticker) is None:
-            self._positions[ticker] = domain.Position(self._acc_uuid, ticker)
-        return self._positions[ticker]
+class GetAccountPositionsCommand:
+    def __init__(self, position_repo: PositionRepository, account_uuid: UUID):
+        self._position_repo = position_repo
+        self._acc_uuid = account_uuid
 
     async def execute(self) -> list[domain.Position]:
-        one = await self._trs_repo.get_many({"buyer": self._acc_uuid})
-        two = await self._trs_repo.get_many({"seller": self._acc_uuid})
+        return await self._position_repo.get_positions(self._acc_uuid)
 
-        for trs in one:
-            position = self.__get_or_create_pos(trs.ticker)
-            position.append_transaction(trs)
 
-        for trs in two:
-            position = self.__get_or_create_pos(trs.ticker)
-            position.append_transaction(trs)
+class RebuildPositionsCommand:
+    def __init__(self, position_repo: PositionRepository):
+        self._position_repo = position_repo
 
-        return list(filter(lambda x: x.total_quantity != 0, self._positions.values()))
+    async def execute(self):
+        await self._position_repo.rebuild()
 
 
 class CommandFactory:
     def __init__(
             self,
+            registry: MarketRegistry,
+            ledger: AccountLedger,
             order_repo: Repository[domain.Order],
+            commodity_gw: CommodityGateway,
             trs_repo: Repository[domain.Transaction],
-            deal_gw: DealGateway,
+            position_repo: PositionRepository,
             acc_gw: AccountGateway,
             queue: eventbus.Queue,
     ):
+        self._registry = registry
+        self._ledger = ledger
         self._order_repo = order_repo
+        self._commodity_gw = commodity_gw
         self._trs_repo = trs_repo
-        self._deal_gw = deal_gw
+        self._position_repo = position_repo
         self._acc_gw = acc_gw
         self._queue = queue
 
@@ -162,40 +507,85 @@ class CommandFactory:
                               slice_from: int = None, slice_to: int = None) -> GetManyTransactionsCommand:
         return GetManyTransactionsCommand(self._trs_repo, filter_by, order_by, slice_from, slice_to)
 
+    def get_orders_page(self, filter_by: dict = None, after: tuple = None, limit: int = 100,
+                        asc: bool = True) -> GetPageCommand:
+        return GetPageCommand(self._order_repo, domain.ORDER_KEYSET, filter_by, after, limit, asc)
+
+    def get_transactions_page(self, filter_by: dict = None, after: tuple = None, limit: int = 100,
+                              asc: bool = True) -> GetPageCommand:
+        return GetPageCommand(self._trs_repo, domain.TRANSACTION_KEYSET, filter_by, after, limit, asc)
+
+    def stream_transactions(self, filter_by: dict = None, order_by: OrderBy = None,
+                            chunk_size: int = 10_000) -> StreamTransactionsCommand:
+        return StreamTransactionsCommand(self._trs_repo, filter_by, order_by, chunk_size)
+
+    def warm_up_markets(self) -> WarmUpMarketsCommand:
+        return WarmUpMarketsCommand(self._registry, self._order_repo, self._commodity_gw)
+
     def get_market_by_ticker(self, ticker: Ticker) -> GetMarketByTickerCommand:
-        return GetMarketByTickerCommand(ticker, self._order_repo, self._trs_repo)
+        return GetMarketByTickerCommand(ticker, self._registry, self._order_repo, self._commodity_gw)
+
+    def check_ticker(self, ticker: Ticker) -> CheckTickerCommand:
+        return CheckTickerCommand(ticker, self._registry, self._commodity_gw)
 
     def get_account_positions(self, acc_uuid: UUID) -> GetAccountPositionsCommand:
-        return GetAccountPositionsCommand(self._trs_repo, acc_uuid)
+        return GetAccountPositionsCommand(self._position_repo, acc_uuid)
+
+    def rebuild_positions(self) -> RebuildPositionsCommand:
+        return RebuildPositionsCommand(self._position_repo)
 
     def send_order(self, order: domain.Order) -> SendOrderCommand:
-        return SendOrderCommand(order, self._order_repo, self._trs_repo, self._deal_gw, self._acc_gw, self._queue)
+        return SendOrderCommand(order, self._registry, self._ledger, self._order_repo, self._commodity_gw,
+                                self._acc_gw, self._queue)
+
+    def send_orders(self, orders: list[domain.Order]) -> SendOrdersCommand:
+        return SendOrdersCommand(orders, self._registry, self._ledger, self._order_repo, self._commodity_gw,
+                                 self._acc_gw, self._queue)
 
     def cancel_order(self, order: domain.Order) -> CancelOrderCommand:
-        return CancelOrderCommand(order, self._order_repo, self._queue)
+        return CancelOrderCommand(order, self._registry, self._ledger, self._order_repo, self._commodity_gw,
+                                   self._acc_gw, self._queue)
+
+    def amend_order(self, order: domain.Order) -> AmendOrderCommand:
+        return AmendOrderCommand(order, self._registry, self._ledger, self._order_repo, self._commodity_gw,
+                                  self._acc_gw, self._queue)
 
 
 class OrderHandler:
     def __init__(self, repo: Repository[domain.Order]):
         self._repo = repo
 
-    async def handle_order_created(self, event: eventbus.Created[domain.Order]):
-        await self._repo.add_many([event.entity])
+    async def handle_orders_created(self, events: list[eventbus.Created[domain.Order]]):
+        await self._repo.add_many([x.entity for x in events])
+
+    async def handle_orders_updated(self, events: list[eventbus.Updated[domain.Order]]):
+        await self._repo.update_many([x.entity for x in events])
 
-    async def handle_order_updated(self, event: eventbus.Updated[domain.Order]):
-        await self._repo.update_one(event.entity)
+    async def handle_orders_completed(self, events: list[eventbus.Deleted[domain.Order]]):
+        await self._repo.remove_many(filter_by={'uuid.$__in': [x.entity.uuid for x in events]})
 
-    async def handle_order_completed(self, event: eventbus.Deleted[domain.Order]):
-        await self._repo.remove_many(filter_by={'uuid': event.entity.uuid})
+    async def handle_orders_canceled(self, events: list[eventbus.Deleted[domain.Order]]):
+        await self._repo.remove_many(filter_by={'uuid.$__in': [x.entity.uuid for x in events]})
 
 
 class TransactionHandler:
-    def __init__(self, trs_repo: Repository[domain.Transaction], deal_gw: DealGateway, acc_gw: AccountGateway):
+    def __init__(self, trs_repo: Repository[domain.Transaction], acc_gw: AccountGateway):
         self._repo = trs_repo
-        self._deal_gw = deal_gw
         self._acc_gw = acc_gw
 
-    async def handle_transaction_created(self, event: eventbus.Created[domain.Transaction]):
-        await self._repo.add_many([event.entity])
-        await self._acc_gw.change_accounts_data(event.entity)
-        await self._deal_gw.create_deals_from_transaction(event.entity)
+    async def handle_transactions_created(self, events: list[eventbus.Created[domain.Transaction]]):
+        transactions = [x.entity for x in events]
+        await self._repo.add_many(transactions)
+        await self._acc_gw.change_accounts_data(transactions)
+
+
+class ProjectionHandler:
+    """Positions and deals are derived from committed fills, they are brought up to date after the order response"""
+
+    def __init__(self, position_repo: PositionRepository, deal_gw: DealGateway):
+        self._position_repo = position_repo
+
+    async def handle_transactions_created(self, events: list[eventbus.Created[domain.Transaction]]):
+        transactions = [x.entity for x in events]
+        await self._position_repo.apply_changes(domain.Position.collect_changes(transactions))
+        await self._deal_gw.create_deals_from_transactions(transactions)
@@ -1,7 +1,12 @@
 from src.base import eventbus
 from src.base.repo import Repository, PostgresRepo
-from src.market import domain, handlers
+from src.market import domain, handlers, engine
 from src.market.infrastructure import postgres, gateway
+from src.market.infrastructure.broadcast import BroadcastHandler
+
+market_registry = handlers.MarketRegistry()
+account_ledger = handlers.AccountLedger()
+matching_engine = engine.MatchingEngine()
 
 
 class Bootstrap:
@@ -12,20 +17,34 @@ class Bootstrap:
     def get_queue(self):
         return self._queue
 
+    def get_market_registry(self) -> handlers.MarketRegistry:
+        return market_registry
+
+    def get_account_ledger(self) -> handlers.AccountLedger:
+        return account_ledger
+
     def get_order_repo(self) -> Repository[domain.Order]:
         return PostgresRepo(session=self._session, model=postgres.OrderModel)
 
     def get_transaction_repo(self) -> Repository[domain.Transaction]:
         return PostgresRepo(session=self._session, model=postgres.TransactionModel)
 
+    def get_position_repo(self) -> handlers.PositionRepository:
+        return postgres.PositionRepo(session=self._session)
+
     def get_deal_gateway(self) -> handlers.DealGateway:
         return gateway.DealGatewayM(self._session)
 
     def get_acc_gateway(self) -> handlers.AccountGateway:
         return gateway.AccountGatewayM(self._session)
 
+    def get_commodity_gateway(self) -> handlers.CommodityGateway:
+        return gateway.CommodityGatewayM(self._session)
+
     def get_command_factory(self) -> handlers.CommandFactory:
-        factory = handlers.CommandFactory(self.get_order_repo(), self.get_transaction_repo(), self.get_deal_gateway(),
+        factory = handlers.CommandFactory(self.get_market_registry(), self.get_account_ledger(),
+                                          self.get_order_repo(), self.get_commodity_gateway(),
+                                          self.get_transaction_repo(), self.get_position_repo(),
                                           self.get_acc_gateway(), self._queue)
         return factory
 
@@ -33,14 +52,27 @@ class Bootstrap:
         bus = eventbus.EventBus(self._queue)
 
         handler = handlers.OrderHandler(self.get_order_repo())
-        bus.register('OrderCreated', handler.handle_order_created)
-        bus.register('OrderUpdated', handler.handle_order_updated)
-        bus.register('OrderCompleted', handler.handle_order_completed)
-
-        handler = handlers.TransactionHandler(
-            self.get_transaction_repo(),
-            self.get_deal_gateway(),
-            self.get_acc_gateway(),
-        )
-        bus.register('TransactionCreated', handler.handle_transaction_created)
+        bus.register_batch('OrderCreated', handler.handle_orders_created)
+        bus.register_batch('OrderUpdated', handler.handle_orders_updated)
+        bus.register_batch('OrderCompleted', handler.handle_orders_completed)
+        bus.register_batch('OrderCanceled', handler.handle_orders_canceled)
+
+        handler = handlers.TransactionHandler(self.get_transaction_repo(), self.get_acc_gateway())
+        bus.register_batch('TransactionCreated', handler.handle_transactions_created)
         return bus
+
+    def get_projection_eventbus(self) -> eventbus.EventBus:
+        # Fills that are already committed, applied to the projections in this session
+        bus = eventbus.EventBus(self._queue)
+        handler = handlers.ProjectionHandler(self.get_position_repo(), self.get_deal_gateway())
+        bus.register_batch('TransactionCreated', handler.handle_transactions_created)
+        return bus
+
+
+def create_broadcast_eventbus(broadcaster: BroadcastHandler) -> eventbus.EventBus:
+    # Events that are already committed, sent to the subscribers without a session
+    bus = eventbus.EventBus(eventbus.Queue())
+    for key in ('OrderCreated', 'OrderUpdated', 'OrderCompleted', 'OrderCanceled'):
+        bus.register_batch(key, broadcaster.handle_orders)
+    bus.register_batch('TransactionCreated', broadcaster.handle_transactions_created)
+    return bus
@@ -0,0 +1,579 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Awaitable, Callable, Hashable, Literal, NamedTuple, Optional
+from uuid import uuid4
+
+import asyncpg
+from fastapi import WebSocket
+from loguru import logger
+from pydantic_core import to_jsonable_python
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from src.base import eventbus
+from src.core import Ticker
+from .. import domain, engine
+from .schema import MarketDiffSchema, MarketSnapshotSchema, OrderSchema, TransactionSchema
+
+MARKET_FEED_INTERVAL = 0.05
+OUTBOUND_QUEUE_SIZE = 256
+
+# NOTIFY payloads must be shorter than 8000 bytes, the rest of the limit is left for the chunk header
+NOTIFY_CHUNK_SIZE = 7_900
+# Payloads kept for the publisher while its connection is down
+BROKER_OUTBOX_SIZE = 10_000
+# Seconds, doubled after every failed reconnect up to the maximum
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+CLOSE_TIMEOUT = 5
+# Seconds a message may wait for its remaining chunks
+CHUNK_TIMEOUT = 10
+# Seconds a depth subscriber of another process waits for the snapshot of the matching process
+SNAPSHOT_TIMEOUT = 5
+SNAPSHOT_REQUEST_CHANNEL = 'market-snapshot-request'
+SNAPSHOT_CHANNEL = 'market-snapshot'
+
+OverflowPolicy = Literal['DROP_OLDEST', 'CONFLATE', 'CLOSE']
+BrokerType = Literal['local', 'postgres']
+
+
+def encode(message: dict | str) -> str:
+    """JSON text of a message, UUIDs and datetimes included; text is passed through so it can be encoded once"""
+    if isinstance(message, str):
+        return message
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message, separators=(',', ':'), default=to_jsonable_python)
+
+
+class BroadcastStats(NamedTuple):
+    channel: str
+    connections: int
+    queued: int
+    max_queued: int
+    dropped: int
+    closed: int
+
+
+class Connection:
+    """
+    Outbound side of one websocket: messages are queued without blocking and sent by a writer task of its own.
+    When the queue is full the policy decides: DROP_OLDEST drops the oldest message, CONFLATE replaces the queued
+    message with the same conflation key (falling back to DROP_OLDEST), CLOSE closes the socket so the client
+    reconnects and starts over. When the writer stops on its own, the socket is closed and `on_close` is called.
+    """
+
+    def __init__(self, websocket: WebSocket, maxsize: int = OUTBOUND_QUEUE_SIZE,
+                 policy: OverflowPolicy = 'DROP_OLDEST', on_close: Callable[[], None] = None):
+        self.websocket = websocket
+        self._maxsize = maxsize
+        self._policy = policy
+        self._on_close = on_close
+        self._queue: deque[tuple[Hashable, str]] = deque()
+        self._ready = asyncio.Event()
+        self._overflowed = False
+        self.closed = False
+        self._task = asyncio.create_task(self._write(), name='websocket-writer')
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def put(self, text: str, key: Hashable = None) -> int:
+        """Queues encoded text and returns the number of messages dropped to make room, key is used by CONFLATE"""
+        if self.closed:
+            return 1
+        queue = self._queue
+        dropped = 0
+        if len(queue) >= self._maxsize:
+            if self._policy == 'CLOSE':
+                dropped = len(queue) + 1
+                queue.clear()
+                self._overflowed = self.closed = True
+                self._ready.set()
+                return dropped
+            if self._policy == 'CONFLATE' and self.__conflate(text, key):
+                return 1
+            queue.popleft()
+            dropped = 1
+        queue.append((key, text))
+        self._ready.set()
+        return dropped
+
+    async def close(self):
+        self.closed = True
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def __conflate(self, text: str, key: Hashable) -> bool:
+        queue = self._queue
+        for i, (queued, _text) in enumerate(queue):
+            if queued == key:
+                queue[i] = (key, text)
+                return True
+        return False
+
+    async def _write(self):
+        # Cancellation comes from close(), whose caller has already let go of the connection
+        queue = self._queue
+        try:
+            while True:
+                if not queue:
+                    if self._overflowed:
+                        await self.websocket.close(code=1013)
+                        break
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                await self.websocket.send_text(queue.popleft()[1])
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.warning(f'websocket writer stopped: {err}')
+            queue.clear()
+            with contextlib.suppress(Exception):
+                await self.websocket.close(code=1011)
+        self.closed = True
+        if self._on_close is not None:
+            self._on_close()
+
+
+class BrokerChannel(NamedTuple):
+    """A broker channel read by the process itself rather than by websockets"""
+    channel: str
+    deliver: Callable[[str, str, Optional[str]], None]
+
+
+class Broker(ABC):
+    """Carries encoded messages from the process that broadcasts them to the managers of every process"""
+
+    def __init__(self):
+        self._managers: dict[str, ConnectionManager | BrokerChannel] = {}
+
+    def register(self, manager: 'ConnectionManager | BrokerChannel'):
+        self._managers[manager.channel] = manager
+
+    def wants(self, channel: str, key: str) -> bool:
+        """False only if no process can have a subscriber of the key, so the message is not even encoded"""
+        return True
+
+    @abstractmethod
+    def publish(self, channel: str, key: str, text: str, conflate_key: str = None):
+        raise NotImplemented
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def _deliver(self, channel: str, key: str, text: str, conflate_key: str = None):
+        manager = self._managers.get(channel)
+        if manager is not None:
+            manager.deliver(key, text, conflate_key)
+
+
+class LocalBroker(Broker):
+    """Subscribers of this process only, messages are delivered synchronously"""
+
+    def wants(self, channel: str, key: str) -> bool:
+        manager = self._managers.get(channel)
+        return manager is not None and bool(manager.active_connections.get(key))
+
+    def publish(self, channel: str, key: str, text: str, conflate_key: str = None):
+        self._deliver(channel, key, text, conflate_key)
+
+
+class PostgresBroker(Broker):
+    """
+    Fan-out across processes through LISTEN/NOTIFY on one Postgres channel. Every process, the publishing one included,
+    delivers what its listener connection receives. Publishing only queues the message, a task sends the queue in
+    order over a connection of its own. Longer messages are split into numbered chunks that listeners join back.
+    Lost connections are opened again with a growing delay and the queue is sent once they are back, what other
+    processes publish in the meantime is not received.
+    """
+
+    def __init__(self, dsn: str, pg_channel: str = 'broadcast', outbox_size: int = BROKER_OUTBOX_SIZE):
+        super().__init__()
+        self._dsn = dsn
+        self._pg_channel = pg_channel
+        self._outbox: deque[str] = deque()
+        self._outbox_size = outbox_size
+        self._ready = asyncio.Event()
+        self._lost = asyncio.Event()
+        self._listener: Optional[asyncpg.Connection] = None
+        self._publisher: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._origin = uuid4().hex[:8]
+        self._ids = itertools.count()
+        self._chunks: dict[str, tuple[float, list[str]]] = {}
+        self.dropped = 0
+
+    async def start(self):
+        # The first connection is not retried, a database out of reach at startup is a configuration error
+        await self.__connect()
+        self._task = asyncio.create_task(self._run(), name='broadcast-publisher')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.__disconnect()
+
+    def publish(self, channel: str, key: str, text: str, conflate_key: str = None):
+        # json.dumps escapes to ASCII, so a character is a byte when the envelope is cut into chunks
+        envelope = json.dumps([channel, key, conflate_key, text], separators=(',', ':'))
+        pieces = [envelope[i:i + NOTIFY_CHUNK_SIZE] for i in range(0, len(envelope), NOTIFY_CHUNK_SIZE)]
+        message_id = f'{self._origin}-{next(self._ids)}'
+        for i, piece in enumerate(pieces):
+            if len(self._outbox) >= self._outbox_size:
+                # The database has been out of reach for long, the oldest payloads go first
+                self._outbox.popleft()
+                self.dropped += 1
+            self._outbox.append(f'{message_id}:{i}:{len(pieces)}:{piece}')
+        self._ready.set()
+
+    async def _run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                if self._publisher is None:
+                    await self.__connect()
+                    logger.info('broadcast broker reconnected')
+                delay = RECONNECT_DELAY
+                await self.__send()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.error(f'broadcast broker connection lost: {err!r}, reconnecting in {delay}s')
+            await self.__disconnect()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    async def __send(self):
+        """Sends the queue until a connection is lost"""
+        outbox = self._outbox
+        while True:
+            if self._lost.is_set():
+                raise ConnectionError('listener connection closed')
+            if not outbox:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            payloads = list(outbox)
+            outbox.clear()
+            try:
+                await self._publisher.executemany('SELECT pg_notify($1, $2)', [(self._pg_channel, x) for x in payloads])
+            except Exception as err:
+                if self._publisher.is_closed():
+                    # Sent again over the next connection, ahead of what was queued meanwhile
+                    outbox.extendleft(reversed(payloads))
+                    raise
+                logger.error(f'broadcast publisher lost {len(payloads)} payloads: {err}')
+
+    async def __connect(self):
+        self._lost.clear()
+        listener = await asyncpg.connect(self._dsn)
+        try:
+            await listener.add_listener(self._pg_channel, self._on_notify)
+            publisher = await asyncpg.connect(self._dsn)
+        except BaseException:
+            await listener.close()
+            raise
+        listener.add_termination_listener(self.__on_listener_lost)
+        self._listener, self._publisher = listener, publisher
+
+    async def __disconnect(self):
+        connections = (self._listener, self._publisher)
+        self._listener = self._publisher = None
+        for connection in connections:
+            if connection is not None and not connection.is_closed():
+                with contextlib.suppress(Exception):
+                    await connection.close(timeout=CLOSE_TIMEOUT)
+
+    def __on_listener_lost(self, connection: asyncpg.Connection):
+        if connection is self._listener:
+            self._lost.set()
+            self._ready.set()
+
+    def _on_notify(self, _connection, _pid: int, _channel: str, payload: str):
+        message_id, index, count, piece = payload.split(':', 3)
+        if count != '1':
+            piece = self.__join(message_id, int(index), int(count), piece)
+            if piece is None:
+                return
+        channel, key, conflate_key, text = json.loads(piece)
+        self._deliver(channel, key, text, conflate_key)
+
+    def __join(self, message_id: str, index: int, count: int, piece: str) -> Optional[str]:
+        # Chunks of one message are sent back to back by one connection, so they arrive in order
+        now = time.monotonic()
+        if index == 0:
+            # A message whose tail never came, cut by a lost connection or a dropped payload, is given up
+            for stale in [k for k, (started, _) in self._chunks.items() if now - started > CHUNK_TIMEOUT]:
+                del self._chunks[stale]
+            self._chunks[message_id] = (now, [piece])
+            return None
+        entry = self._chunks.get(message_id)
+        if entry is None or len(entry[1]) != index:
+            # Joined in the middle of the message or a chunk is missing, it can not be put back together
+            self._chunks.pop(message_id, None)
+            return None
+        entry[1].append(piece)
+        if index + 1 < count:
+            return None
+        del self._chunks[message_id]
+        return ''.join(entry[1])
+
+    def pending_chunks(self) -> int:
+        """Messages of which only some chunks have arrived"""
+        return len(self._chunks)
+
+
+def create_broker(broker: BrokerType, dsn: str) -> Broker:
+    if broker == 'local':
+        return LocalBroker()
+    if broker == 'postgres':
+        return PostgresBroker(dsn)
+    raise ValueError(f'unknown broker {broker}')
+
+
+class ConnectionManager:
+    def __init__(self, channel: str, broker: Broker = None, maxsize: int = OUTBOUND_QUEUE_SIZE,
+                 policy: OverflowPolicy = 'DROP_OLDEST', conflate_key: Callable[[dict], str] = None):
+        if policy == 'CONFLATE' and conflate_key is None:
+            raise ValueError('CONFLATE policy needs a conflation key')
+        self.channel = channel
+        self._broker = broker if broker is not None else LocalBroker()
+        self._broker.register(self)
+        self._maxsize = maxsize
+        self._policy = policy
+        self._conflate_key = conflate_key
+        self.active_connections: dict[str, dict[WebSocket, Connection]] = {}
+        self._max_queued = 0
+        self._dropped = 0
+        self._closed = 0
+
+    async def connect(self, key, websocket: WebSocket) -> Connection:
+        await websocket.accept()
+        return self.add(key, websocket)
+
+    def add(self, key, websocket: WebSocket) -> Connection:
+        connection = Connection(websocket, self._maxsize, self._policy, on_close=lambda: self.__discard(key, websocket))
+        connections = self.active_connections.setdefault(key, {})
+        connections[websocket] = connection
+        logger.debug(f'current connections: {len(connections)}')
+        return connection
+
+    async def disconnect(self, key, websocket: WebSocket):
+        connection = self.__discard(key, websocket)
+        if connection is not None:
+            await connection.close()
+
+    def __discard(self, key, websocket: WebSocket) -> Optional[Connection]:
+        connections = self.active_connections.get(key, {})
+        connection = connections.pop(websocket, None)
+        if not connections:
+            self.active_connections.pop(key, None)
+        return connection
+
+    def broadcast(self, key: str, message: dict | str):
+        """Encodes the message once and publishes it to the subscribers of the key in every process"""
+        if not self._broker.wants(self.channel, key):
+            return
+        # The conflation key is read from the message, so a conflating channel is given dicts
+        conflate_key = self._conflate_key(message) if self._conflate_key is not None else None
+        self._broker.publish(self.channel, key, encode(message), conflate_key)
+
+    def deliver(self, key: str, text: str, conflate_key: str = None):
+        """Queues the same text for every subscriber of the key in this process"""
+        connections = self.active_connections.get(key)
+        if not connections:
+            return
+        for connection in connections.values():
+            if connection.closed:
+                continue
+            self._dropped += connection.put(text, conflate_key)
+            if connection.closed:
+                self._closed += 1
+            self._max_queued = max(self._max_queued, len(connection))
+
+    def stats(self) -> BroadcastStats:
+        connections = [x for group in self.active_connections.values() for x in group.values()]
+        return BroadcastStats(
+            channel=self.channel,
+            connections=len(connections),
+            queued=sum(len(x) for x in connections),
+            max_queued=self._max_queued,
+            dropped=self._dropped,
+            closed=self._closed,
+        )
+
+
+class MarketFeed:
+    """
+    Depth channel of every ticker: one snapshot on connect, then level diffs numbered per ticker.
+    Changes are collected for `interval` seconds, so a burst of orders costs subscribers one message.
+    A client applies a diff only if its sequence is the one after the last applied message.
+
+    Books and sequences belong to the matching process. Another process asks it for the snapshot through the
+    broker and adds the subscriber when the answer arrives, in order with the diffs the matching process publishes.
+    """
+
+    def __init__(self, manager: ConnectionManager, matching_engine: engine.MatchingEngine,
+                 get_market: Callable[[Ticker], Awaitable[domain.Market]], interval: float = MARKET_FEED_INTERVAL,
+                 broker: Broker = None, matching: Callable[[], bool] = None):
+        self._manager = manager
+        self._engine = matching_engine
+        self._get_market = get_market
+        self._interval = interval
+        self._broker = broker
+        self._matching = matching if matching is not None else lambda: True
+        self._sequences: dict[Ticker, int] = {}
+        self._markets: dict[Ticker, domain.Market] = {}
+        self._pending: set[Ticker] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._requests: dict[str, tuple[Ticker, WebSocket, asyncio.Future]] = {}
+        self._answers: set[asyncio.Task] = set()
+        if broker is not None:
+            broker.register(BrokerChannel(SNAPSHOT_REQUEST_CHANNEL, self._on_snapshot_request))
+            broker.register(BrokerChannel(SNAPSHOT_CHANNEL, self._on_snapshot))
+
+    async def subscribe(self, ticker: Ticker, websocket: WebSocket):
+        """Raises TimeoutError if the subscriber is not matching and the matching process does not answer"""
+        await websocket.accept()
+        if not self._matching():
+            await self.__request_snapshot(ticker, websocket)
+            return
+
+        # Runs in the ticker worker: no order is half-processed and no diff can get ahead of the snapshot
+        async def snapshot():
+            self._manager.add(ticker, websocket).put(await self._snapshot(ticker))
+
+        await self._engine.execute(ticker, snapshot)
+
+    async def _snapshot(self, ticker: Ticker) -> str:
+        market = await self._get_market(ticker)
+        if self._markets.setdefault(ticker, market) is not market:
+            # The book was rebuilt since the last flush, the next message resyncs everyone
+            self.notify(ticker)
+        return MarketSnapshotSchema.from_entity(market, self._sequences.get(ticker, 0)).model_dump_json()
+
+    async def __request_snapshot(self, ticker: Ticker, websocket: WebSocket):
+        request_id = uuid4().hex
+        answered = asyncio.get_running_loop().create_future()
+        self._requests[request_id] = (ticker, websocket, answered)
+        try:
+            self._broker.publish(SNAPSHOT_REQUEST_CHANNEL, ticker, request_id)
+            await asyncio.wait_for(answered, SNAPSHOT_TIMEOUT)
+        finally:
+            self._requests.pop(request_id, None)
+
+    def _on_snapshot_request(self, ticker: Ticker, request_id: str, _conflate_key: str = None):
+        if not self._matching():
+            return
+
+        # Published from the ticker worker, so the diffs published after it are the ones that follow the snapshot
+        async def answer():
+            self._broker.publish(SNAPSHOT_CHANNEL, request_id, await self._snapshot(ticker))
+
+        async def run():
+            try:
+                await self._engine.execute(ticker, answer)
+            except Exception as err:
+                logger.error(f'market feed {ticker}: snapshot for another process failed: {err}')
+
+        task = asyncio.create_task(run(), name='market-snapshot')
+        self._answers.add(task)
+        task.add_done_callback(self._answers.discard)
+
+    def _on_snapshot(self, request_id: str, text: str, _conflate_key: str = None):
+        request = self._requests.pop(request_id, None)
+        if request is None or request[2].done():
+            # Asked by another process, or given up already
+            return
+        ticker, websocket, answered = request
+        # Added as the snapshot is delivered, the next message the broker delivers is the diff that follows it
+        self._manager.add(ticker, websocket).put(text)
+        answered.set_result(None)
+
+    def notify(self, ticker: Ticker):
+        if not self._matching():
+            # Diffs are numbered by the matching process only, this one relays what the broker delivers
+            return
+        self._pending.add(ticker)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name='market-feed')
+
+    async def stop(self):
+        tasks = [*self._answers, *([self._task] if self._task is not None else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        try:
+            while self._pending:
+                await asyncio.sleep(self._interval)
+                tickers, self._pending = self._pending, set()
+                await asyncio.gather(*[self._publish(ticker) for ticker in tickers])
+        finally:
+            self._task = None
+
+    async def _publish(self, ticker: Ticker):
+        try:
+            message = await self._engine.execute(ticker, lambda: self._collect(ticker))
+        except Exception as err:
+            logger.error(f'market feed {ticker}: {err}')
+            return
+        if message is not None:
+            self._manager.broadcast(ticker, message.model_dump_json())
+
+    async def _collect(self, ticker: Ticker) -> MarketSnapshotSchema | MarketDiffSchema | None:
+        market = await self._get_market(ticker)
+        buy_level, sell_level = market.parse_level_changes()
+        known = self._markets.get(ticker)
+        self._markets[ticker] = market
+        if known is market and not buy_level and not sell_level:
+            return None
+        sequence = self._sequences[ticker] = self._sequences.get(ticker, 0) + 1
+        if known is not market:
+            # A rebuilt book has no history to diff against
+            return MarketSnapshotSchema.from_entity(market, sequence)
+        return MarketDiffSchema(ticker=ticker, sequence=sequence, buy_level=buy_level, sell_level=sell_level)
+
+
+class BroadcastHandler:
+    """Fan-out of committed market events to the websocket channels"""
+
+    def __init__(self, feed: MarketFeed, trs_manager: ConnectionManager, order_manager: ConnectionManager,
+                 position_manager: ConnectionManager):
+        self._feed = feed
+        self._trs_manager = trs_manager
+        self._order_manager = order_manager
+        self._position_manager = position_manager
+
+    async def handle_orders(self, events: list[eventbus.Event]):
+        for event in events:
+            order = event.entity
+            self._feed.notify(order.ticker)
+            self._order_manager.broadcast(str(order.account), OrderSchema.from_entity(order).model_dump())
+
+    async def handle_transactions_created(self, events: list[eventbus.Created[domain.Transaction]]):
+        for event in events:
+            trs = event.entity
+            self._feed.notify(trs.ticker)
+            # One encoding for the three channels
+            data = encode(TransactionSchema.from_entity(trs).model_dump())
+            self._trs_manager.broadcast(trs.ticker, data)
+            self._position_manager.broadcast(str(trs.buyer), data)
+            self._position_manager.broadcast(str(trs.seller), data)
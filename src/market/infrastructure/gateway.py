@@ -1,3 +1,5 @@
+from uuid import UUID
+
 from src.deal import (
     bootstrap as deal_bootstrap,
     domain as deal_domain,
@@ -5,8 +7,9 @@ from src.deal import (
 from src.account import (
     bootstrap as acc_bootstrap,
     domain as acc_domain,
-    handlers as acc_commands,
 )
+from src.commodity.infrastructure import bootstrap as commodity_bootstrap
+from src.core import Ticker
 from .. import (
     domain as market_domain,
     handlers as market_handlers,
@@ -17,66 +20,55 @@ class DealGatewayM(market_handlers.DealGateway):
     def __init__(self, session):
         self._session = session
 
-    async def create_deals_from_transaction(self, trs: market_domain.Transaction):
+    async def create_deals_from_transactions(self, transactions: list[market_domain.Transaction]):
+        # Fills of one matching cycle are summed per account and ticker and stored with one upsert
+        deals: dict[tuple, deal_domain.Deal] = {}
+        for trs in transactions:
+            for account, direction in ((trs.buyer, 'BUY'), (trs.seller, 'SELL')):
+                deal = deals.get((account, trs.ticker))
+                if deal is None:
+                    deal = deals[(account, trs.ticker)] = deal_domain.Deal(
+                        account=account,
+                        ticker=trs.ticker,
+                        status='PROCESSING',
+                        weighted_price=0,
+                        total_quantity=0,
+                    )
+                deal.append_transaction(
+                    deal_domain.InnerTransaction(direction=direction, price=trs.price, quantity=trs.quantity)
+                )
         factory = deal_bootstrap.Bootstrap(self._session).get_deal_command_factory()
-        deals = (await factory.get_many_deals({'ticker': trs.ticker, 'account': trs.buyer}).execute())
-        if len(deals) == 0:
-            deal = deal_domain.Deal(
-                account=trs.buyer,
-                ticker=trs.ticker,
-                status='PROCESSING',
-                weighted_price=0,
-                total_quantity=0,
-            )
-            deal.append_transaction(
-                deal_domain.InnerTransaction(direction='BUY', price=trs.price, quantity=trs.quantity)
-            )
-            await factory.create_deal(deal).execute()
-        else:
-            deal = deals.pop()
-            deal.append_transaction(
-                deal_domain.InnerTransaction(direction='BUY', price=trs.price, quantity=trs.quantity)
-            )
-            await factory.update_deal(deal).execute()
-
-        deals = (await factory.get_many_deals({'ticker': trs.ticker, 'account': trs.seller}).execute())
-        if len(deals) == 0:
-            deal = deal_domain.Deal(
-                account=trs.seller,
-                ticker=trs.ticker,
-                status='PROCESSING',
-                weighted_price=0,
-                total_quantity=0,
-            )
-            deal.append_transaction(
-                deal_domain.InnerTransaction(direction='SELL', price=trs.price, quantity=trs.quantity)
-            )
-            await factory.create_deal(deal).execute()
-        else:
-            deal = deals.pop()
-            deal.append_transaction(
-                deal_domain.InnerTransaction(direction='SELL', price=trs.price, quantity=trs.quantity)
-            )
-            await factory.update_deal(deal).execute()
+        await factory.apply_deal_changes(list(deals.values())).execute()
 
 
 class AccountGatewayM(market_handlers.AccountGateway):
     def __init__(self, session):
         self._session = session
 
-    async def change_accounts_data(self, trs: market_domain.Transaction):
-        acc_repo = acc_bootstrap.Bootstrap(self._session).get_account_repo()
+    async def change_accounts_data(self, transactions: list[market_domain.Transaction]):
+        # Same arithmetic as Account.reflect_purchase and reflect_sale, summed per account over the batch
+        changes: dict = {}
+        for trs in transactions:
+            amount = trs.amount
+            cash, bda, sda = changes.get(trs.buyer, (0, 0, 0))
+            changes[trs.buyer] = (cash - amount, bda + amount, sda)
+            cash, bda, sda = changes.get(trs.seller, (0, 0, 0))
+            changes[trs.seller] = (cash - amount, bda, sda + amount)
+        factory = acc_bootstrap.Bootstrap(self._session).get_command_factory()
+        changes = [acc_domain.AccountChange(uuid, *change) for uuid, change in changes.items()]
+        await factory.apply_account_changes(changes).execute()
+
+    async def get_accounts_cash(self, accounts: list[UUID]) -> dict[UUID, float]:
+        factory = acc_bootstrap.Bootstrap(self._session).get_command_factory()
+        return {x.uuid: x.cash for x in await factory.get_accounts_by_uuids(accounts).execute()}
 
-        buyer: acc_domain.Account = await acc_commands.GetAccountByUuid(trs.buyer, acc_repo).execute()
-        buyer.reflect_purchase(trs.amount)
-        await acc_commands.UpdateAccount(buyer, acc_repo).execute()
 
-        seller: acc_domain.Account = await acc_commands.GetAccountByUuid(trs.seller, acc_repo).execute()
-        seller.reflect_sale(trs.amount)
-        await acc_commands.UpdateAccount(seller, acc_repo).execute()
+class CommodityGatewayM(market_handlers.CommodityGateway):
+    def __init__(self, session):
+        self._session = session
 
-    async def check_account_has_permission_to_send_order(self, order: market_domain.Order):
-        acc_repo = acc_bootstrap.Bootstrap(self._session).get_account_repo()
-        acc: acc_domain.Account = await acc_commands.GetAccountByUuid(order.account, acc_repo).execute()
-        if order.amount > acc.cash:
-            raise PermissionError(f'order.amount > acc.cash ({order.amount} > {acc.cash})')
+    async def get_book_specs(self, tickers: list[Ticker] = None) -> dict[Ticker, market_domain.BookSpec]:
+        factory = commodity_bootstrap.Bootstrap(self._session).get_command_factory()
+        filter_by = {'ticker.$__in': tickers} if tickers is not None else None
+        commodities = await factory.get_many_commodities(filter_by).execute()
+        return {x.ticker: market_domain.BookSpec(tick_size=x.tick_size, book=x.book) for x in commodities}
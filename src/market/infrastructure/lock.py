@@ -0,0 +1,45 @@
+from typing import Optional
+
+import asyncpg
+from loguru import logger
+
+# Session-level advisory lock key, any value works as long as nothing else in the database takes it
+MATCHING_LOCK_KEY = 0x6d61746368
+
+
+class MatchingLock:
+    """
+    Held by the one process that matches orders against a database. Books, the account ledger and the depth
+    sequences live in that process's memory, a second matching process would fill against copies of its own.
+    The advisory lock belongs to a connection of its own, so it is released with a crashed process.
+    """
+
+    def __init__(self, dsn: str, key: int = MATCHING_LOCK_KEY):
+        self._dsn = dsn
+        self._key = key
+        self._connection: Optional[asyncpg.Connection] = None
+
+    @property
+    def held(self) -> bool:
+        return self._connection is not None and not self._connection.is_closed()
+
+    async def acquire(self) -> bool:
+        """Tries the lock once, a process that does not get it serves reads and websockets only"""
+        connection = await asyncpg.connect(self._dsn)
+        if not await connection.fetchval('SELECT pg_try_advisory_lock($1)', self._key):
+            await connection.close()
+            logger.warning('orders are matched by another process on this database, this one refuses them')
+            return False
+        connection.add_termination_listener(self.__on_lost)
+        self._connection = connection
+        return True
+
+    async def release(self):
+        connection, self._connection = self._connection, None
+        if connection is not None and not connection.is_closed():
+            await connection.close()
+
+    def __on_lost(self, connection: asyncpg.Connection):
+        if connection is self._connection:
+            # Another process may take the lock now, this one must not match again on its stale books
+            logger.critical('matching lock lost with its connection, orders are refused until the process restarts')
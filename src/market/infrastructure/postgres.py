@@ -1,10 +1,14 @@
-from sqlalchemy.dialects.postgresql import UUID
+from uuid import uuid4
 
-from sqlalchemy import String, TIMESTAMP, Integer, Float
+from sqlalchemy.dialects.postgresql import UUID, insert
+
+from sqlalchemy import String, TIMESTAMP, Integer, Float, Index, UniqueConstraint, Uuid, delete, func, select, text, \
+    type_coerce, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from src.base.repo.postgres import Base
-from src.market import domain
+from src.market import domain, handlers
 
 
 class OrderModel(Base):
@@ -17,6 +21,10 @@ class OrderModel(Base):
     price: Mapped[float] = mapped_column(Float, nullable=False)
     quantity: Mapped[int] = mapped_column(Integer, nullable=False)
     created: Mapped[TIMESTAMP] = mapped_column(TIMESTAMP(timezone=True), nullable=False)
+    __table_args__ = (
+        Index('ix_order_open_ticker', 'ticker', 'created', postgresql_where=text("status IN ('PENDING', 'PARTIAL')")),
+        Index('ix_order_account_created', 'account', 'created', 'id'),
+    )
 
     @staticmethod
     def key_converter(key: str):
@@ -25,6 +33,13 @@ class OrderModel(Base):
             key = 'account'
         return key
 
+    @classmethod
+    def select_column(cls, key: str):
+        # The account is stored as text, rows get the UUID the entity has
+        if key == 'account':
+            return type_coerce(cls.__table__.c.account, Uuid(native_uuid=False)).label(key)
+        return super().select_column(key)
+
     def to_entity(self) -> domain.Order:
         return domain.Order(
             uuid=self.id,
@@ -39,9 +54,9 @@ class OrderModel(Base):
         )
 
     @classmethod
-    def from_entity(cls, entity: domain.Order):
-        return cls(
-            id=str(entity.uuid),
+    def to_values(cls, entity: domain.Order) -> dict:
+        return dict(
+            id=entity.uuid,
             account=str(entity.account),
             ticker=entity.ticker,
             dtype=entity.dtype,
@@ -61,6 +76,12 @@ class TransactionModel(Base):
     quantity: Mapped[int] = mapped_column(Integer)
     buyer: Mapped[UUID] = mapped_column(UUID)
     seller: Mapped[UUID] = mapped_column(UUID)
+    __table_args__ = (
+        Index('ix_transaction_buyer', 'buyer'),
+        Index('ix_transaction_seller', 'seller'),
+        Index('ix_transaction_ticker_date', 'ticker', 'date', 'id'),
+        Index('ix_transaction_date', 'date', 'id'),
+    )
 
     @staticmethod
     def key_converter(key: str):
@@ -84,8 +105,8 @@ class TransactionModel(Base):
         )
 
     @classmethod
-    def from_entity(cls, entity: domain.Transaction):
-        return cls(
+    def to_values(cls, entity: domain.Transaction) -> dict:
+        return dict(
             id=entity.uuid,
             ticker=entity.ticker,
             date=entity.date,
@@ -94,3 +115,69 @@ class TransactionModel(Base):
             buyer=str(entity.buyer),
             seller=str(entity.seller),
         )
+
+
+class PositionModel(Base):
+    __tablename__ = 'position'
+    account: Mapped[UUID] = mapped_column(UUID, nullable=False)
+    ticker: Mapped[str] = mapped_column(String(32), nullable=False)
+    weighted_price: Mapped[float] = mapped_column(Float, nullable=False)
+    total_quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    __table_args__ = (
+        UniqueConstraint('account', 'ticker', name='uq_position_account_ticker'),
+    )
+
+    def to_entity(self) -> domain.Position:
+        return domain.Position(
+            account_id=self.account,
+            ticker=self.ticker,
+            weighted_price=self.weighted_price,
+            total_quantity=self.total_quantity,
+        )
+
+
+class PositionRepo(handlers.PositionRepository):
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    async def apply_changes(self, changes: list[domain.Position]):
+        if not changes:
+            return
+        # One upsert per batch of fills, the changes are added to the stored values by the database
+        stmt = insert(PositionModel).values([
+            dict(id=uuid4(), account=x.account_uuid, ticker=x.ticker, weighted_price=x.weighted_price,
+                 total_quantity=x.total_quantity)
+            for x in changes
+        ])
+        stmt = stmt.on_conflict_do_update(
+            constraint='uq_position_account_ticker',
+            set_=dict(
+                weighted_price=PositionModel.weighted_price + stmt.excluded.weighted_price,
+                total_quantity=PositionModel.total_quantity + stmt.excluded.total_quantity,
+                updated_at=func.now(),
+            ),
+        )
+        await self._session.execute(stmt)
+
+    async def get_positions(self, account_uuid) -> list[domain.Position]:
+        stmt = select(PositionModel).where(PositionModel.account == account_uuid, PositionModel.total_quantity != 0)
+        result = await self._session.scalars(stmt)
+        return [x.to_entity() for x in result]
+
+    async def rebuild(self):
+        trs = TransactionModel.__table__
+        fills = union_all(
+            select(trs.c.buyer.label('account'), trs.c.ticker, trs.c.price, trs.c.quantity)
+            .where(trs.c.buyer != trs.c.seller),
+            select(trs.c.seller.label('account'), trs.c.ticker, trs.c.price, (-trs.c.quantity).label('quantity'))
+            .where(trs.c.buyer != trs.c.seller),
+        ).subquery()
+        source = (
+            select(func.gen_random_uuid(), func.now(), fills.c.account, fills.c.ticker,
+                   func.sum(fills.c.quantity * fills.c.price), func.sum(fills.c.quantity))
+            .group_by(fills.c.account, fills.c.ticker)
+        )
+        table = PositionModel.__table__
+        await self._session.execute(delete(table))
+        await self._session.execute(table.insert().from_select(
+            ['id', 'updated_at', 'account', 'ticker', 'weighted_price', 'total_quantity'], source))
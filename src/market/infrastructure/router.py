@@ -1,42 +1,62 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
+import os
+from typing import Awaitable, Callable
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from loguru import logger
+from pydantic import conlist
+from sqlalchemy.exc import IntegrityError
 
 from src import db
-from src.auth import User, current_active_user
+from src.auth import User, current_active_user, current_superuser
+from src.base import eventbus
 from src.base.repo.repository import OrderBy
+from src.market import handlers
 
 from .schema import *
-from .bootstrap import Bootstrap
-
-
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[str, list[WebSocket]] = {}
-
-    async def connect(self, key, websocket: WebSocket):
-        await websocket.accept()
-        if self.active_connections.get(key) is None:
-            self.active_connections[key] = []
-        self.active_connections[key].append(websocket)
-        logger.debug(f'current connections: {len(self.active_connections[key])}')
-
-    def disconnect(self, key, websocket: WebSocket):
-        self.active_connections[key].remove(websocket)
-
-    async def broadcast(self, key, message: dict):
-        if self.active_connections.get(key) is not None:
-            for connection in self.active_connections[key]:
-                await connection.send_json(message)
+from .bootstrap import Bootstrap, create_broadcast_eventbus, market_registry, matching_engine
+from .broadcast import BroadcastHandler, ConnectionManager, MarketFeed, create_broker
+from .lock import MatchingLock
+
+# Taken at startup, a second process matching against the same database refuses to start
+matching_lock = MatchingLock(db.ASYNCPG_DSN)
+# 'postgres' relays every update through the database, it does not make more than one matching process safe
+broker = create_broker(os.environ.get('BROADCAST_BROKER', 'local'), db.ASYNCPG_DSN)
+# Diffs are numbered, a client that falls behind is disconnected and starts over from a snapshot
+market_manager = ConnectionManager('market', broker, policy='CLOSE')
+trs_manager = ConnectionManager('transaction', broker)
+# Only the latest state of an order matters to a client that falls behind
+order_manager = ConnectionManager('order', broker, policy='CONFLATE', conflate_key=lambda x: str(x['uuid']))
+position_manager = ConnectionManager('position', broker)
+MANAGERS = (market_manager, trs_manager, order_manager, position_manager)
+
+PAGE_SIZE = 100
+MAX_PAGE = 1_000
+PROJECTION_ATTEMPTS = 8
+# Orders of one batch are matched in one job, a larger batch would hold the ticker worker for too long
+MAX_BATCH = 100
+
+CHECK_VIOLATION = '23514'
+
+# Most specific first, any other rejection is a well-formed request the book can not accept
+REJECTION_STATUS = ((domain.OrderNotFound, 404), (domain.UnknownTicker, 404), (domain.NotOrderOwner, 403),
+                    (domain.OrderRejected, 422))
+
+
+def parse_cursor(cursor: str | None) -> tuple | None:
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
 
-    @staticmethod
-    async def send_personal_message(message: dict, websocket: WebSocket):
-        await websocket.send_json(message)
 
+def set_next_cursor(response: Response, page: list, limit: int, key: Callable):
+    # A full page may have a successor, the token of its last item is sent in a header to keep the body a plain list
+    if len(page) == limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(*key(page[-1]))
 
-market_manager = ConnectionManager()
-trs_manager = ConnectionManager()
-order_manager = ConnectionManager()
-position_manager = ConnectionManager()
 
 router_market = APIRouter(
     prefix='/market',
@@ -51,16 +71,134 @@ async def get_market(ticker: Ticker) -> domain.Market:
         return market
 
 
+market_feed = MarketFeed(market_manager, matching_engine, get_market, broker=broker,
+                         matching=lambda: matching_lock.held)
+broadcaster = BroadcastHandler(market_feed, trs_manager, order_manager, position_manager)
+
+
+async def broadcast_events(events: list[eventbus.Event]):
+    bus = create_broadcast_eventbus(broadcaster)
+    bus.extend_events(events)
+    await bus.run()
+
+
+async def project_events(events: list[eventbus.Event]):
+    async with db.get_as() as session:
+        bus = Bootstrap(session).get_projection_eventbus()
+        bus.extend_events(events)
+        await bus.run()
+        await session.commit()
+
+
+# The order response waits for matching and the commit only, fan-out and projections follow in the background.
+# Fan-out is not repeated, projections are retried and rebuilt from the transactions if they still fail.
+fanout = eventbus.Dispatcher(broadcast_events)
+projector = eventbus.Dispatcher(project_events, attempts=PROJECTION_ATTEMPTS)
+
+
+async def check_ticker(ticker: Ticker):
+    # Before the engine is asked, a job for an unknown ticker would leave a worker behind
+    if ticker in market_registry:
+        return
+    async with db.get_as() as session:
+        try:
+            await Bootstrap(session).get_command_factory().check_ticker(ticker).execute()
+        except domain.UnknownTicker as err:
+            raise HTTPException(status_code=404, detail=str(err))
+
+
+async def execute_book_command(ticker: Ticker, get_as,
+                               create: Callable[[handlers.CommandFactory], Awaitable]) -> handlers.MarketUpdate:
+    async def job():
+        async with get_as as session:
+            boot = Bootstrap(session)
+            result = None
+            try:
+                result = await create(boot.get_command_factory()).execute()
+                events = await boot.get_eventbus().run()
+                await session.commit()
+            except Exception as err:
+                # A rejection leaves the book as it was, a command that fails after changing it evicts the book itself
+                registry = boot.get_market_registry()
+                if result is not None:
+                    # The book and the ledger already carry the update that is rolled back
+                    registry.evict(ticker)
+                    boot.get_account_ledger().invalidate(result.accounts())
+                if ticker not in registry:
+                    # Depth subscribers are sent the rebuilt book rather than waiting for the next order
+                    market_feed.notify(ticker)
+                if isinstance(err, IntegrityError) and getattr(err.orig, 'sqlstate', None) == CHECK_VIOLATION:
+                    # The ledger missed a change of the balance, the database refused to take the account below zero
+                    raise domain.InsufficientCash(f'order refused by the account balance check: {err.orig}') from err
+                raise
+            boot.get_account_ledger().release(result.accounts())
+            # Put from the ticker worker, so the events of one ticker reach the dispatchers in commit order
+            fanout.put(events)
+            projector.put([x for x in events if x.key == 'TransactionCreated'])
+            return result
+
+    if not matching_lock.held:
+        raise HTTPException(status_code=503, detail='Orders are not matched by this process')
+    await check_ticker(ticker)
+    try:
+        return await matching_engine.execute(ticker, job)
+    except domain.OrderRejected as err:
+        status_code = next(code for error, code in REJECTION_STATUS if isinstance(err, error))
+        raise HTTPException(status_code=status_code, detail=str(err))
+
+
+def matched_orders(result: handlers.MarketUpdate, entities: list[domain.Order]) -> list[OrderSchema]:
+    # Each submitted order as matching left it, its last change in the update is the latest
+    latest = {x.uuid: x for x in result.orders}
+    return [OrderSchema.from_entity(latest.get(x.uuid, x)) for x in entities]
+
+
 @router_market.websocket("/ws/{ticker}")
 async def market_websocket_endpoint(websocket: WebSocket, ticker: str):
-    market = MarketSchema.from_entity(await get_market(ticker))
-    await market_manager.connect(ticker, websocket)
-    await market_manager.send_personal_message(market.model_dump(), websocket)
+    try:
+        await check_ticker(ticker)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    try:
+        await market_feed.subscribe(ticker, websocket)
+    except TimeoutError:
+        # The matching process did not send the snapshot, the client may try again later
+        await websocket.close(code=1013)
+        return
     try:
         while True:
             _data = await websocket.receive_text()
     except WebSocketDisconnect:
-        market_manager.disconnect(ticker, websocket)
+        await market_manager.disconnect(ticker, websocket)
+
+
+@router_market.get("/engine/stats")
+async def get_engine_stats(_user: User = Depends(current_active_user)) -> list[EngineStatsSchema]:
+    return [EngineStatsSchema.from_entity(x) for x in matching_engine.stats()]
+
+
+@router_market.get("/broadcast/stats")
+async def get_broadcast_stats(_user: User = Depends(current_active_user)) -> list[BroadcastStatsSchema]:
+    return [BroadcastStatsSchema.from_entity(x.stats()) for x in MANAGERS]
+
+
+@router_market.get("/{ticker}")
+async def get_market_depth(
+        ticker: Ticker,
+        depth: int = Query(None, ge=1),
+        _user: User = Depends(current_active_user),
+) -> MarketSchema:
+    # Read in the ticker worker, so a lazily loaded book is built by the worker that owns it
+    async def read():
+        market = await get_market(ticker)
+        if not matching_lock.held:
+            # Orders are matched by another process, the book is read again from the database every time
+            market_registry.evict(ticker)
+        return MarketSchema.from_entity(market, depth)
+
+    await check_ticker(ticker)
+    return await matching_engine.execute(ticker, read)
 
 
 router_position = APIRouter(
@@ -76,7 +214,7 @@ async def account_websocket_endpoint(websocket: WebSocket, account_uuid: str):
         while True:
             _data = await websocket.receive_text()
     except WebSocketDisconnect:
-        position_manager.disconnect(account_uuid, websocket)
+        await position_manager.disconnect(account_uuid, websocket)
 
 
 @router_position.get("/{account_uuid}")
@@ -90,6 +228,16 @@ async def get_account_positions(
         return [PositionSchema.from_entity(x) for x in positions]
 
 
+@router_position.post("/rebuild")
+async def rebuild_positions(
+        _user: User = Depends(current_superuser),
+        get_as=Depends(db.get_as),
+):
+    async with get_as as session:
+        await Bootstrap(session).get_command_factory().rebuild_positions().execute()
+        await session.commit()
+
+
 router_order = APIRouter(
     prefix='/order',
     tags=['Order'],
@@ -103,7 +251,7 @@ async def order_websocket_endpoint(websocket: WebSocket, account_uuid: str):
         while True:
             _data = await websocket.receive_text()
     except WebSocketDisconnect:
-        order_manager.disconnect(account_uuid, websocket)
+        await order_manager.disconnect(account_uuid, websocket)
 
 
 @router_order.post("/")
@@ -112,50 +260,67 @@ async def create_order(
         user: User = Depends(current_active_user),
         get_as=Depends(db.get_as)
 ) -> OrderSchema:
-    async with get_as as session:
-        boot = Bootstrap(session)
-        cmd = boot.get_command_factory().send_order(order.to_entity())
-        market = await cmd.execute()
-        await boot.get_eventbus().run()
-        await session.commit()
+    entity = order.to_entity()
+    result = await execute_book_command(order.ticker, get_as, lambda factory: factory.send_order(entity))
+    return matched_orders(result, [entity])[0]
 
-        await market_manager.broadcast(order.ticker, MarketSchema.from_entity(market).model_dump())
-        for trs in market.transactions:
-            data = TransactionSchema.from_entity(trs).model_dump()
-            await trs_manager.broadcast(order.ticker, data)
-            await position_manager.broadcast(trs.buyer, data)
-            await position_manager.broadcast(trs.seller, data)
-        for order in market.orders:
-            await order_manager.broadcast(str(order.account), OrderSchema.from_entity(order).model_dump())
-        return order
+
+@router_order.post("/batch")
+async def create_orders(
+        orders: conlist(OrderSchema, min_length=1, max_length=MAX_BATCH),
+        _user: User = Depends(current_active_user),
+        get_as=Depends(db.get_as)
+) -> list[OrderSchema]:
+    # One book and one worker per batch, a mixed batch is refused before a job is scheduled
+    tickers = {x.ticker for x in orders}
+    if len(tickers) != 1:
+        raise HTTPException(status_code=422, detail=f'order batch must contain one ticker, got {sorted(tickers)}')
+    ticker = orders[0].ticker
+    entities = [x.to_entity() for x in orders]
+    result = await execute_book_command(ticker, get_as, lambda factory: factory.send_orders(entities))
+    return matched_orders(result, entities)
 
 
 @router_order.get("/{account_uuid}")
 async def get_account_orders(
+        response: Response,
+        limit: int = Query(None, ge=1, le=MAX_PAGE),
+        cursor: str = None,
         user: User = Depends(current_active_user),
         get_as=Depends(db.get_as),
 ) -> list[OrderSchema]:
+    filter_by = {"account.uuid": str(user.id)}
     async with get_as as session:
         boot = Bootstrap(session)
-        cmd = boot.get_command_factory().get_many_orders({"account.uuid": str(user.id)})
-        orders = await cmd.execute()
+        if limit is None and cursor is None:
+            orders = await boot.get_command_factory().get_many_orders(filter_by).execute()
+        else:
+            after = parse_cursor(cursor)
+            orders = await boot.get_command_factory().get_orders_page(filter_by, after, limit or PAGE_SIZE).execute()
+            set_next_cursor(response, orders, limit or PAGE_SIZE, lambda x: (x.created, x.uuid))
         return [OrderSchema.from_entity(x) for x in orders]
 
 
 @router_order.patch("/cancel")
 async def cancel_order(
         order: OrderSchema,
-        _user: User = Depends(current_active_user),
+        user: User = Depends(current_active_user),
         get_as=Depends(db.get_as),
 ):
-    async with get_as as session:
-        order.status = 'CANCELED'
-        boot = Bootstrap(session)
-        market = await boot.get_command_factory().cancel_order(order.to_entity()).execute()
-        await boot.get_eventbus().run()
-        await session.commit()
-        await market_manager.broadcast(order.ticker, MarketSchema.from_entity(market).model_dump())
-        await order_manager.broadcast(str(order.account), order.model_dump())
+    # The book order must belong to the caller, whatever account the body names
+    entity = order.to_entity().model_copy(update={'account': user.id})
+    await execute_book_command(order.ticker, get_as, lambda factory: factory.cancel_order(entity))
+
+
+@router_order.patch("/amend")
+async def amend_order(
+        order: OrderSchema,
+        user: User = Depends(current_active_user),
+        get_as=Depends(db.get_as),
+):
+    # The book order must belong to the caller, whatever account the body names
+    entity = order.to_entity().model_copy(update={'account': user.id})
+    await execute_book_command(order.ticker, get_as, lambda factory: factory.amend_order(entity))
 
 
 router_transaction = APIRouter(
@@ -171,7 +336,29 @@ async def trs_websocket_endpoint(websocket: WebSocket, ticker: str):
         while True:
             _ = await websocket.receive_text()
     except WebSocketDisconnect:
-        trs_manager.disconnect(ticker, websocket)
+        await trs_manager.disconnect(ticker, websocket)
+
+
+@router_transaction.get("/export")
+async def export_transactions(
+        ticker: Ticker = None,
+        fmt: ExportFormat = 'ndjson',
+        _user: User = Depends(current_active_user),
+) -> StreamingResponse:
+    filter_by = {'ticker': ticker} if ticker else None
+
+    # The session lives as long as the response body, so it is opened by the generator itself
+    async def generate():
+        async with db.get_as() as session:
+            factory = Bootstrap(session).get_command_factory()
+            cmd = factory.stream_transactions(filter_by, OrderBy(['date', 'id'], asc=True))
+            if fmt == 'csv':
+                yield export_csv_header(domain.TRANSACTION_FIELDS)
+            async for rows in cmd.execute():
+                yield export_rows(rows, fmt)
+
+    media_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return StreamingResponse(generate(), media_type=media_type)
 
 
 @router_transaction.get("/{account_uuid}")
@@ -181,27 +368,36 @@ async def get_account_transactions(
 ) -> list[TransactionSchema]:
     async with get_as as session:
         boot = Bootstrap(session)
-        one = await boot.get_command_factory().get_many_transactions({'buyer.uuid': str(user.id)}).execute()
-        two = await boot.get_command_factory().get_many_transactions({'seller.uuid': str(user.id)}).execute()
-        transactions = one + two
+        filter_by = {'$or': [{'buyer.uuid': str(user.id)}, {'seller.uuid': str(user.id)}]}
+        transactions = await boot.get_command_factory().get_many_transactions(filter_by).execute()
         return [TransactionSchema.from_entity(x) for x in transactions]
 
 
 @router_transaction.get("/")
 async def get_many_transactions(
+        response: Response,
         ticker: Ticker = None,
         slice_from: int = None,
         slice_to: int = None,
         order_by: str = None,
         asc: bool = True,
+        limit: int = Query(None, ge=1, le=MAX_PAGE),
+        cursor: str = None,
         _user: User = Depends(current_active_user),
         get_as=Depends(db.get_as),
 ):
     filter_by = {'ticker': ticker} if ticker else None
-    order_by = OrderBy(order_by, asc) if order_by else None
 
     async with get_as as session:
         boot = Bootstrap(session)
-        cmd = boot.get_command_factory().get_many_transactions(filter_by, order_by, slice_from, slice_to)
-        transactions = await cmd.execute()
+        if limit is None and cursor is None:
+            order_by = OrderBy(order_by, asc) if order_by else None
+            cmd = boot.get_command_factory().get_many_transactions(filter_by, order_by, slice_from, slice_to)
+            transactions = await cmd.execute()
+        else:
+            # Keyset pages are always ordered by (date, uuid), the direction comes from asc
+            after = parse_cursor(cursor)
+            cmd = boot.get_command_factory().get_transactions_page(filter_by, after, limit or PAGE_SIZE, asc)
+            transactions = await cmd.execute()
+            set_next_cursor(response, transactions, limit or PAGE_SIZE, lambda x: (x.date, x.uuid))
         return [TransactionSchema.from_entity(x) for x in transactions]
@@ -1,10 +1,16 @@
+import base64
+import binascii
+import csv
+import io
+import json
 from datetime import datetime
+from typing import Literal, NamedTuple, Sequence
 from uuid import UUID, uuid4
 
 from pydantic import BaseModel, field_serializer, Field
 
 from src.core import Ticker
-from .. import domain
+from .. import domain, engine
 
 
 class OrderSchema(BaseModel):
@@ -117,11 +123,113 @@ class MarketSchema(BaseModel):
     sell_level: list[tuple[float, int]]
 
     @classmethod
-    def from_entity(cls, market: domain.Market):
-        buy_level = [(price, quantity) for price, quantity in market.buy_level.items()]
-        sell_level = [(price, quantity) for price, quantity in market.sell_level.items()]
+    def from_entity(cls, market: domain.Market, depth: int = None):
+        if depth is None:
+            buy_level = list(market.buy_level.items())
+            sell_level = list(market.sell_level.items())
+        else:
+            buy_level = market.top_buy_levels(depth)[::-1]
+            sell_level = market.top_sell_levels(depth)
         return cls(
             ticker=market.ticker,
             buy_level=buy_level,
             sell_level=sell_level,
         )
+
+
+class MarketSnapshotSchema(BaseModel):
+    type: Literal['snapshot'] = 'snapshot'
+    ticker: Ticker
+    sequence: int
+    buy_level: list[tuple[float, int]]
+    sell_level: list[tuple[float, int]]
+
+    @classmethod
+    def from_entity(cls, market: domain.Market, sequence: int):
+        return cls(
+            ticker=market.ticker,
+            sequence=sequence,
+            buy_level=list(market.buy_level.items()),
+            sell_level=list(market.sell_level.items()),
+        )
+
+
+class MarketDiffSchema(BaseModel):
+    """Absolute quantity of the levels changed since the previous sequence, 0 for a removed level"""
+    type: Literal['diff'] = 'diff'
+    ticker: Ticker
+    sequence: int
+    buy_level: list[tuple[float, int]]
+    sell_level: list[tuple[float, int]]
+
+
+class EngineStatsSchema(BaseModel):
+    ticker: Ticker
+    queue_depth: int
+    processed: int
+    last_latency: float
+    avg_latency: float
+    max_latency: float
+
+    @classmethod
+    def from_entity(cls, entity: engine.EngineStats):
+        return cls(
+            ticker=entity.ticker,
+            queue_depth=entity.queue_depth,
+            processed=entity.processed,
+            last_latency=entity.last_latency,
+            avg_latency=entity.avg_latency,
+            max_latency=entity.max_latency,
+        )
+
+
+class BroadcastStatsSchema(BaseModel):
+    channel: str
+    connections: int
+    queued: int
+    max_queued: int
+    dropped: int
+    closed: int
+
+    @classmethod
+    def from_entity(cls, entity: NamedTuple):
+        return cls(**entity._asdict())
+
+
+ExportFormat = Literal['ndjson', 'csv']
+
+
+def _export_value(value):
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def export_csv_header(fields: Sequence[str]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(fields)
+    return buffer.getvalue()
+
+
+def export_rows(rows: Sequence[NamedTuple], fmt: ExportFormat) -> str:
+    if fmt == 'ndjson':
+        return ''.join(json.dumps({k: _export_value(v) for k, v in row._asdict().items()}) + '\n' for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_export_value(v) for v in row] for row in rows)
+    return buffer.getvalue()
+
+
+def encode_cursor(moment: datetime, uuid: UUID) -> str:
+    """Opaque continuation token of a (timestamp, uuid) keyset"""
+    data = json.dumps([moment.isoformat(), str(uuid)]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(token: str) -> tuple[datetime, UUID]:
+    try:
+        moment, uuid = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return datetime.fromisoformat(moment), UUID(uuid)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as err:
+        raise ValueError(f'invalid cursor {token!r}') from err
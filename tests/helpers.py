@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+from src.market import domain
+
+
+def create_order(direction, price, quantity, **update) -> domain.Order:
+    order = domain.Order(
+        uuid=uuid4(),
+        account=uuid4(),
+        ticker='ABC',
+        dtype='LIMIT',
+        direction=direction,
+        price=price,
+        quantity=quantity,
+        created=datetime.now(),
+    )
+    return order.model_copy(update=update) if update else order
+
+
+class FakePostgres:
+    """Stands in for asyncpg.connect, NOTIFY reaches the listeners of every open connection and locks go with theirs"""
+
+    def __init__(self):
+        self.connections = []
+        self.locks = {}
+        self.refuse = False
+
+    async def connect(self, dsn):
+        if self.refuse:
+            raise ConnectionRefusedError
+        connection = FakeConnection(self)
+        self.connections.append(connection)
+        return connection
+
+    def notify(self, channel, payload):
+        loop = asyncio.get_running_loop()
+        for connection in self.connections:
+            for callback in connection.listeners.get(channel, ()):
+                loop.call_soon(callback, connection, 0, channel, payload)
+
+    def drop_all(self):
+        for connection in list(self.connections):
+            connection.terminate()
+
+
+class FakeConnection:
+    def __init__(self, server: FakePostgres):
+        self.server = server
+        self.listeners = {}
+        self.on_terminate = []
+        self.closed = False
+
+    async def add_listener(self, channel, callback):
+        self.listeners.setdefault(channel, []).append(callback)
+
+    def add_termination_listener(self, callback):
+        self.on_terminate.append(callback)
+
+    async def fetchval(self, query, key):
+        assert query == 'SELECT pg_try_advisory_lock($1)'
+        return self.server.locks.setdefault(key, self) is self
+
+    async def executemany(self, query, args):
+        if self.closed:
+            raise ConnectionResetError
+        assert query == 'SELECT pg_notify($1, $2)'
+        for channel, payload in args:
+            assert len(payload.encode()) < 8000
+            self.server.notify(channel, payload)
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self, timeout=None):
+        self.terminate()
+
+    def terminate(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.connections.remove(self)
+        self.server.locks = {k: v for k, v in self.server.locks.items() if v is not self}
+        for callback in self.on_terminate:
+            asyncio.get_running_loop().call_soon(callback, self)
@@ -0,0 +1,350 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from src.base import eventbus
+from src.market import domain, engine
+from src.market.infrastructure import broadcast
+from src.market.infrastructure.broadcast import ConnectionManager, MarketFeed
+from tests.helpers import FakePostgres, create_order
+
+
+class FakeWebSocket:
+    def __init__(self, blocked: bool = False, broken: bool = False):
+        self.messages = []
+        self.closed_with = None
+        self.broken = broken
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        await self.unblocked.wait()
+        if self.broken:
+            raise ConnectionResetError
+        self.messages.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+class TestEncode:
+    def test_fallback_encoder_matches_orjson(self, monkeypatch):
+        message = {'uuid': uuid4(), 'date': datetime(2024, 1, 2, 3, 4, 5, 6), 'price': 1.5, 'level': (1, 2)}
+        encoded = broadcast.encode(message)
+        monkeypatch.setattr(broadcast, 'orjson', None)
+        assert json.loads(broadcast.encode(message)) == json.loads(encoded)
+        assert broadcast.encode(encoded) is encoded
+
+
+class TestConnectionManager:
+    def run_slow_client(self, manager: ConnectionManager, messages: list[dict]):
+        async def main():
+            slow, fast = FakeWebSocket(blocked=True), FakeWebSocket()
+            manager.add('ABC', slow)
+            manager.add('ABC', fast)
+            for message in messages:
+                manager.broadcast('ABC', message)
+                await asyncio.sleep(0)
+            stats = manager.stats()
+            slow.unblocked.set()
+            await asyncio.sleep(0.01)
+            await manager.disconnect('ABC', slow)
+            await manager.disconnect('ABC', fast)
+            return slow, fast, stats
+
+        return asyncio.run(main())
+
+    def test_slow_client_drops_its_oldest_messages_only(self):
+        messages = [{'n': i} for i in range(5)]
+        slow, fast, stats = self.run_slow_client(ConnectionManager('test', maxsize=2), messages)
+        assert fast.messages == messages
+        # The writer had taken the first message before the client stalled
+        assert slow.messages == [{'n': 0}, {'n': 3}, {'n': 4}]
+        assert (stats.connections, stats.queued, stats.dropped, stats.closed) == (2, 2, 2, 0)
+
+    def test_conflation_keeps_the_latest_message_per_key(self):
+        messages = [{'uuid': 'a', 'n': 0}, {'uuid': 'a', 'n': 1}, {'uuid': 'b', 'n': 2}, {'uuid': 'a', 'n': 3}]
+        manager = ConnectionManager('test', maxsize=2, policy='CONFLATE', conflate_key=lambda x: x['uuid'])
+        slow, fast, stats = self.run_slow_client(manager, messages)
+        assert fast.messages == messages
+        assert slow.messages == [{'uuid': 'a', 'n': 0}, {'uuid': 'a', 'n': 3}, {'uuid': 'b', 'n': 2}]
+        assert stats.dropped == 1
+
+    def test_client_that_falls_behind_is_closed(self):
+        messages = [{'n': i} for i in range(4)]
+        slow, fast, stats = self.run_slow_client(ConnectionManager('test', maxsize=2, policy='CLOSE'), messages)
+        assert fast.messages == messages
+        assert slow.messages == [{'n': 0}]
+        assert slow.closed_with == 1013
+        assert (stats.dropped, stats.closed) == (3, 1)
+
+    def test_connection_whose_writer_stops_is_closed_and_removed(self):
+        async def main():
+            manager = ConnectionManager('test', maxsize=1, policy='CLOSE')
+            broken, slow, fast = FakeWebSocket(broken=True), FakeWebSocket(blocked=True), FakeWebSocket()
+            for websocket in (broken, slow, fast):
+                manager.add('ABC', websocket)
+            for i in range(3):
+                manager.broadcast('ABC', {'n': i})
+                await asyncio.sleep(0)
+            slow.unblocked.set()
+            await asyncio.sleep(0.01)
+            stats = manager.stats()
+            await manager.disconnect('ABC', fast)
+            return broken, slow, stats, manager.stats()
+
+        broken, slow, stats, empty = asyncio.run(main())
+        assert (broken.closed_with, slow.closed_with) == (1011, 1013)
+        assert (stats.connections, stats.closed) == (1, 1)
+        assert empty.connections == 0
+
+    def test_conflation_needs_a_key(self):
+        with pytest.raises(ValueError):
+            ConnectionManager('test', policy='CONFLATE')
+
+
+class TestMarketFeed:
+    def run_feed(self, scenario):
+        async def main():
+            books = {'ABC': domain.Market(ticker='ABC', orders=[create_order('SELL', 20, 10)])}
+
+            async def get_market(ticker):
+                return books[ticker]
+
+            matching_engine = engine.MatchingEngine()
+            feed = MarketFeed(ConnectionManager('market'), matching_engine, get_market, interval=0.01)
+            websocket = FakeWebSocket()
+            await feed.subscribe('ABC', websocket)
+            await scenario(feed, books)
+            await asyncio.sleep(0.05)
+            await feed.stop()
+            await matching_engine.stop()
+            return websocket.messages
+
+        return asyncio.run(main())
+
+    def test_burst_of_orders_is_one_diff_after_the_snapshot(self):
+        async def scenario(feed, books):
+            for price in (20, 19, 19):
+                books['ABC'].send_order(create_order('BUY', price, 2))
+                feed.notify('ABC')
+
+        snapshot, diff = self.run_feed(scenario)
+        assert snapshot == {'type': 'snapshot', 'ticker': 'ABC', 'sequence': 0, 'buy_level': [],
+                            'sell_level': [[20, 10]]}
+        assert diff == {'type': 'diff', 'ticker': 'ABC', 'sequence': 1, 'buy_level': [[19, 4]],
+                        'sell_level': [[20, 8]]}
+
+    def test_rebuilt_book_is_sent_as_a_new_snapshot(self):
+        async def scenario(feed, books):
+            books['ABC'] = domain.Market(ticker='ABC', orders=[create_order('BUY', 10, 1)])
+            feed.notify('ABC')
+            await asyncio.sleep(0.05)
+            feed.notify('ABC')
+
+        messages = self.run_feed(scenario)
+        assert [(x['type'], x['sequence']) for x in messages] == [('snapshot', 0), ('snapshot', 1)]
+        assert messages[1]['buy_level'] == [[10, 1]]
+
+
+async def wait_for(condition, timeout=1):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.005)
+
+
+class TestPostgresBroker:
+    @pytest.fixture
+    def server(self, monkeypatch):
+        server = FakePostgres()
+        monkeypatch.setattr(broadcast.asyncpg, 'connect', server.connect)
+        monkeypatch.setattr(broadcast, 'RECONNECT_DELAY', 0.01)
+        return server
+
+    def test_long_messages_are_chunked_and_reach_every_process(self, server):
+        async def main():
+            brokers = [broadcast.PostgresBroker('postgresql://localhost/test') for _ in range(2)]
+            markets = [ConnectionManager('market', x) for x in brokers]
+            order = ConnectionManager('order', brokers[0])
+            sockets = [FakeWebSocket() for _ in brokers]
+            for broker, market, websocket in zip(brokers, markets, sockets):
+                await broker.start()
+                market.add('ABC', websocket)
+            markets[0].broadcast('ABC', {'levels': ['é' * 10] * 3_000})
+            markets[0].broadcast('ABC', {'n': 1})
+            # Nobody subscribes to this key here, a subscriber may be connected to another process
+            order.broadcast('XYZ', {'n': 2})
+            await wait_for(lambda: all(len(x.messages) == 2 for x in sockets))
+            for broker in brokers:
+                await broker.stop()
+            return [x.messages for x in sockets], server.connections
+
+        messages, connections = asyncio.run(main())
+        assert messages == [[{'levels': ['é' * 10] * 3_000}, {'n': 1}]] * 2
+        assert connections == []
+
+    def test_lost_connections_are_reopened_and_listen_again(self, server):
+        async def main():
+            pg_broker = broadcast.PostgresBroker('postgresql://localhost/test')
+            market = ConnectionManager('market', pg_broker)
+            websocket = FakeWebSocket()
+            market.add('ABC', websocket)
+            await pg_broker.start()
+            server.refuse = True
+            server.drop_all()
+            # Queued while the database is out of reach, sent once the broker is connected again
+            market.broadcast('ABC', {'n': 1})
+            await asyncio.sleep(0.05)
+            delivered_while_down = list(websocket.messages)
+            server.refuse = False
+            await wait_for(lambda: len(websocket.messages) == 1)
+            market.broadcast('ABC', {'n': 2})
+            await wait_for(lambda: len(websocket.messages) == 2)
+            await pg_broker.stop()
+            return delivered_while_down, websocket.messages
+
+        delivered_while_down, messages = asyncio.run(main())
+        assert delivered_while_down == []
+        assert messages == [{'n': 1}, {'n': 2}]
+
+    def test_incomplete_messages_are_given_up(self, server, monkeypatch):
+        monkeypatch.setattr(broadcast, 'CHUNK_TIMEOUT', 0)
+
+        async def main():
+            pg_broker = broadcast.PostgresBroker('postgresql://localhost/test')
+            market = ConnectionManager('market', pg_broker)
+            websocket = FakeWebSocket()
+            market.add('ABC', websocket)
+            await pg_broker.start()
+            # Another process lost its connection after the first of two chunks
+            other = await server.connect('postgresql://localhost/test')
+            await other.executemany('SELECT pg_notify($1, $2)', [('broadcast', 'other-0:0:2:["market"')])
+            await wait_for(lambda: pg_broker.pending_chunks() == 1)
+            # The tail of a message whose head was never received is ignored
+            await other.executemany('SELECT pg_notify($1, $2)', [('broadcast', 'other-1:1:2:,"ABC",null,"{}"]')])
+            market.broadcast('ABC', {'levels': ['x'] * 5_000})
+            await wait_for(lambda: len(websocket.messages) == 1)
+            pending = pg_broker.pending_chunks()
+            await pg_broker.stop()
+            return pending, websocket.messages
+
+        pending, messages = asyncio.run(main())
+        assert pending == 0
+        assert messages == [{'levels': ['x'] * 5_000}]
+
+    def test_snapshot_and_sequences_come_from_the_matching_process(self, server):
+        async def main():
+            books = {'ABC': domain.Market(ticker='ABC', orders=[create_order('SELL', 20, 10)])}
+
+            async def get_market(ticker):
+                return books[ticker]
+
+            async def stale_market(ticker):
+                return domain.Market(ticker=ticker, orders=[])
+
+            brokers = [broadcast.PostgresBroker('postgresql://localhost/test') for _ in range(2)]
+            engines = [engine.MatchingEngine() for _ in brokers]
+            matching = MarketFeed(ConnectionManager('market', brokers[0]), engines[0], get_market, interval=0.01,
+                                  broker=brokers[0])
+            other = MarketFeed(ConnectionManager('market', brokers[1]), engines[1], stale_market, interval=0.01,
+                               broker=brokers[1], matching=lambda: False)
+            for pg_broker in brokers:
+                await pg_broker.start()
+            books['ABC'].send_order(create_order('BUY', 19, 2))
+            matching.notify('ABC')
+            await asyncio.sleep(0.05)
+
+            websocket = FakeWebSocket()
+            await other.subscribe('ABC', websocket)
+            # Not numbered here, the diff comes from the matching process
+            other.notify('ABC')
+            books['ABC'].send_order(create_order('BUY', 20, 3))
+            matching.notify('ABC')
+            await wait_for(lambda: len(websocket.messages) == 2)
+            for feed, pg_broker, matching_engine in zip((matching, other), brokers, engines):
+                await feed.stop()
+                await pg_broker.stop()
+                await matching_engine.stop()
+            return websocket.messages
+
+        snapshot, diff = asyncio.run(main())
+        assert snapshot == {'type': 'snapshot', 'ticker': 'ABC', 'sequence': 1, 'buy_level': [[19, 2]],
+                            'sell_level': [[20, 10]]}
+        assert diff == {'type': 'diff', 'ticker': 'ABC', 'sequence': 2, 'buy_level': [], 'sell_level': [[20, 7]]}
+
+    def test_subscriber_gives_up_without_the_matching_process(self, server, monkeypatch):
+        monkeypatch.setattr(broadcast, 'SNAPSHOT_TIMEOUT', 0.05)
+
+        async def main():
+            pg_broker = broadcast.PostgresBroker('postgresql://localhost/test')
+            manager = ConnectionManager('market', pg_broker)
+            feed = MarketFeed(manager, engine.MatchingEngine(), None, broker=pg_broker, matching=lambda: False)
+            await pg_broker.start()
+            with pytest.raises(TimeoutError):
+                await feed.subscribe('ABC', FakeWebSocket())
+            await pg_broker.stop()
+            return manager.stats().connections
+
+        assert asyncio.run(main()) == 0
+
+    @pytest.mark.skipif('TEST_DATABASE_URL' not in os.environ, reason='needs a Postgres server')
+    def test_listen_notify_round_trip(self):
+        async def main():
+            brokers = [broadcast.PostgresBroker(os.environ['TEST_DATABASE_URL'], 'broadcast_test') for _ in range(2)]
+            markets = [ConnectionManager('market', x) for x in brokers]
+            websocket = FakeWebSocket()
+            markets[1].add('ABC', websocket)
+            for broker in brokers:
+                await broker.start()
+            markets[0].broadcast('ABC', {'levels': ['é' * 10] * 3_000})
+            await wait_for(lambda: len(websocket.messages) == 1, timeout=5)
+            for broker in brokers:
+                await broker.stop()
+            return websocket.messages
+
+        assert asyncio.run(main()) == [{'levels': ['é' * 10] * 3_000}]
+
+
+class TestBroadcastHandler:
+    def test_committed_fill_reaches_every_channel(self):
+        async def main():
+            broker = broadcast.LocalBroker()
+            managers = {x: ConnectionManager(x, broker) for x in ('market', 'transaction', 'order', 'position')}
+            sockets = {x: FakeWebSocket() for x in managers}
+            buyer, seller = uuid4(), uuid4()
+            maker = create_order('SELL', 10, 5, account=seller)
+            books = {'ABC': domain.Market(ticker='ABC', orders=[maker])}
+
+            async def get_market(ticker):
+                return books[ticker]
+
+            feed = MarketFeed(managers['market'], engine.MatchingEngine(), get_market, interval=0.01)
+            await feed.subscribe('ABC', sockets['market'])
+            managers['transaction'].add('ABC', sockets['transaction'])
+            managers['order'].add(str(seller), sockets['order'])
+            managers['position'].add(str(buyer), sockets['position'])
+
+            books['ABC'].send_order(create_order('BUY', 10, 1, account=buyer))
+            trs, = books['ABC'].parse_transactions()
+            handler = broadcast.BroadcastHandler(feed, managers['transaction'], managers['order'],
+                                                 managers['position'])
+            await handler.handle_orders([eventbus.Updated(key='OrderUpdated', entity=maker)])
+            await handler.handle_transactions_created([eventbus.Created(key='TransactionCreated', entity=trs)])
+            await asyncio.sleep(0.05)
+            await feed.stop()
+            return sockets, trs
+
+        sockets, trs = asyncio.run(main())
+        assert [(x['type'], x['sequence']) for x in sockets['market'].messages] == [('snapshot', 0), ('diff', 1)]
+        assert sockets['market'].messages[1]['sell_level'] == [[10, 4]]
+        assert sockets['transaction'].messages == sockets['position'].messages
+        assert [x['uuid'] for x in sockets['transaction'].messages] == [str(trs.uuid)]
+        assert [x['status'] for x in sockets['order'].messages] == ['PENDING']
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from src.market import engine
+
+
+class TestMatchingEngine:
+    def test_jobs_of_one_ticker_are_serialized(self):
+        async def main():
+            matching_engine = engine.MatchingEngine()
+            running = []
+            trace = []
+
+            def make_job(i):
+                async def job():
+                    running.append(i)
+                    assert len(running) == 1
+                    await asyncio.sleep(0.001)
+                    trace.append(i)
+                    running.remove(i)
+                    return i
+
+                return job
+
+            results = await asyncio.gather(*[matching_engine.execute('ABC', make_job(i)) for i in range(10)])
+            await matching_engine.stop()
+            return results, trace
+
+        results, trace = asyncio.run(main())
+        assert results == list(range(10))
+        assert trace == list(range(10))
+
+    def test_different_tickers_run_concurrently(self):
+        async def main():
+            matching_engine = engine.MatchingEngine()
+            started = asyncio.Event()
+
+            async def blocker():
+                await started.wait()
+                return 'ABC'
+
+            async def releaser():
+                started.set()
+                return 'XYZ'
+
+            results = await asyncio.gather(
+                matching_engine.execute('ABC', blocker),
+                matching_engine.execute('XYZ', releaser),
+            )
+            await matching_engine.stop()
+            return results
+
+        assert asyncio.run(main()) == ['ABC', 'XYZ']
+
+    def test_job_error_is_raised_to_caller_and_worker_survives(self):
+        async def main():
+            matching_engine = engine.MatchingEngine()
+
+            async def failing():
+                raise ValueError
+
+            async def ok():
+                return 1
+
+            with pytest.raises(ValueError):
+                await matching_engine.execute('ABC', failing)
+            result = await matching_engine.execute('ABC', ok)
+            stats = matching_engine.stats()
+            await matching_engine.stop()
+            return result, stats
+
+        result, stats = asyncio.run(main())
+        assert result == 1
+        assert len(stats) == 1
+        assert stats[0].ticker == 'ABC'
+        assert stats[0].processed == 2
+        assert stats[0].queue_depth == 0
+        assert stats[0].max_latency >= stats[0].avg_latency > 0
+
+    def test_stop_lets_the_running_job_finish_and_cancels_the_queued_ones(self):
+        async def main():
+            matching_engine = engine.MatchingEngine()
+            started = asyncio.Event()
+            release = asyncio.Event()
+
+            async def running():
+                started.set()
+                await release.wait()
+                return 'done'
+
+            async def queued():
+                return 'queued'
+
+            first = asyncio.create_task(matching_engine.execute('ABC', running))
+            second = asyncio.create_task(matching_engine.execute('ABC', queued))
+            await started.wait()
+            stopping = asyncio.create_task(matching_engine.stop())
+            await asyncio.sleep(0)
+            release.set()
+            await stopping
+            return await first, await asyncio.gather(second, return_exceptions=True)
+
+        first, (second,) = asyncio.run(main())
+        assert first == 'done'
+        assert isinstance(second, asyncio.CancelledError)
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from src.base import eventbus
+
+
+class TestEventBus:
+    def test_batch_handlers_receive_grouped_events_in_registration_order(self):
+        queue = eventbus.Queue()
+        bus = eventbus.EventBus(queue)
+        calls = []
+
+        async def handle_created(events):
+            calls.append(('created', [x.entity for x in events]))
+            queue.append(eventbus.Created(key='Followup', entity=0))
+
+        async def handle_deleted(events):
+            calls.append(('deleted', [x.entity for x in events]))
+
+        async def handle_followup(event):
+            calls.append(('followup', event.entity))
+
+        bus.register_batch('Created', handle_created)
+        bus.register_batch('Deleted', handle_deleted)
+        bus.register('Followup', handle_followup)
+        bus.extend_events([
+            eventbus.Deleted(key='Deleted', entity=1),
+            eventbus.Created(key='Created', entity=2),
+            eventbus.Deleted(key='Deleted', entity=3),
+            eventbus.Created(key='Created', entity=4),
+        ])
+        handled = asyncio.run(bus.run())
+        assert calls == [('created', [2, 4]), ('deleted', [1, 3]), ('followup', 0)]
+        assert [x.entity for x in handled] == [1, 2, 3, 4, 0]
+        assert queue.empty
+
+    def test_event_without_handler_is_rejected(self):
+        bus = eventbus.EventBus(eventbus.Queue())
+        bus.extend_events([eventbus.Created(key='Unknown', entity=1)])
+        with pytest.raises(KeyError):
+            asyncio.run(bus.run())
+
+
+class TestDispatcher:
+    def test_batches_queued_meanwhile_are_handled_together_and_errors_are_contained(self):
+        async def main():
+            calls = []
+            release = asyncio.Event()
+
+            async def handle(events):
+                calls.append([x.entity for x in events])
+                if len(calls) == 1:
+                    await release.wait()
+                    raise ValueError
+
+            dispatcher = eventbus.Dispatcher(handle)
+            dispatcher.put([eventbus.Created(key='Created', entity=1)])
+            await asyncio.sleep(0)
+            dispatcher.put([eventbus.Created(key='Created', entity=2)])
+            dispatcher.put([])
+            dispatcher.put([eventbus.Created(key='Created', entity=3), eventbus.Created(key='Created', entity=4)])
+            release.set()
+            await dispatcher.join()
+            await dispatcher.stop()
+            return calls
+
+        assert asyncio.run(main()) == [[1], [2, 3, 4]]
+
+    def test_failed_batch_is_handled_again_before_the_next_one(self):
+        async def main():
+            calls = []
+
+            async def handle(events):
+                calls.append([x.entity for x in events])
+                if len(calls) < 3:
+                    raise ConnectionError
+
+            dispatcher = eventbus.Dispatcher(handle, attempts=3, retry_delay=0)
+            dispatcher.put([eventbus.Created(key='Created', entity=1)])
+            await asyncio.sleep(0)
+            dispatcher.put([eventbus.Created(key='Created', entity=2)])
+            await dispatcher.join()
+            await dispatcher.stop()
+            return calls, dispatcher.lost
+
+        assert asyncio.run(main()) == ([[1], [1], [1], [2]], 0)
+
+    def test_batch_is_lost_once_attempts_run_out(self):
+        async def main():
+            async def handle(events):
+                raise ConnectionError
+
+            dispatcher = eventbus.Dispatcher(handle, attempts=2, retry_delay=0)
+            dispatcher.put([eventbus.Created(key='Created', entity=1), eventbus.Created(key='Created', entity=2)])
+            await dispatcher.join()
+            await dispatcher.stop()
+            return dispatcher.lost
+
+        assert asyncio.run(main()) == 2
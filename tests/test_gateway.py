@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from sqlalchemy.dialects import postgresql
+
+from src.market import domain
+from src.market.infrastructure.gateway import AccountGatewayM, DealGatewayM
+
+
+class RecordingResult:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def all(self):
+        return self._rows
+
+
+class RecordingSession:
+    def __init__(self, rows: int = 0):
+        self.statements = []
+        self._rows = rows
+
+    async def execute(self, stmt, *args):
+        self.statements.append(stmt.compile(dialect=postgresql.dialect()))
+        return RecordingResult([None] * self._rows)
+
+
+class TestDealGateway:
+    def test_fills_of_a_batch_become_one_upsert_per_account_and_ticker(self):
+        buyer, seller = uuid4(), uuid4()
+        transactions = [
+            domain.Transaction(ticker='ABC', date=datetime.now(), price=10, quantity=2, buyer=buyer, seller=seller),
+            domain.Transaction(ticker='ABC', date=datetime.now(), price=11, quantity=1, buyer=buyer, seller=seller),
+        ]
+        session = RecordingSession()
+        asyncio.run(DealGatewayM(session).create_deals_from_transactions(transactions))
+
+        assert len(session.statements) == 1
+        stmt = session.statements[0]
+        assert 'ON CONFLICT ON CONSTRAINT uq_deal_table_account_ticker DO UPDATE' in str(stmt)
+        rows = {stmt.params[f'account_m{i}']: (stmt.params[f'weighted_price_m{i}'], stmt.params[f'total_quantity_m{i}'])
+                for i in range(2)}
+        assert rows == {buyer: (31, 3), seller: (-31, -3)}
+
+
+class TestAccountGateway:
+    def test_sweep_over_many_makers_is_one_update(self):
+        taker = uuid4()
+        makers = [uuid4() for _ in range(50)]
+        transactions = [
+            domain.Transaction(ticker='ABC', date=datetime.now(), price=10, quantity=1, buyer=taker, seller=maker)
+            for maker in makers
+        ]
+        session = RecordingSession(rows=51)
+        asyncio.run(AccountGatewayM(session).change_accounts_data(transactions))
+
+        assert len(session.statements) == 1
+        stmt = session.statements[0]
+        assert str(stmt).startswith('UPDATE account SET')
+        assert 'FROM (VALUES' in str(stmt)
+        params = list(stmt.params.values())
+        rows = {params[i]: tuple(params[i + 1:i + 4]) for i in range(0, len(params), 4)}
+        assert rows[taker] == (-500, 500, 0)
+        assert all(rows[maker] == (-10, 0, 10) for maker in makers)
+
+    def test_missing_account_is_an_error(self):
+        transactions = [
+            domain.Transaction(ticker='ABC', date=datetime.now(), price=10, quantity=1, buyer=uuid4(), seller=uuid4()),
+        ]
+        with pytest.raises(LookupError):
+            asyncio.run(AccountGatewayM(RecordingSession(rows=1)).change_accounts_data(transactions))
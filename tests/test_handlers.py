@@ -0,0 +1,258 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from src.base import eventbus
+from src.market import domain, handlers
+from tests.helpers import create_order
+
+
+class FakeOrderRepo:
+    def __init__(self, orders: list[domain.Order] = None):
+        self.orders = orders or []
+
+    async def get_rows(self, columns, filter_by=None, order_by=None, *args):
+        orders = [x for x in self.orders if x.status in filter_by['status.$__in']]
+        if 'ticker' in filter_by:
+            return [x for x in orders if x.ticker == filter_by['ticker']]
+        return [x for x in orders if str(x.account) in filter_by['account.$__in']]
+
+    async def stream_rows(self, columns, filter_by=None, order_by=None, chunk_size=2):
+        for i in range(0, len(self.orders), chunk_size):
+            yield self.orders[i:i + chunk_size]
+
+
+class FakeCommodityGateway(handlers.CommodityGateway):
+    async def get_book_specs(self, tickers=None):
+        specs = {'ABC': domain.BookSpec(), 'XYZ': domain.BookSpec(tick_size=0.5, book='LADDER')}
+        return {k: v for k, v in specs.items() if tickers is None or k in tickers}
+
+
+class FakeAccountGateway(handlers.AccountGateway):
+    def __init__(self, cash: dict = None, default: float = 1_000_000):
+        self.cash = cash or {}
+        self.default = default
+        self.loaded = []
+
+    async def change_accounts_data(self, transactions):
+        pass
+
+    async def get_accounts_cash(self, accounts):
+        self.loaded.extend(accounts)
+        return {x: self.cash.get(x, self.default) for x in accounts}
+
+
+def create_factory(orders=None, acc_gw=None, registry=None, ledger=None) -> handlers.CommandFactory:
+    return handlers.CommandFactory(
+        registry=registry if registry is not None else handlers.MarketRegistry(),
+        ledger=ledger if ledger is not None else handlers.AccountLedger(),
+        order_repo=FakeOrderRepo(orders),
+        commodity_gw=FakeCommodityGateway(),
+        trs_repo=None,
+        position_repo=None,
+        acc_gw=acc_gw or FakeAccountGateway(),
+        queue=eventbus.Queue(),
+    )
+
+
+class TestSendOrdersCommand:
+    def test_batch_is_matched_in_sequence_against_one_book(self):
+        ledger = handlers.AccountLedger()
+        factory = create_factory([create_order('SELL', 20, 10)], ledger=ledger)
+        batch = [
+            create_order('BUY', 19, 5),
+            create_order('BUY', 20, 4),
+            create_order('SELL', 21, 7),
+            create_order('BUY', 21, 10),
+        ]
+        update = asyncio.run(factory.send_orders(batch).execute())
+        assert [(x.price, x.quantity) for x in update.transactions] == [(20, 4), (20, 6), (21, 4)]
+        assert dict(update.market.buy_level) == {19: 5}
+        assert dict(update.market.sell_level) == {21: 3}
+        assert all(x.account in ledger for x in batch)
+
+    def test_batch_with_several_tickers_is_rejected(self):
+        registry = handlers.MarketRegistry()
+        factory = create_factory(registry=registry)
+        batch = [create_order('BUY', 19, 5), create_order('BUY', 19, 5, ticker='XYZ')]
+        with pytest.raises(domain.OrderRejected):
+            asyncio.run(factory.send_orders(batch).execute())
+        assert 'ABC' not in registry
+
+    def test_malformed_order_refuses_the_batch_before_matching(self):
+        factory = create_factory([create_order('SELL', 20, 10)])
+        market = asyncio.run(factory.get_market_by_ticker('ABC').execute())
+        batch = [create_order('BUY', 20, 4), create_order('BUY', 20.005, 1)]
+        with pytest.raises(domain.OrderRejected):
+            asyncio.run(factory.send_orders(batch).execute())
+        assert asyncio.run(factory.get_market_by_ticker('ABC').execute()) is market
+        assert dict(market.sell_level) == {20: 10}
+
+
+class TestMarketRegistry:
+    def test_warm_up_builds_every_listed_book_from_streamed_rows(self):
+        orders = [create_order('BUY', 10, 1) for _ in range(3)] + [create_order('SELL', 11, 2)]
+        orders += [create_order('BUY', 1, 1, ticker='OTHER')]
+        registry = handlers.MarketRegistry()
+        asyncio.run(registry.warm_up(FakeOrderRepo(orders), FakeCommodityGateway()))
+        assert 'ABC' in registry and 'XYZ' in registry and 'OTHER' in registry
+
+        market = asyncio.run(registry.get_market('ABC', FakeOrderRepo(), FakeCommodityGateway()))
+        assert dict(market.buy_level) == {10: 3}
+        assert dict(market.sell_level) == {11: 2}
+        market = asyncio.run(registry.get_market('XYZ', FakeOrderRepo(), FakeCommodityGateway()))
+        assert (market.tick_size, market.book) == (0.5, 'LADDER')
+
+    def test_unknown_ticker_gets_no_book(self):
+        registry = handlers.MarketRegistry()
+        with pytest.raises(domain.UnknownTicker):
+            asyncio.run(registry.check_ticker('NOPE', FakeCommodityGateway()))
+        with pytest.raises(domain.UnknownTicker):
+            asyncio.run(registry.get_market('NOPE', FakeOrderRepo(), FakeCommodityGateway()))
+        assert 'NOPE' not in registry
+        asyncio.run(registry.check_ticker('ABC', FakeCommodityGateway()))
+
+
+class TestAccountLedger:
+    def test_open_orders_hold_cash_and_fills_spend_it(self):
+        maker = create_order('SELL', 10, 5)
+        taker = create_order('BUY', 10, 3)
+        acc_gw = FakeAccountGateway({maker.account: 100, taker.account: 100})
+        ledger = handlers.AccountLedger()
+        factory = create_factory([maker], acc_gw, ledger=ledger)
+
+        asyncio.run(factory.send_order(taker).execute())
+        # The maker was loaded with its resting order held, the fill moved cash and released the filled part
+        assert ledger.get(taker.account).available == 70
+        assert ledger.get(maker.account).cash == 70
+        assert ledger.get(maker.account).available == 50
+
+        asyncio.run(factory.cancel_order(maker).execute())
+        assert ledger.get(maker.account).available == 70
+
+    def test_order_above_available_cash_is_rejected_before_matching(self):
+        resting = create_order('BUY', 10, 6)
+        order = create_order('BUY', 10, 5, account=resting.account)
+        factory = create_factory([resting], FakeAccountGateway(default=100))
+
+        with pytest.raises(domain.InsufficientCash):
+            asyncio.run(factory.send_order(order).execute())
+        assert dict(asyncio.run(factory.get_market_by_ticker('ABC').execute()).buy_level) == {10: 6}
+
+    def test_batch_can_not_spend_the_same_cash_twice(self):
+        order = create_order('BUY', 10, 6)
+        batch = [order, create_order('BUY', 10, 6, account=order.account)]
+        factory = create_factory(acc_gw=FakeAccountGateway(default=100))
+        with pytest.raises(domain.InsufficientCash):
+            asyncio.run(factory.send_orders(batch).execute())
+
+    def test_orders_on_two_tickers_can_not_spend_the_same_cash(self):
+        class SlowAccountGateway(FakeAccountGateway):
+            async def get_accounts_cash(self, accounts):
+                await asyncio.sleep(0.01)
+                return await super().get_accounts_cash(accounts)
+
+        buyer = uuid4()
+        maker = create_order('SELL', 10, 6)
+        ledger = handlers.AccountLedger()
+        factory = create_factory([maker], SlowAccountGateway({buyer: 100}), ledger=ledger)
+
+        async def main():
+            # The ABC order waits for its maker to load while the XYZ order is checked
+            return await asyncio.gather(
+                factory.send_order(create_order('BUY', 10, 6, account=buyer)).execute(),
+                factory.send_order(create_order('BUY', 10, 6, account=buyer, ticker='XYZ')).execute(),
+                return_exceptions=True,
+            )
+
+        first, second = asyncio.run(main())
+        assert [(x.price, x.quantity) for x in first.transactions] == [(10, 6)]
+        assert isinstance(second, domain.InsufficientCash)
+        assert (ledger.get(buyer).cash, ledger.get(buyer).available) == (40, 40)
+
+    def test_holds_of_a_failed_order_are_dropped(self):
+        class FailingAccountGateway(FakeAccountGateway):
+            async def get_accounts_cash(self, accounts):
+                if self.loaded:
+                    raise ConnectionError
+                return await super().get_accounts_cash(accounts)
+
+        taker = create_order('BUY', 20, 1)
+        ledger = handlers.AccountLedger()
+        factory = create_factory([create_order('SELL', 20, 10)], FailingAccountGateway({taker.account: 100}),
+                                 ledger=ledger)
+        with pytest.raises(ConnectionError):
+            asyncio.run(factory.send_order(taker).execute())
+        assert ledger.get(taker.account).available == 100
+
+    def test_accounts_are_loaded_once_until_invalidated(self):
+        order = create_order('BUY', 10, 1)
+        acc_gw = FakeAccountGateway()
+        ledger = handlers.AccountLedger()
+        factory = create_factory(acc_gw=acc_gw, ledger=ledger)
+        asyncio.run(factory.send_order(order).execute())
+        asyncio.run(factory.send_order(order.model_copy(update={'uuid': uuid4()})).execute())
+        assert acc_gw.loaded == [order.account]
+        assert ledger.get(order.account).available == 1_000_000 - 20
+
+        ledger.invalidate({order.account})
+        asyncio.run(factory.send_order(order.model_copy(update={'uuid': uuid4()})).execute())
+        assert acc_gw.loaded == [order.account, order.account]
+
+    def test_idle_entries_are_bounded_and_pending_ones_are_kept(self):
+        accounts = [uuid4() for _ in range(3)]
+        resting = create_order('BUY', 10, 1, account=accounts[0])
+        ledger = handlers.AccountLedger(max_idle=1)
+        asyncio.run(ledger.load(set(accounts[:2]), FakeAccountGateway(), FakeOrderRepo([resting])))
+        # An account with an open order is not idle, it is kept whatever the bound
+        assert accounts[0] in ledger and accounts[1] in ledger
+
+        trs = domain.Transaction(ticker='ABC', date=datetime.now(), price=10, quantity=1, buyer=accounts[1],
+                                 seller=accounts[0])
+        ledger.apply(handlers.MarketUpdate(None, [], [trs]))
+        asyncio.run(ledger.load({accounts[2]}, FakeAccountGateway(), FakeOrderRepo()))
+        # The uncommitted fill pins the buyer, the newest idle entry fills the bound
+        assert accounts[1] in ledger and accounts[2] in ledger
+
+        ledger.release({accounts[0], accounts[1]})
+        assert accounts[1] in ledger and accounts[2] not in ledger
+        assert ledger.get(accounts[1]).cash == 1_000_000 - 10
+
+
+class TestBookEviction:
+    def test_rejected_order_leaves_the_book_resident(self):
+        registry = handlers.MarketRegistry()
+        factory = create_factory([create_order('SELL', 20, 10)], registry=registry)
+        market = asyncio.run(factory.get_market_by_ticker('ABC').execute())
+        with pytest.raises(domain.OrderRejected):
+            asyncio.run(factory.send_order(create_order('BUY', 20.005, 1)).execute())
+        with pytest.raises(domain.OrderNotFound):
+            asyncio.run(factory.cancel_order(create_order('BUY', 20, 1)).execute())
+        assert asyncio.run(factory.get_market_by_ticker('ABC').execute()) is market
+
+    def test_failure_after_matching_evicts_the_book(self):
+        class FailingAccountGateway(FakeAccountGateway):
+            async def get_accounts_cash(self, accounts):
+                if self.loaded:
+                    raise ConnectionError
+                return await super().get_accounts_cash(accounts)
+
+        registry = handlers.MarketRegistry()
+        factory = create_factory([create_order('SELL', 20, 10)], FailingAccountGateway(), registry)
+        # The taker is loaded for the check, loading the maker fails once the book has matched
+        with pytest.raises(ConnectionError):
+            asyncio.run(factory.send_order(create_order('BUY', 20, 1)).execute())
+        assert 'ABC' not in registry
+
+    def test_resting_order_of_another_account_can_not_be_canceled(self):
+        registry = handlers.MarketRegistry()
+        resting = create_order('SELL', 20, 10)
+        factory = create_factory([resting], registry=registry)
+        with pytest.raises(domain.NotOrderOwner):
+            asyncio.run(factory.cancel_order(resting.model_copy(update={'account': uuid4()})).execute())
+        with pytest.raises(domain.NotOrderOwner):
+            asyncio.run(factory.amend_order(resting.model_copy(update={'account': uuid4(), 'quantity': 1})).execute())
+        market = asyncio.run(factory.get_market_by_ticker('ABC').execute())
+        assert dict(market.sell_level) == {20: 10}
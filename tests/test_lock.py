@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from src.market.infrastructure import lock
+from src.market.infrastructure.lock import MatchingLock
+from tests.helpers import FakePostgres
+
+
+class TestMatchingLock:
+    @pytest.fixture
+    def server(self, monkeypatch):
+        server = FakePostgres()
+        monkeypatch.setattr(lock.asyncpg, 'connect', server.connect)
+        return server
+
+    def test_second_process_starts_without_the_lock(self, server):
+        async def main():
+            first, second = MatchingLock('postgresql://localhost/test'), MatchingLock('postgresql://localhost/test')
+            acquired = await first.acquire(), await second.acquire()
+            held = first.held, second.held
+            await first.release()
+            # Released with its connection, another process may match now
+            return acquired, held, await second.acquire(), len(server.connections)
+
+        assert asyncio.run(main()) == ((True, False), (True, False), True, 1)
+
+    def test_lock_lost_with_its_connection_is_not_held(self, server):
+        async def main():
+            matching_lock = MatchingLock('postgresql://localhost/test')
+            await matching_lock.acquire()
+            server.drop_all()
+            other = MatchingLock('postgresql://localhost/test')
+            await other.acquire()
+            return matching_lock.held, other.held
+
+        assert asyncio.run(main()) == (False, True)
@@ -1,7 +1,12 @@
+import contextlib
+import random
 from datetime import datetime
 from uuid import uuid4
 
+import pytest
+
 from src.market import domain
+from tests.helpers import create_order
 
 
 class TestMarket:
@@ -106,3 +111,246 @@ class TestMarket:
         )
         assert len(market.transactions) == 4
         assert market.sell_level[90] == 300
+
+
+class TestPosition:
+    def test_position_accumulates_both_sides_and_skips_self_trades(self):
+        account, other = uuid4(), uuid4()
+        position = domain.Position(account, 'ABC')
+        for buyer, seller, price, quantity in [(account, other, 10, 5), (other, account, 12, 2), (account, account, 1, 9)]:
+            position.append_transaction(domain.Transaction(ticker='ABC', date=datetime.now(), price=price,
+                                                           quantity=quantity, buyer=buyer, seller=seller))
+        assert position.total_quantity == 3
+        assert position.avg_price == (5 * 10 - 2 * 12) / 3
+        with pytest.raises(ValueError):
+            position.append_transaction(domain.Transaction(ticker='ABC', date=datetime.now(), price=1, quantity=1,
+                                                           buyer=other, seller=other))
+
+
+    def test_changes_are_collected_per_account_and_ticker(self):
+        first, second = uuid4(), uuid4()
+        transactions = [
+            domain.Transaction(ticker='ABC', date=datetime.now(), price=10, quantity=2, buyer=first, seller=second),
+            domain.Transaction(ticker='ABC', date=datetime.now(), price=11, quantity=1, buyer=second, seller=first),
+            domain.Transaction(ticker='XYZ', date=datetime.now(), price=5, quantity=4, buyer=first, seller=first),
+        ]
+        changes = {(x.account_uuid, x.ticker): (x.weighted_price, x.total_quantity)
+                   for x in domain.Position.collect_changes(transactions)}
+        assert changes == {(first, 'ABC'): (9, 1), (second, 'ABC'): (-9, -1)}
+
+
+class TestMarketDepth:
+    def test_levels_are_aggregated_on_push(self):
+        market = domain.Market(ticker='ABC', orders=[
+            create_order('BUY', 10, 100),
+            create_order('BUY', 10, 50),
+            create_order('SELL', 20, 30),
+        ])
+        market.send_buy_limit_order(create_order('BUY', 11, 5))
+        assert dict(market.buy_level) == {10: 150, 11: 5}
+        assert dict(market.sell_level) == {20: 30}
+
+    def test_levels_are_reduced_on_match(self):
+        market = domain.Market(ticker='ABC', orders=[
+            create_order('SELL', 20, 100),
+            create_order('SELL', 20, 50),
+            create_order('SELL', 21, 30),
+        ])
+        market.send_buy_limit_order(create_order('BUY', 20, 120))
+        assert dict(market.sell_level) == {20: 30, 21: 30}
+        market.send_buy_limit_order(create_order('BUY', 21, 40))
+        assert dict(market.sell_level) == {21: 20}
+        assert len(market.buy_level) == 0
+
+    def test_top_levels_are_best_first(self):
+        orders = [create_order('BUY', x, 10) for x in range(1, 6)]
+        orders += [create_order('SELL', x, 10) for x in range(6, 11)]
+        market = domain.Market(ticker='ABC', orders=orders)
+        assert market.top_buy_levels(2) == [(5, 10), (4, 10)]
+        assert market.top_sell_levels(2) == [(6, 10), (7, 10)]
+        assert len(market.top_sell_levels(100)) == 5
+
+
+class TestMarketLevelChanges:
+    def test_touched_levels_are_reported_once_with_absolute_quantity(self):
+        orders = [create_order('SELL', 20, 10), create_order('SELL', 21, 5)]
+        market = domain.Market(ticker='ABC', orders=orders)
+        assert market.parse_level_changes() == ([], [])
+
+        market.send_order(create_order('BUY', 21, 12))
+        resting = create_order('BUY', 19, 4)
+        market.send_order(resting)
+        market.amend_order(resting.uuid, 3)
+        assert market.parse_level_changes() == ([(19, 3)], [(20, 0), (21, 3)])
+        assert market.parse_level_changes() == ([], [])
+
+        market.cancel_order(resting.uuid)
+        assert market.parse_level_changes() == ([(19, 0)], [])
+
+
+class TestMarketCancel:
+    def test_cancel_order_removes_quantity_and_emits_event(self):
+        first, second = create_order('SELL', 20, 100), create_order('SELL', 20, 50)
+        market = domain.Market(ticker='ABC', orders=[first, second])
+        market.cancel_order(first.uuid)
+        assert dict(market.sell_level) == {20: 50}
+        events = market.events.parse_events()
+        assert [x.key for x in events] == ['OrderCanceled']
+        assert events[0].entity.uuid == first.uuid
+        assert events[0].entity.status == 'CANCELED'
+        with pytest.raises(LookupError):
+            market.cancel_order(first.uuid)
+
+    def test_canceled_order_is_not_matched(self):
+        first, second, third = [create_order('SELL', 20, 10) for _ in range(3)]
+        market = domain.Market(ticker='ABC', orders=[first, second, third])
+        market.cancel_order(second.uuid)
+        market.send_buy_limit_order(create_order('BUY', 20, 30))
+        assert sum(x.quantity for x in market.transactions) == 20
+        assert len(market.sell_level) == 0
+        assert dict(market.buy_level) == {20: 10}
+
+    def test_cancel_last_order_removes_level(self):
+        order = create_order('BUY', 10, 10)
+        market = domain.Market(ticker='ABC', orders=[order])
+        market.cancel_order(order.uuid)
+        assert len(market.buy_level) == 0
+        market.send_sell_limit_order(create_order('SELL', 10, 10))
+        assert len(market.transactions) == 0
+        assert dict(market.sell_level) == {10: 10}
+
+    def test_amend_order_decreases_quantity(self):
+        order = create_order('BUY', 10, 10)
+        market = domain.Market(ticker='ABC', orders=[order])
+        market.amend_order(order.uuid, 4)
+        assert dict(market.buy_level) == {10: 4}
+        with pytest.raises(ValueError):
+            market.amend_order(order.uuid, 5)
+
+    def test_changes_are_converted_to_entities_once(self):
+        maker = create_order('SELL', 20, 10)
+        market = domain.Market(ticker='ABC', orders=[maker])
+        takers = [create_order('BUY', 20, 4), create_order('BUY', 20, 6)]
+        for taker in takers:
+            market.send_buy_limit_order(taker)
+        events = market.events.parse_events()
+        assert [x.key for x in events] == ['OrderUpdated', 'TransactionCreated', 'OrderCompleted',
+                                           'OrderCompleted', 'TransactionCreated', 'OrderCompleted']
+        assert events[0].entity is events[3].entity
+        assert isinstance(events[0].entity, domain.Order)
+        assert events[0].entity.status == 'COMPLETED'
+        assert [x.entity for x in events[1::3]] == market.parse_transactions()
+        # A taker filled on arrival is reported in its final state
+        orders = market.parse_orders()
+        assert [x.uuid for x in orders] == [maker.uuid, takers[0].uuid, takers[1].uuid]
+        assert [(x.status, x.quantity) for x in orders[1:]] == [('COMPLETED', 0), ('COMPLETED', 0)]
+
+
+class TestMarketTicks:
+    def test_prices_are_aggregated_by_tick(self):
+        market = domain.Market(ticker='ABC', orders=[], tick_size=0.1)
+        market.send_buy_limit_order(create_order('BUY', 0.3, 10))
+        market.send_buy_limit_order(create_order('BUY', 0.1 + 0.2, 5))
+        assert dict(market.buy_level) == {0.3: 15}
+        market.send_sell_limit_order(create_order('SELL', 0.3, 15))
+        assert [x.price for x in market.transactions] == [0.3, 0.3]
+        assert len(market.buy_level) == 0
+
+    def test_off_grid_price_is_rejected(self):
+        market = domain.Market(ticker='ABC', orders=[], tick_size=0.05)
+        with pytest.raises(ValueError):
+            market.send_buy_limit_order(create_order('BUY', 1.02, 10))
+        market.send_buy_limit_order(create_order('BUY', 1.05, 10))
+        assert market.top_buy_levels(1) == [(1.05, 10)]
+
+    def test_off_grid_resting_orders_move_in_their_favor(self):
+        market = domain.Market(ticker='ABC', orders=[create_order('SELL', 10.004, 5), create_order('BUY', 9.996, 5)])
+        assert market.top_sell_levels(1) == [(10.01, 5)]
+        assert market.top_buy_levels(1) == [(9.99, 5)]
+        market.send_buy_limit_order(create_order('BUY', 10.01, 1))
+        assert [x.price for x in market.transactions] == [10.01]
+
+    def test_crossed_resting_orders_are_loaded(self):
+        market = domain.Market(ticker='ABC', orders=[create_order('SELL', 10.4, 5), create_order('BUY', 10.3, 5)],
+                               tick_size=1)
+        # Snapped in their favor the orders do not cross, stored orders that do are kept as they are
+        assert (market.top_sell_levels(1), market.top_buy_levels(1), market.crossed) == ([(11, 5)], [(10, 5)], False)
+        market = domain.Market(ticker='ABC', orders=[create_order('SELL', 10, 5), create_order('BUY', 11, 5)],
+                               tick_size=1)
+        assert market.crossed
+
+
+class TestLadderBook:
+    def test_ladder_matches_like_sorted_book(self):
+        rng = random.Random(7)
+        markets = [domain.Market(ticker='ABC', orders=[], tick_size=0.01, book=book) for book in ('SORTED', 'LADDER')]
+        resting = []
+        for _ in range(2_000):
+            if resting and rng.random() < 0.2:
+                uuid = resting.pop(rng.randrange(len(resting)))
+                for market in markets:
+                    # Filled meanwhile in both books or in neither
+                    with contextlib.suppress(domain.OrderNotFound):
+                        market.cancel_order(uuid)
+                continue
+            direction = rng.choice(['BUY', 'SELL'])
+            order = create_order(direction, rng.randint(9_900, 10_100) / 100, rng.randint(1, 20))
+            resting.append(order.uuid)
+            for market in markets:
+                market.send_order(order)
+
+        sorted_market, ladder_market = markets
+        assert ladder_market.buy_level == sorted_market.buy_level
+        assert ladder_market.sell_level == sorted_market.sell_level
+        assert ladder_market.top_buy_levels(5) == sorted_market.top_buy_levels(5)
+        assert ladder_market.top_sell_levels(5) == sorted_market.top_sell_levels(5)
+        assert [(x.price, x.quantity) for x in ladder_market.transactions] == \
+               [(x.price, x.quantity) for x in sorted_market.transactions]
+
+    def test_best_level_moves_over_gaps(self):
+        market = domain.Market(ticker='ABC', orders=[
+            create_order('SELL', 10, 5),
+            create_order('SELL', 14, 5),
+            create_order('SELL', 20, 5),
+        ], tick_size=1, book='LADDER')
+        market.send_buy_limit_order(create_order('BUY', 14, 10))
+        assert market.top_sell_levels(2) == [(20, 5)]
+        market.send_buy_limit_order(create_order('BUY', 20, 5))
+        assert len(market.sell_level) == 0
+        market.send_sell_limit_order(create_order('SELL', 1_000, 5))
+        market.send_sell_limit_order(create_order('SELL', 990, 5))
+        assert market.top_sell_levels(5) == [(990, 5), (1_000, 5)]
+
+    def test_price_beyond_ladder_span_does_not_fit(self):
+        side = domain.LadderBookSide('BUY', max_span=100)
+        side.get_or_create(1_000)
+        assert not side.fits(1_100)
+        assert side.fits(1_099)
+
+    def test_drifting_ladder_is_trimmed(self):
+        side = domain.LadderBookSide('SELL', max_span=100)
+        side.get_or_create(1_000)
+        for tick in range(1_001, 1_300):
+            assert side.fits(tick)
+            side.get_or_create(tick)
+            side.remove(tick - 1)
+        assert len(side) == 1
+        assert side.best().tick == 1_299
+
+    def test_only_a_resting_remainder_must_fit_the_ladder(self):
+        market = domain.Market(ticker='ABC', orders=[
+            create_order('BUY', 1, 5),
+            create_order('SELL', 10, 5),
+        ], tick_size=1, book='LADDER')
+        # Marketable and filled on arrival: never rests, so the span of the buy side does not matter
+        market.send_buy_limit_order(create_order('BUY', 150_000, 3))
+        assert market.top_sell_levels(1) == [(10, 2)]
+        with pytest.raises(domain.OrderRejected):
+            market.send_buy_limit_order(create_order('BUY', 150_000, 3))
+        assert market.top_sell_levels(1) == [(10, 2)]
+
+    def test_loaded_orders_beyond_the_ladder_span_fall_back_to_sorted(self):
+        orders = [create_order('BUY', 1, 5), create_order('BUY', 150_000, 5)]
+        market = domain.Market(ticker='ABC', orders=orders, tick_size=1, book='LADDER')
+        assert market.book == 'SORTED'
+        assert market.top_buy_levels(2) == [(150_000, 5), (1, 5)]
@@ -0,0 +1,68 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from src.base.repo import PostgresRepo
+from src.base.repo.postgres import parse_filter_by
+from src.market import domain
+from src.market.infrastructure.postgres import OrderModel, TransactionModel
+
+
+def compile_where(filter_by: dict) -> str:
+    stmt = select(TransactionModel.__table__.c.id).where(*parse_filter_by(TransactionModel, filter_by))
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    return sql.split('WHERE', 1)[1].strip()
+
+
+class TestParseFilterBy:
+    def test_or_group(self):
+        account = uuid4()
+        where = compile_where({'$or': [{'buyer.uuid': account}, {'seller.uuid': account}]})
+        assert where == 'transaction.buyer = %(buyer_1)s::UUID OR transaction.seller = %(seller_1)s::UUID'
+
+    def test_or_group_of_conjunctions_next_to_plain_filter(self):
+        where = compile_where({
+            'quantity': 1,
+            '$or': [{'buyer.uuid': uuid4(), 'ticker': 'ABC'}, {'seller.uuid': uuid4()}],
+        })
+        assert where == ('transaction.quantity = %(quantity_1)s AND (transaction.buyer = %(buyer_1)s::UUID '
+                         'AND transaction.ticker = %(ticker_1)s OR transaction.seller = %(seller_1)s::UUID)')
+
+
+class RecordingSession:
+    def __init__(self, rowcount: int = 1):
+        self.statements = []
+        self.rowcount = rowcount
+
+    async def flush(self):
+        pass
+
+    async def execute(self, stmt, params=None):
+        self.statements.append((str(stmt.compile(dialect=postgresql.dialect())), params))
+        return type('Result', (), {'rowcount': self.rowcount})()
+
+
+class TestUpdateById:
+    @staticmethod
+    def create_order(quantity):
+        return domain.Order(account=uuid4(), ticker='ABC', dtype='LIMIT', direction='BUY', price=10,
+                            quantity=quantity, created=datetime.now())
+
+    def test_rows_are_updated_by_primary_key_without_orm_state(self):
+        session = RecordingSession()
+        orders = [self.create_order(1), self.create_order(2)]
+        asyncio.run(PostgresRepo(session, OrderModel).update_many(orders))
+        (sql, params), = session.statements
+        assert sql.startswith('UPDATE "order" SET')
+        assert 'WHERE "order".id = %(b_id)s' in sql
+        assert [x['b_id'] for x in params] == [x.uuid for x in orders]
+        assert [x['b_quantity'] for x in params] == [1, 2]
+        assert all(key.startswith('b_') for x in params for key in x)
+
+    def test_missing_row_is_reported(self):
+        with pytest.raises(LookupError):
+            asyncio.run(PostgresRepo(RecordingSession(rowcount=0), OrderModel).update_one(self.create_order(1)))
@@ -0,0 +1,47 @@
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from src.market import domain
+from src.market.infrastructure import schema
+
+TransactionRow = namedtuple('TransactionRow', domain.TRANSACTION_FIELDS)
+
+
+class TestTransactionExport:
+    rows = [
+        TransactionRow(uuid4(), 'ABC', datetime(2024, 1, 2, 3, 4, 5), 10.5, 3, uuid4(), uuid4()),
+        TransactionRow(uuid4(), 'ABC', datetime(2024, 1, 2, 3, 4, 6), 11.0, 1, uuid4(), uuid4()),
+    ]
+
+    def test_ndjson_has_one_object_per_line(self):
+        lines = schema.export_rows(self.rows, 'ndjson').splitlines()
+        assert len(lines) == 2
+        first = json.loads(lines[0])
+        assert first['uuid'] == str(self.rows[0].uuid)
+        assert first['date'] == '2024-01-02T03:04:05'
+        assert first['price'] == 10.5
+
+    def test_csv_chunks_follow_the_header(self):
+        body = schema.export_csv_header(domain.TRANSACTION_FIELDS)
+        body += schema.export_rows(self.rows[:1], 'csv') + schema.export_rows(self.rows[1:], 'csv')
+        records = list(csv.DictReader(io.StringIO(body)))
+        assert [x['buyer'] for x in records] == [str(x.buyer) for x in self.rows]
+        assert records[1]['quantity'] == '1'
+
+
+class TestCursor:
+    def test_cursor_round_trip(self):
+        moment, uuid = datetime(2024, 1, 2, 3, 4, 5, 678), uuid4()
+        token = schema.encode_cursor(moment, uuid)
+        assert schema.decode_cursor(token) == (moment, uuid)
+
+    def test_malformed_cursor_is_rejected(self):
+        for token in ('not a cursor', schema.encode_cursor(datetime.now(), uuid4())[:-4]):
+            with pytest.raises(ValueError):
+                schema.decode_cursor(token)